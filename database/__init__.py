@@ -24,8 +24,11 @@
 
 import re
 import logging
+import collections
 import datetime
 import functools
+import gzip
+import importlib
 import time
 import threading
 import lib.db
@@ -57,6 +60,30 @@ COL_LOG_VAL_NUM = 4
 COL_LOG_VAL_BOOL = 5
 COL_LOG_CHANGED = 6
 
+# Constants for rollup table
+COL_ROLLUP = ('item_id', 'tier', 'time', 'time_min', 'cnt', 'val_sum', 'val_min', 'val_max', 'val_dsum', 'duration', 'on_duration')
+
+# Rollup tiers (bucket sizes in milliseconds: minute, hour, day), coarsest last
+ROLLUP_TIERS = (60 * 1000, 60 * 60 * 1000, 24 * 60 * 60 * 1000)
+
+# Partial aggregates (time, count, sum, min, max, duration weighted sum, duration, on duration, conditional count)
+# used to combine results of log table, rollup table, result cache and buffer
+PARTIAL_FUNCS = ('avg', 'integrate', 'count', 'countall', 'min', 'max', 'on', 'sum')
+PARTIAL_COLUMNS = "MIN(time), COUNT(*), SUM(val_num), MIN(val_num), MAX(val_num), SUM(val_num * duration), SUM(duration), SUM(val_bool * duration), SUM(CASE WHEN val_num{cond} THEN 1 ELSE 0 END)"
+PARTIAL_ROLLUP_COLUMNS = "MIN(time_min), SUM(cnt), SUM(val_sum), MIN(val_min), MAX(val_max), SUM(val_dsum), SUM(duration), SUM(on_duration), NULL"
+PARTIAL_TIME = 0
+PARTIAL_COUNT = 1
+
+# Number of log records read per query when exporting
+EXPORT_CHUNK = 10000
+
+# Time frames (in milliseconds) used for relative times and durations
+TIME_FRAMES = {'i': 60 * 1000, 'h': 60 * 60 * 1000, 'd': 24 * 60 * 60 * 1000, 'w': 7 * 24 * 60 * 60 * 1000,
+               'm': 30 * 24 * 60 * 60 * 1000, 'y': 365 * 24 * 60 * 60 * 1000}
+
+# Parameter placeholders used by the DB API 2 paramstyles (used for bulk writes)
+PARAM_FORMATS = {'qmark': '?', 'format': '%s', 'numeric': ':{}', 'named': ':{}', 'pyformat': '%({})s'}
+
 
 class Database(SmartPlugin):
     ALLOW_MULTIINSTANCE = True
@@ -75,10 +102,38 @@ class Database(SmartPlugin):
         '4': ["CREATE INDEX {log}_{item}_id_changed ON {log} (item_id, changed);",
               "DROP INDEX {log}_{item}_id_changed;"],
         '5': ["CREATE UNIQUE INDEX {item}_id ON {item} (id);", "DROP INDEX {item}_id;"],
-        '6': ["CREATE INDEX {item}_name ON {item} (name);", "DROP INDEX {item}_name;"]
+        '6': ["CREATE INDEX {item}_name ON {item} (name);", "DROP INDEX {item}_name;"],
+        '7': [
+            "CREATE TABLE {rollup} (item_id INTEGER, tier BIGINT, time BIGINT, time_min BIGINT, cnt INTEGER, val_sum REAL, val_min REAL, val_max REAL, val_dsum REAL, duration BIGINT, on_duration BIGINT);",
+            "DROP TABLE {rollup};"],
+        '8': ["CREATE UNIQUE INDEX {rollup}_id_tier_time ON {rollup} (item_id, tier, time);",
+              "DROP INDEX {rollup}_id_tier_time;"],
+        '9': ["CREATE TABLE {rollup_since} (item_id INTEGER, time BIGINT);", "DROP TABLE {rollup_since};"]
     }
 
-    def __init__(self, smarthome, driver, connect, prefix="", cycle=60, precision=2):
+    # Upsert statements for the log table used by the bulk dump, depending on driver
+    _upsert_log = {
+        'on_conflict': "INSERT INTO {log}(item_id, time, val_str, val_num, val_bool, duration, changed) VALUES (:id,:time,:val_str,:val_num,:val_bool,:duration,:changed) "
+                       "ON CONFLICT (item_id, time) DO UPDATE SET duration = excluded.duration, val_str = excluded.val_str, val_num = excluded.val_num, val_bool = excluded.val_bool, changed = excluded.changed;",
+        'on_duplicate_key': "INSERT INTO {log}(item_id, time, val_str, val_num, val_bool, duration, changed) VALUES (:id,:time,:val_str,:val_num,:val_bool,:duration,:changed) "
+                            "ON DUPLICATE KEY UPDATE duration = VALUES(duration), val_str = VALUES(val_str), val_num = VALUES(val_num), val_bool = VALUES(val_bool), changed = VALUES(changed);"
+    }
+    _upsert_rollup = {
+        'on_conflict': "INSERT INTO {rollup}({rollup_columns}) VALUES (:id,:tier,:time,:time_min,:cnt,:val_sum,:val_min,:val_max,:val_dsum,:duration,:on_duration) "
+                       "ON CONFLICT (item_id, tier, time) DO UPDATE SET time_min = excluded.time_min, cnt = excluded.cnt, val_sum = excluded.val_sum, val_min = excluded.val_min, val_max = excluded.val_max, val_dsum = excluded.val_dsum, duration = excluded.duration, on_duration = excluded.on_duration;",
+        'on_duplicate_key': "INSERT INTO {rollup}({rollup_columns}) VALUES (:id,:tier,:time,:time_min,:cnt,:val_sum,:val_min,:val_max,:val_dsum,:duration,:on_duration) "
+                            "ON DUPLICATE KEY UPDATE time_min = VALUES(time_min), cnt = VALUES(cnt), val_sum = VALUES(val_sum), val_min = VALUES(val_min), val_max = VALUES(val_max), val_dsum = VALUES(val_dsum), duration = VALUES(duration), on_duration = VALUES(on_duration);"
+    }
+    _upsert_drivers = {
+        'sqlite3': 'on_conflict',
+        'psycopg2': 'on_conflict',
+        'pymysql': 'on_duplicate_key',
+        'MySQLdb': 'on_duplicate_key',
+        'mysql.connector': 'on_duplicate_key'
+    }
+
+    def __init__(self, smarthome, driver, connect, prefix="", cycle=60, precision=2, rollup=False, cache_size=0,
+                 retention_cycle=3600, retention_batch=1000):
         self._sh = smarthome
         self.shtime = Shtime.get_instance()
         self.items = Items.get_instance()
@@ -86,20 +141,55 @@ class Database(SmartPlugin):
         self._dump_cycle = int(cycle)
         self._precision = int(precision)
         self._name = self.get_instance_name()
-        self._replace = {table: table if prefix == "" else prefix + "_" + table for table in ["log", "item"]}
+        self._replace = {table: table if prefix == "" else prefix + "_" + table for table in ["log", "item", "rollup", "rollup_since"]}
         self._replace['item_columns'] = ", ".join(COL_ITEM)
         self._replace['log_columns'] = ", ".join(COL_LOG)
+        self._replace['rollup_columns'] = ", ".join(COL_ROLLUP)
         self._buffer = {}
         self._buffer_lock = threading.Lock()
         self._dump_lock = threading.Lock()
+        self._dump_stats = {'rows': 0, 'items': 0, 'duration': 0.0, 'rate': 0.0, 'bulk': False, 'time': None}
+        self._export_stats = {'rows': 0, 'items': 0, 'total': 0, 'running': False, 'time': None}
+        self._driver = driver
+
+        try:
+            self._paramstyle = importlib.import_module(driver).paramstyle
+        except Exception:
+            self._paramstyle = None
+        self._upsert = self._upsert_drivers.get(driver) if self._paramstyle in PARAM_FORMATS else None
+
+        self._rollup = Utils.to_bool(rollup)
+        if self._rollup and self._upsert is None:
+            self.logger.warning("Database: Rollup tables are not supported for driver {}, disabling them".format(driver))
+            self._rollup = False
+        self._rollup_since = None
+        self._rollup_buckets = {}
+
+        self._cache_size = int(cache_size)
+        self._cache = collections.OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._cache_stats = {'hits': 0, 'misses': 0}
+
+        self._retention = {}
+        self._retention_done = {}
+        self._retention_cycle = int(retention_cycle)
+        self._retention_batch = max(int(retention_batch), 1)
+        self._retention_lock = threading.Lock()
+        self._retention_stats = {'items': 0, 'removed': 0, 'written': 0, 'batches': 0, 'duration': 0.0,
+                                 'lock_max': 0.0, 'space': None, 'time': None}
 
         self._db = lib.db.Database(("" if prefix == "" else prefix.capitalize() + "_") + "Database", driver,
                                    Utils.string_to_list(connect))
         self._initialized = False
+        self._item_ids = None
         self._initialize()
+        self._load_item_ids()
 
         smarthome.scheduler.add('Database dump ' + self._name + ("" if prefix == "" else " [" + prefix + "]"),
                                 self._dump, cycle=self._dump_cycle, prio=5)
+        if self._retention_cycle > 0:
+            smarthome.scheduler.add('Database retention ' + self._name + ("" if prefix == "" else " [" + prefix + "]"),
+                                    self.retention, cycle=self._retention_cycle, prio=7)
 
         self.init_webinterface()
         return
@@ -112,6 +202,9 @@ class Database(SmartPlugin):
             item.db = functools.partial(self._single, item=item.id())
             item.dbplugin = self
 
+            if self.has_iattr(item.conf, 'database_retention'):
+                self._parse_retention(item)
+
             if self._initialized and self.get_iattr_value(item.conf, 'database') == 'init':
                 if not self._db.lock(5):
                     self.logger.error("Can not acquire lock for database to read value for item {}".format(item.id()))
@@ -136,6 +229,19 @@ class Database(SmartPlugin):
         else:
             return None
 
+    def _parse_retention(self, item):
+        retention = self._parse_duration(self.get_iattr_value(item.conf, 'database_retention'))
+        step = None
+        if self.has_iattr(item.conf, 'database_downsample'):
+            step = self._parse_duration(self.get_iattr_value(item.conf, 'database_downsample'))
+            if step is None:
+                return
+            if item.type() != 'num':
+                self.logger.warning("Database: Downsampling is supported for items of type num only, ignoring retention of {}".format(item.id()))
+                return
+        if retention is not None:
+            self._retention[item] = (retention, step)
+
     def run(self):
         self.alive = True
 
@@ -160,36 +266,71 @@ class Database(SmartPlugin):
             self._buffer[item].append((end, None, item()))
 
     def dump(self, dumpfile, id=None, time=None, time_start=None, time_end=None, changed=None, changed_start=None,
-             changed_end=None, cur=None):
+             changed_end=None, cur=None, compress=None):
+        """
+        Dumps the log table to the given file (gzip compressed if the file name
+        ends with .gz or compress is set)
+
+        The records are written while reading them in chunks (see export()),
+        so the memory usage does not depend on the size of the database.
+        """
         self.logger.info("Starting file dump to {} ...".format(dumpfile))
 
+        if compress is None:
+            compress = dumpfile.endswith('.gz')
+        f = gzip.open(dumpfile, 'wt') if Utils.to_bool(compress) else open(dumpfile, 'w')
+        try:
+            for line in self.export(id=id, time=time, time_start=time_start, time_end=time_end, changed=changed,
+                                    changed_start=changed_start, changed_end=changed_end, cur=cur):
+                f.write(line)
+        finally:
+            f.close()
+        self.logger.info("File dump completed ({} items, {} records) ...".format(self._export_stats['items'],
+                                                                                  self._export_stats['rows']))
+
+    def export(self, id=None, time=None, time_start=None, time_end=None, changed=None, changed_start=None,
+               changed_end=None, cur=None):
+        """
+        Generator returning the lines of a dump of the log table (see dump())
+
+        The progress is available in _export_stats while iterating.
+        """
         item_ids = self.readItems(cur=cur) if id is None else [self.readItem(id, cur=cur)]
+        item_ids = [item for item in item_ids or [] if item is not None]
+        stats = {'rows': 0, 'items': 0, 'total': len(item_ids), 'running': True, 'time': self.shtime.now()}
+        self._export_stats = stats
 
         s = ';'
         h = ['item_id', 'item_name', 'time', 'duration', 'val_str', 'val_num', 'val_bool', 'changed', 'time_date',
              'changed_date']
-        f = open(dumpfile, 'w')
-        f.write(s.join(h) + "\n")
-        for item in item_ids:
-            self.logger.debug("... dumping item {}/{}".format(item[1], item[0]))
-
-            rows = self.readLogs(item[0], time=time, time_start=time_start, time_end=time_end, changed=changed,
-                                 changed_start=changed_start, changed_end=changed_end, cur=cur)
-
-            for row in rows:
-                cols = []
-                for key in [COL_ITEM_ID, COL_ITEM_NAME]:
-                    cols.append(item[key])
-                for key in [COL_LOG_TIME, COL_LOG_DURATION, COL_LOG_VAL_STR, COL_LOG_VAL_NUM, COL_LOG_VAL_BOOL,
-                            COL_LOG_CHANGED]:
-                    cols.append(row[key])
-                for key in [COL_ITEM_ID, COL_LOG_CHANGED]:
-                    cols.append('' if row[key] is None else datetime.datetime.fromtimestamp(row[key] / 1000.0))
-                cols = map(lambda col: '' if col is None else col, cols)
-                cols = map(lambda col: str(col) if not '"' in str(col) else col.replace('"', '\\"'), cols)
-                f.write(s.join(cols) + "\n")
-        f.close()
-        self.logger.info("File dump completed ({} items) ...".format(len(item_ids)))
+        try:
+            yield s.join(h) + "\n"
+            for item in item_ids:
+                self.logger.debug("... dumping item {}/{}".format(item[1], item[0]))
+
+                for rows in self.readLogsChunked(item[0], time=time, time_start=time_start, time_end=time_end,
+                                                 changed=changed, changed_start=changed_start,
+                                                 changed_end=changed_end, cur=cur):
+                    lines = []
+                    for row in rows:
+                        cols = []
+                        for key in [COL_ITEM_ID, COL_ITEM_NAME]:
+                            cols.append(item[key])
+                        for key in [COL_LOG_TIME, COL_LOG_DURATION, COL_LOG_VAL_STR, COL_LOG_VAL_NUM, COL_LOG_VAL_BOOL,
+                                    COL_LOG_CHANGED]:
+                            cols.append(row[key])
+                        for key in [COL_ITEM_ID, COL_LOG_CHANGED]:
+                            cols.append('' if row[key] is None else datetime.datetime.fromtimestamp(row[key] / 1000.0))
+                        cols = map(lambda col: '' if col is None else col, cols)
+                        cols = map(lambda col: str(col) if not '"' in str(col) else col.replace('"', '\\"'), cols)
+                        lines.append(s.join(cols) + "\n")
+                    stats['rows'] += len(rows)
+                    yield "".join(lines)
+                stats['items'] += 1
+                self.logger.debug("... dumped {}/{} items, {} records".format(stats['items'], stats['total'],
+                                                                            stats['rows']))
+        finally:
+            stats['running'] = False
 
     def cleanup(self):
         items = [item.id() for item in self._buffer]
@@ -207,19 +348,28 @@ class Database(SmartPlugin):
         self._db.release()
 
     def id(self, item, create=True, cur=None):
-        id = self.readItem(str(item.id()), cur=cur)
+        if self._item_ids is None:
+            self._load_item_ids(cur=cur)
+
+        if self._item_ids is not None:
+            id = self._item_ids.get(str(item.id()))
+        else:
+            id = self.readItem(str(item.id()), cur=cur)
+            id = None if id is None else int(id[COL_ITEM_ID])
 
         if id is None and create == True:
-            id = [self.insertItem(item.id(), cur)]
+            id = self.insertItem(item.id(), cur)
 
-        return None if id == None else int(id[COL_ITEM_ID])
+        return id
 
     def insertItem(self, name, cur=None):
         id = self._fetchone("SELECT MAX(id) FROM {item};", cur=cur)
+        id = 1 if id[0] == None else int(id[0]) + 1
         self._execute(self._prepare("INSERT INTO {item}(id, name) VALUES(:id, :name);"),
-                      {'id': 1 if id[0] == None else id[0] + 1, 'name': name}, cur=cur)
-        id = self._fetchone("SELECT id FROM {item} where name = :name;", {'name': name}, cur=cur)
-        return int(id[0])
+                      {'id': id, 'name': name}, cur=cur)
+        if self._item_ids is not None:
+            self._item_ids[str(name)] = id
+        return id
 
     def updateItem(self, id, time, duration=0, val=None, it=None, changed=None, cur=None):
         params = {'id': id, 'time': time, 'changed': changed}
@@ -240,9 +390,13 @@ class Database(SmartPlugin):
     def deleteItem(self, id, cur=None):
         params = {'id': id}
         self.deleteLog(id, cur=cur)
+        self._execute(self._prepare("DELETE FROM {rollup} WHERE item_id = :id;"), params, cur=cur)
         self._execute(self._prepare("DELETE FROM {item} WHERE id = :id;"), params, cur=cur)
+        if self._item_ids is not None:
+            self._item_ids = {name: item_id for name, item_id in self._item_ids.items() if item_id != int(id)}
 
     def insertLog(self, id, time, duration=0, val=None, it=None, changed=None, cur=None):
+        self._cache_invalidate(id, time)
         params = {'id': id, 'time': time, 'changed': changed, 'duration': duration}
         params.update(self._item_value_tuple(it, val))
         self._execute(self._prepare(
@@ -250,6 +404,7 @@ class Database(SmartPlugin):
                       params, cur=cur)
 
     def updateLog(self, id, time, duration=0, val=None, it=None, changed=None, cur=None):
+        self._cache_invalidate(id, time)
         params = {'id': id, 'time': time, 'changed': changed, 'duration': duration}
         params.update(self._item_value_tuple(it, val))
         self._execute(self._prepare(
@@ -266,12 +421,62 @@ class Database(SmartPlugin):
                                                   changed=changed, changed_start=changed_start, changed_end=changed_end)
         return self._fetchall("SELECT {log_columns} FROM {log} WHERE " + condition, params, cur=cur)
 
+    def readLogsChunked(self, id, time=None, time_start=None, time_end=None, changed=None, changed_start=None,
+                        changed_end=None, order='ASC', chunk=EXPORT_CHUNK, cur=None):
+        """
+        Generator returning the log records like readLogs() as lists of at
+        most chunk records ordered by time
+
+        The chunks are read using keyset pagination on (item_id, time), so each
+        query only holds the database lock for one chunk and large logs do not
+        need to be kept in memory.
+        """
+        condition, params = self._slice_condition(id, time=time, time_start=time_start, time_end=time_end,
+                                                  changed=changed, changed_start=changed_start, changed_end=changed_end)
+        desc = order.upper() == 'DESC'
+        query = "SELECT {log_columns} FROM {log} WHERE " + condition.rstrip().rstrip(';') + "{keyset} ORDER BY time " + \
+                ("DESC" if desc else "ASC") + " LIMIT " + str(int(chunk)) + ";"
+        keyset = ""
+        while True:
+            rows = self._fetchall(query.replace("{keyset}", keyset), params, cur=cur)
+            if not rows:
+                break
+            yield rows
+            if len(rows) < chunk:
+                break
+            # continue after the last record (using the index instead of an offset)
+            keyset = " AND time < :time_last" if desc else " AND time > :time_last"
+            params['time_last'] = rows[-1][COL_LOG_TIME]
+
     def deleteLog(self, id, time=None, time_start=None, time_end=None, changed=None, changed_start=None,
                   changed_end=None, cur=None):
         condition, params = self._slice_condition(id, time=time, time_start=time_start, time_end=time_end,
                                                   changed=changed, changed_start=changed_start, changed_end=changed_end)
         self._execute(self._prepare("DELETE FROM {log} WHERE " + condition), params, cur=cur)
 
+        self._cache_invalidate(id)
+
+        # rollups may contain deleted records now, so do not use them until rebuilt
+        self._execute(self._prepare("DELETE FROM {rollup_since} WHERE item_id = :id;"), {'id': id}, cur=cur)
+        if self._rollup_since is not None:
+            self._rollup_since.pop(int(id), None)
+
+    def _load_item_ids(self, cur=None):
+        """
+        Loads the item table into the name to ID map used by id()
+
+        The map is kept in sync by insertItem() and deleteItem(), so item IDs
+        are answered from memory instead of querying the item table.
+        """
+        try:
+            items = self.readItems(cur=cur)
+        except Exception as e:
+            self.logger.warning("Database: Loading item IDs failed: {}".format(e))
+            items = None
+        if items is not None:
+            self._item_ids = {str(item[COL_ITEM_NAME]): int(item[COL_ITEM_ID]) for item in items}
+        return self._item_ids
+
     def _slice_condition(self, id, time=None, time_start=None, time_end=None, changed=None, changed_start=None,
                          changed_end=None):
         params = {
@@ -342,81 +547,529 @@ class Database(SmartPlugin):
             items = list(self._buffer.keys())
             self._buffer_lock.release()
 
+        dumps = []
         for item in items:
             tuples = self._buffer_remove(item)
-
             if len(tuples) or finalize:
+                dumps.append((item, tuples))
 
-                # Test connectivity
-                if self._db.verify(5) == 0:
-                    self._buffer_insert(item, tuples)
-                    self.logger.error("Database: Connection not recovered, skipping dump");
-                    self._dump_lock.release()
-                    return
+        if len(dumps) == 0:
+            self.logger.debug('Dump completed (nothing to dump)')
+            self._dump_lock.release()
+            return
 
-                # Can't lock, restore data
-                if not self._db.lock(300):
-                    self._buffer_insert(item, tuples)
-                    if finalize:
-                        self.logger.error(
-                            "Database: can't dump {} items due to fail to acquire lock!".format(len(self._buffer)))
-                    else:
-                        self.logger.error(
-                            "Database: can't dump {} items due to fail to acquire lock - will try on next dump".format(
-                                len(self._buffer)))
-                    self._dump_lock.release()
-                    return
+        # Test connectivity
+        if self._db.verify(5) == 0:
+            self._buffer_restore(dumps)
+            self.logger.error("Database: Connection not recovered, skipping dump");
+            self._dump_lock.release()
+            return
 
-                cur = None
+        # Can't lock, restore data
+        if not self._db.lock(300):
+            self._buffer_restore(dumps)
+            if finalize:
+                self.logger.error(
+                    "Database: can't dump {} items due to fail to acquire lock!".format(len(self._buffer)))
+            else:
+                self.logger.error(
+                    "Database: can't dump {} items due to fail to acquire lock - will try on next dump".format(
+                        len(self._buffer)))
+            self._dump_lock.release()
+            return
+
+        dump_start = time.time()
+        rows = 0
+        bulk = self._upsert is not None
+        try:
+            changed = self._timestamp(self.shtime.now())
+            if bulk:
                 try:
-                    changed = self._timestamp(self.shtime.now())
+                    rows = self._dump_bulk(dumps, changed, finalize)
+                except Exception as e:
+                    self.logger.warning("Database: Bulk dump failed, falling back to dumping items one by one: {}".format(e))
+                    bulk = False
+                    self._rollback()
+            if not bulk:
+                rows = self._dump_single(dumps, changed, finalize)
+        finally:
+            self._db.release()
+
+        duration = time.time() - dump_start
+        self._dump_stats = {
+            'rows': rows,
+            'items': len(dumps),
+            'duration': duration,
+            'rate': rows / duration if duration > 0 else 0.0,
+            'bulk': bulk,
+            'time': self.shtime.now()
+        }
+        self.logger.debug('Dump completed: {} rows of {} items in {:.3f}s ({:.0f} rows/s)'.format(
+            rows, len(dumps), duration, self._dump_stats['rate']))
+        self._dump_lock.release()
 
-                    # Get current values of item
-                    start = self._timestamp(item.last_change())
-                    end = changed
-                    val = item()
+    def _dump_prepare(self, item, tuples, changed, finalize):
+        """
+        Returns the log tuples and the item table update for the given item
 
-                    # When finalizing (e.g. plugin shutdown) add current value to item and log
-                    if finalize:
-                        _update = (end, val, changed)
+        When finalizing (e.g. plugin shutdown) the current value is added to
+        the log tuples, too.
+        """
+        start = self._timestamp(item.last_change())
+        end = changed
+        val = item()
 
-                        current = (start, end - start, val)
-                        tuples.append(current)
+        if finalize:
+            return tuples + [(start, end - start, val)], (end, val, changed)
+        return tuples, (start, val, changed)
 
-                    else:
-                        _update = (start, val, changed)
+    def _dump_bulk(self, dumps, changed, finalize):
+        """
+        Dumps all given items within one transaction using bulk writes
 
-                    cur = self._db.cursor()
-                    id = self.id(item, cur=cur)
+        :param dumps: list of (item, tuples) to dump
+        :return: number of written log rows
+        """
+        logs = []
+        updates = []
+        rollups = []
+        cur = self._db.cursor()
+        try:
+            for (item, tuples) in dumps:
+                tuples, _update = self._dump_prepare(item, tuples, changed, finalize)
+                id = self.id(item, cur=cur)
+                self.logger.debug('Dumping {}/{} with {} values'.format(item.id(), id, len(tuples)))
+                for t in tuples:
+                    logs.append(self._log_params(id, t[0], t[1], t[2], item.type(), changed))
+                if len(tuples):
+                    self._cache_invalidate(id, min(t[0] for t in tuples))
+                updates.append(self._log_params(id, _update[0], None, _update[1], item.type(), _update[2]))
+                if self._rollup:
+                    rollups += self._rollup_add(id, item.type(), tuples, cur)
+
+            self._executemany(self._upsert_log[self._upsert], logs, cur)
+            self._executemany(self._upsert_rollup[self._upsert], rollups, cur)
+            self._executemany(
+                "UPDATE {item} SET time = :time, val_str = :val_str, val_num = :val_num, val_bool = :val_bool, changed = :changed WHERE id = :id;",
+                updates, cur)
+        finally:
+            cur.close()
+        self._db.commit()
+        return len(logs)
 
-                    # Dump tuples
-                    self.logger.debug('Dumping {}/{} with {} values'.format(item.id(), id, len(tuples)))
+    def _dump_single(self, dumps, changed, finalize):
+        """
+        Dumps the given items one by one, each within its own transaction
 
-                    for t in tuples:
-                        if len(self.readLog(id, t[0], cur)):
-                            self.updateLog(id, t[0], t[1], t[2], item.type(), changed, cur)
-                        else:
-                            self.insertLog(id, t[0], t[1], t[2], item.type(), changed, cur)
+        :param dumps: list of (item, tuples) to dump
+        :return: number of written log rows
+        """
+        rows = 0
+        for (item, tuples) in dumps:
+            cur = None
+            try:
+                tuples, _update = self._dump_prepare(item, tuples, changed, finalize)
+
+                cur = self._db.cursor()
+                id = self.id(item, cur=cur)
+
+                # Dump tuples
+                self.logger.debug('Dumping {}/{} with {} values'.format(item.id(), id, len(tuples)))
+
+                for t in tuples:
+                    if len(self.readLog(id, t[0], cur)):
+                        self.updateLog(id, t[0], t[1], t[2], item.type(), changed, cur)
+                    else:
+                        self.insertLog(id, t[0], t[1], t[2], item.type(), changed, cur)
+
+                self.updateItem(id, _update[0], None, _update[1], item.type(), _update[2], cur)
 
-                    self.updateItem(id, _update[0], None, _update[1], item.type(), _update[2], cur)
+                if self._rollup:
+                    self._executemany(self._upsert_rollup[self._upsert], self._rollup_add(id, item.type(), tuples, cur), cur)
 
+                cur.close()
+                cur = None
+
+                self._db.commit()
+                rows += len(tuples)
+            except Exception as e:
+                self.logger.warning("Database: Problem dumping {}: {}".format(item.id(), e))
+                if not self._rollback():
+                    self._buffer_insert(item, tuples)
+            finally:
+                if cur is not None:
                     cur.close()
-                    cur = None
+        return rows
 
-                    self._db.commit()
-                except Exception as e:
-                    self.logger.warning("Database: Problem dumping {}: {}".format(item.id(), e))
-                    try:
-                        self._db.rollback()
-                    except Exception as er:
-                        self._buffer_insert(item, tuples)
-                        self.logger.warning("Database: Error rolling back: {}".format(er))
-                finally:
-                    if cur is not None:
-                        cur.close()
+    def _rollup_load(self, cur=None):
+        """
+        Loads the times since when the rollups of the items are complete
+        """
+        if self._rollup_since is None:
+            rows = self._fetchall("SELECT item_id, time FROM {rollup_since};", cur=cur)
+            if rows is not None:
+                self._rollup_since = {int(row[0]): int(row[1]) for row in rows}
+        return self._rollup_since
+
+    def _rollup_add(self, id, it, tuples, cur):
+        """
+        Adds the closed log tuples (having a duration) of an item to the
+        rollup buckets of all tiers
+
+        Only the most recent bucket per item and tier is kept in memory, older
+        buckets are read from the database when required. Log records are
+        counted in the bucket their start time belongs to, while their duration
+        (and the duration weighted values) is split across all buckets covered
+        by the record.
+
+        :return: list of parameters of the changed buckets to upsert
+        """
+        closed = [t for t in tuples if t[1] is not None]
+        if len(closed) == 0:
+            return []
+
+        since = self._rollup_load(cur)
+        if since is not None and id not in since:
+            # buckets before the next full day may miss records logged before rollups were enabled
+            since[id] = (closed[0][0] // ROLLUP_TIERS[-1] + 1) * ROLLUP_TIERS[-1]
+            self._execute("INSERT INTO {rollup_since}(item_id, time) VALUES (:id, :time);",
+                          {'id': id, 'time': since[id]}, cur=cur)
+
+        changed = {}
+        for (ts, duration, val) in closed:
+            values = self._item_value_tuple(it, val)
+            val_num = values['val_num']
+            for tier in ROLLUP_TIERS:
+                bucket = self._rollup_bucket(id, tier, ts - ts % tier, cur)
+                bucket['time_min'] = ts if bucket['time_min'] is None else min(bucket['time_min'], ts)
+                bucket['cnt'] += 1
+                if val_num is not None:
+                    bucket['val_sum'] = val_num + (bucket['val_sum'] or 0)
+                    bucket['val_min'] = val_num if bucket['val_min'] is None else min(bucket['val_min'], val_num)
+                    bucket['val_max'] = val_num if bucket['val_max'] is None else max(bucket['val_max'], val_num)
+                changed[(tier, bucket['time'])] = bucket
+
+                part_start = ts
+                while True:
+                    bucket_end = part_start - part_start % tier + tier
+                    part = min(ts + duration, bucket_end) - part_start
+                    bucket = self._rollup_bucket(id, tier, part_start - part_start % tier, cur)
+                    bucket['duration'] += part
+                    bucket['on_duration'] += values['val_bool'] * part
+                    if val_num is not None:
+                        bucket['val_dsum'] = val_num * part + (bucket['val_dsum'] or 0)
+                    changed[(tier, bucket['time'])] = bucket
+                    if ts + duration <= bucket_end:
+                        break
+                    part_start = bucket_end
+        return list(changed.values())
+
+    def _rollup_bucket(self, id, tier, ts, cur):
+        current = self._rollup_buckets.get((id, tier))
+        if current is not None and current['time'] == ts:
+            return current
+
+        bucket = {'id': id, 'tier': tier, 'time': ts, 'time_min': None, 'cnt': 0, 'val_sum': None, 'val_min': None,
+                  'val_max': None, 'val_dsum': None, 'duration': 0, 'on_duration': 0}
+        # a bucket newer than the one in memory can not exist in the database yet
+        if current is None or current['time'] > ts:
+            row = self._fetchone("SELECT {rollup_columns} FROM {rollup} WHERE item_id = :id AND tier = :tier AND time = :time;",
+                                 {'id': id, 'tier': tier, 'time': ts}, cur=cur)
+            if row is not None:
+                bucket.update({col: row[i] for i, col in enumerate(COL_ROLLUP) if i > 2})
+                bucket['duration'] = bucket['duration'] or 0
+                bucket['on_duration'] = bucket['on_duration'] or 0
+
+        # keep the most recent bucket only, since records are usually closed in order
+        if current is None or current['time'] < ts:
+            self._rollup_buckets[(id, tier)] = bucket
+        return bucket
+
+    def _rollup_tier(self, id, istart, step):
+        """
+        Returns the coarsest rollup tier usable for the given start and step
+        or None if the raw log has to be used
+        """
+        if not self._rollup or id is None or step is None or step <= 0:
+            return None
+        since = self._rollup_load()
+        if since is None or id not in since or istart < since[id]:
+            return None
+        for tier in reversed(ROLLUP_TIERS):
+            if step % tier == 0 or step >= 60 * tier:
+                return tier
+        return None
+
+    def rollup_rebuild(self, id=None):
+        """
+        Rebuilds the rollups of the given item (or all items) from the log table
+
+        This is required to use the rollups for data logged before the rollups
+        were enabled. The log table is read in chunks, but the database is
+        locked while rebuilding an item.
+        """
+        if not self._rollup:
+            self.logger.warning("Database: Rollup tables are disabled, not rebuilding rollups")
+            return
+        ids = [item[COL_ITEM_ID] for item in self.readItems()] if id is None else [id]
+        for id in ids:
+            self._rollup_rebuild_item(int(id))
+
+    def _rollup_rebuild_item(self, id):
+        if self._dump_lock.acquire(timeout=60) == False:
+            self.logger.warning("Database: Can not rebuild rollups for item {}, since dump is running".format(id))
+            return
+        if not self._db.lock(300):
+            self.logger.error("Database: Can not acquire lock for rebuilding rollups for item {}".format(id))
+            self._dump_lock.release()
+            return
+        since = None
+        cur = self._db.cursor()
+        try:
+            self.logger.info("Database: Rebuilding rollups for item {}".format(id))
+            name = self.readItem(id, cur=cur)
+            item = None if name is None else self.items.return_item(name[COL_ITEM_NAME])
+            it = 'num' if item is None else item.type()
+            self._execute("DELETE FROM {rollup} WHERE item_id = :id;", {'id': id}, cur=cur)
+            self._execute("DELETE FROM {rollup_since} WHERE item_id = :id;", {'id': id}, cur=cur)
+            for tier in ROLLUP_TIERS:
+                self._rollup_buckets.pop((id, tier), None)
+            if self._rollup_load(cur) is not None:
+                self._rollup_since.pop(id, None)
+
+            ts = -1
+            while True:
+                rows = self._fetchall("SELECT time, duration, val_str, val_num, val_bool FROM {log} WHERE item_id = :id AND time > :time AND duration IS NOT NULL ORDER BY time ASC LIMIT 10000;",
+                                      {'id': id, 'time': ts}, cur=cur)
+                if not rows:
+                    break
+                if since is None:
+                    since = 0
+                    self._execute("INSERT INTO {rollup_since}(item_id, time) VALUES (:id, :time);",
+                                  {'id': id, 'time': since}, cur=cur)
+                    if self._rollup_since is not None:
+                        self._rollup_since[id] = since
+                tuples = [(row[0], row[1], self._item_value_tuple_rev(it, row[2:5])) for row in rows]
+                tuples = [t for t in tuples if t[2] is not None]
+                self._executemany(self._upsert_rollup[self._upsert], self._rollup_add(id, it, tuples, cur), cur)
+                ts = rows[-1][0]
+            self._db.commit()
+        except Exception as e:
+            self.logger.error("Database: Rebuilding rollups for item {} failed: {}".format(id, e))
+            self._rollback()
+        finally:
+            cur.close()
+            self._db.release()
+            self._dump_lock.release()
+
+    def retention(self, items=None):
+        """
+        Applies the retention policies of the items (or the given items)
+
+        Log records older than the item's database_retention are deleted or,
+        if database_downsample is set, replaced by one record per interval
+        containing the duration weighted average. The records are processed in
+        batches of retention_batch records, each in its own transaction, so the
+        database lock is only held shortly.
+        """
+        if not self._retention_lock.acquire(blocking=False):
+            self.logger.warning("Database: Skipping retention, since other retention job running")
+            return
+        try:
+            start = time.time()
+            stats = {'items': 0, 'removed': 0, 'written': 0, 'batches': 0, 'duration': 0.0, 'lock_max': 0.0,
+                     'space': None, 'time': self.shtime.now()}
+            free = self._free_space()
+            for item in list(self._retention) if items is None else items:
+                if item not in self._retention:
+                    continue
+                id = self.id(item, create=False)
+                if id is None:
+                    continue
+                retention, step = self._retention[item]
+                self._retention_item(id, retention, step, stats)
+                stats['items'] += 1
+            if free is not None:
+                stats['space'] = max(self._free_space() - free, 0)
+            stats['duration'] = time.time() - start
+            self._retention_stats = stats
+            self.logger.info("Database: Retention of {} items removed {} and wrote {} records in {:.3f}s ({} batches, longest lock {:.3f}s{})".format(
+                stats['items'], stats['removed'], stats['written'], stats['duration'], stats['batches'],
+                stats['lock_max'], "" if stats['space'] is None else ", {} bytes freed".format(stats['space'])))
+            return stats
+        finally:
+            self._retention_lock.release()
+
+    def _retention_item(self, id, retention, step, stats):
+        cutoff = self._timestamp(self.shtime.now()) - retention
+        # the current value (open record) and records ending after the cutoff are kept
+        keep = self._fetchone("SELECT MIN(time) FROM {log} WHERE item_id = :id AND time < :cutoff AND "
+                              "(duration IS NULL OR time + duration > :cutoff);", {'id': id, 'cutoff': cutoff})
+        if keep is not None and keep[0] is not None:
+            cutoff = min(cutoff, int(keep[0]))
+        if step is not None:
+            # only downsample complete intervals
+            cutoff -= cutoff % step
+        # downsampled records before the last processed interval are not read again
+        start = self._retention_done.get(id, 0) if step is not None else 0
+        while start < cutoff:
+            if not self._db.lock(5):
+                self.logger.warning("Database: Can not acquire lock for retention of item {}".format(id))
+                return
+            locked = time.time()
+            cur = self._db.cursor()
+            try:
+                end = self._retention_batch_apply(id, start, cutoff, step, stats, cur)
+                self._db.commit()
+            except Exception as e:
+                self.logger.error("Database: Retention for item {} failed: {}".format(id, e))
+                self._rollback()
+                return
+            finally:
+                cur.close()
                 self._db.release()
-        self.logger.debug('Dump completed')
-        self._dump_lock.release()
+                stats['lock_max'] = max(stats['lock_max'], time.time() - locked)
+            stats['batches'] += 1
+            if end is None:
+                break
+            start = end
+            if step is not None:
+                self._retention_done[id] = end
+        self._cache_invalidate(id)
+
+    def _retention_batch_apply(self, id, start, cutoff, step, stats, cur):
+        """
+        Deletes or downsamples one batch of log records of an item starting
+        at the given time
+
+        :return: start time of the next batch or None if done
+        """
+        params = {'id': id, 'start': start, 'cutoff': cutoff}
+        closed = "duration IS NOT NULL AND time + duration <= :cutoff"
+        query = "SELECT time, duration, val_num FROM {log} WHERE item_id = :id AND time >= :start AND time < :cutoff AND " + closed + " ORDER BY time ASC LIMIT " + str(self._retention_batch) + ";"
+        rows = self._fetchall(query, params, cur=cur)
+        if not rows:
+            return None
+        if len(rows) < self._retention_batch:
+            end = cutoff
+        elif step is None:
+            end = rows[-1][0] + 1
+        else:
+            # do not split an interval between batches (read an interval with more records completely)
+            end = rows[-1][0] - rows[-1][0] % step
+            if end <= rows[0][0]:
+                end = rows[0][0] - rows[0][0] % step + step
+                params['end'] = end
+                rows = self._fetchall("SELECT time, duration, val_num FROM {log} WHERE item_id = :id AND time >= :start AND time < :end AND " + closed + " ORDER BY time ASC;",
+                                      params, cur=cur)
+            else:
+                rows = [row for row in rows if row[0] < end]
+        params['end'] = end
+
+        logs = []
+        if step is not None:
+            buckets = collections.OrderedDict()
+            for row in rows:
+                buckets.setdefault(row[0] - row[0] % step, []).append(row)
+            if all(len(bucket) == 1 and bucket[0][0] == ts for ts, bucket in buckets.items()):
+                # already downsampled
+                return end
+            changed = self._timestamp(self.shtime.now())
+            for ts, bucket in buckets.items():
+                values = [(row[1] or 0, row[2]) for row in bucket if row[2] is not None]
+                if not values:
+                    continue
+                duration = sum(d for d, v in values)
+                val = sum(d * v for d, v in values) / duration if duration else sum(v for d, v in values) / len(values)
+                logs.append(self._log_params(id, ts, duration, val, 'num', changed))
+
+        self._execute("DELETE FROM {log} WHERE item_id = :id AND time >= :start AND time < :end AND " + closed + ";", params, cur=cur)
+        if self._paramstyle in PARAM_FORMATS:
+            self._executemany("INSERT INTO {log}(item_id, time, val_str, val_num, val_bool, duration, changed) VALUES (:id,:time,:val_str,:val_num,:val_bool,:duration,:changed);",
+                              logs, cur)
+        else:
+            for log in logs:
+                self.insertLog(id, log['time'], log['duration'], log['val_num'], 'num', log['changed'], cur=cur)
+        if self._rollup:
+            self._retention_rollup(id, end, cur)
+        stats['removed'] += len(rows)
+        stats['written'] += len(logs)
+        return end
+
+    def _retention_rollup(self, id, end, cur):
+        """
+        Removes the rollup buckets containing records changed by the retention
+        before end
+
+        The rollups are used from the next full day after end only, the log
+        table is used for the (deleted or downsampled) time before.
+        """
+        day = ROLLUP_TIERS[-1]
+        since = end + (-end % day)
+        self._execute("DELETE FROM {rollup} WHERE item_id = :id AND time < :time;", {'id': id, 'time': since}, cur=cur)
+        for tier in ROLLUP_TIERS:
+            bucket = self._rollup_buckets.get((id, tier))
+            if bucket is not None and bucket['time'] < since:
+                del self._rollup_buckets[(id, tier)]
+        rollup_since = self._rollup_load(cur)
+        if rollup_since is not None and id in rollup_since and rollup_since[id] < since:
+            self._execute("UPDATE {rollup_since} SET time = :time WHERE item_id = :id;", {'id': id, 'time': since}, cur=cur)
+            rollup_since[id] = since
+
+    def _free_space(self):
+        """
+        Returns the free space within the database file (SQLite only), which
+        is reused for new records
+        """
+        if self._driver != 'sqlite3':
+            return None
+        try:
+            page_size = self._fetchone("PRAGMA page_size;")
+            free_pages = self._fetchone("PRAGMA freelist_count;")
+            return int(page_size[0]) * int(free_pages[0])
+        except Exception as e:
+            self.logger.debug("Database: Can not determine free space: {}".format(e))
+            return None
+
+    def _rollback(self):
+        # item IDs and rollup buckets changed within the transaction are gone after rollback
+        self._item_ids = None
+        self._rollup_since = None
+        self._rollup_buckets = {}
+        try:
+            self._db.rollback()
+        except Exception as er:
+            self.logger.warning("Database: Error rolling back: {}".format(er))
+            return False
+        return True
+
+    def _log_params(self, id, time, duration, val, it, changed):
+        params = {'id': id, 'time': time, 'changed': changed, 'duration': duration}
+        params.update(self._item_value_tuple(it, val))
+        return params
+
+    def _executemany(self, query, params, cur):
+        """
+        Executes the given query for all parameter sets using the cursor's
+        executemany() - the named parameters of the query are converted to
+        the driver's paramstyle.
+        """
+        if len(params) == 0:
+            return
+        query = self._prepare(query)
+        names = re.findall(r':([a-z_]+)', query)
+        if self._paramstyle in ('named', 'pyformat'):
+            query = re.sub(r':([a-z_]+)', lambda m: PARAM_FORMATS[self._paramstyle].format(m.group(1)), query)
+        else:
+            counter = iter(range(1, len(names) + 1))
+            query = re.sub(r':([a-z_]+)', lambda m: PARAM_FORMATS[self._paramstyle].format(next(counter)), query)
+            params = [tuple(p[name] for name in names) for p in params]
+        try:
+            cur.executemany(query, params)
+        except Exception as e:
+            self.logger.error("Database: Error for bulk query {} ({} rows): {}".format(query, len(params), e))
+            raise e
+        self.logger.debug("Database: Bulk query {} ({} rows)".format(query, len(params)))
 
     def _buffer_remove(self, item):
         self._buffer_lock.acquire()
@@ -425,6 +1078,10 @@ class Database(SmartPlugin):
         self._buffer_lock.release()
         return tuples
 
+    def _buffer_restore(self, dumps):
+        for (item, tuples) in dumps:
+            self._buffer_insert(item, tuples)
+
     def _buffer_insert(self, item, tuples):
         self._buffer_lock.acquire()
         if item in self._buffer:
@@ -463,14 +1120,14 @@ class Database(SmartPlugin):
             sid = item + '|' + func + '|' + str(start) + '|' + str(end) + '|' + str(count)
         func, expression = self._expression(func)
         queries = {
-            'avg': 'MIN(time), ' + self._precision_query('AVG(val_num * duration) / AVG(duration)'),
+            'avg': 'MIN(time), SUM(val_num * duration) / SUM(duration)',
             'avg.order': 'ORDER BY time ASC',
             'integrate' : 'MIN(time), SUM(val_num * duration)',
             'count': 'MIN(time), SUM(CASE WHEN val_num{op}{value} THEN 1 ELSE 0 END)'.format(**expression['params']),
             'countall' : 'MIN(time), COUNT(*)',
             'min': 'MIN(time), MIN(val_num)',
             'max': 'MIN(time), MAX(val_num)',
-            'on': 'MIN(time), ' + self._precision_query('SUM(val_bool * duration) / SUM(duration)'),
+            'on': 'MIN(time), SUM(val_bool * duration) * 1.0 / SUM(duration)',
             'on.order': 'ORDER BY time ASC',
             'sum': 'MIN(time), SUM(val_num)',
             'raw': 'time, val_num',
@@ -481,8 +1138,9 @@ class Database(SmartPlugin):
             raise NotImplementedError
 
         order = '' if func + '.order' not in queries else queries[func + '.order']
-        group = 'GROUP BY ROUND(time / :step)' if func + '.group' not in queries else queries[func + '.group']
-        logs = self._fetch_log(item, queries[func], start, end, step=step, count=count, group=group, order=order)
+        group = 'GROUP BY time - time % :step' if func + '.group' not in queries else queries[func + '.group']
+        logs = self._fetch_log(item, queries[func], start, end, step=step, count=count, group=group, order=order,
+                               func=func, expression=expression)
         tuples = logs['tuples']
         if tuples:
             if logs['istart'] > tuples[0][0]:
@@ -514,13 +1172,13 @@ class Database(SmartPlugin):
     def _single(self, func, start, end='now', item=None):
         func, expression = self._expression(func)
         queries = {
-            'avg': self._precision_query('AVG(val_num * duration) / AVG(duration)'),
+            'avg': 'SUM(val_num * duration) / SUM(duration)',
             'integrate' : 'SUM(val_num * duration)',
             'count': 'SUM(CASE WHEN val_num{op}{value} THEN 1 ELSE 0 END)'.format(**expression['params']),
             'countall' : 'COUNT(*)',
             'min': 'MIN(val_num)',
             'max': 'MAX(val_num)',
-            'on': self._precision_query('SUM(val_bool * duration) / SUM(duration)'),
+            'on': 'SUM(val_bool * duration) * 1.0 / SUM(duration)',
             'sum': 'SUM(val_num)',
             'raw': 'val_num',
             'raw.order': 'ORDER BY time DESC',
@@ -530,17 +1188,32 @@ class Database(SmartPlugin):
             self.logger.warning("Unknown export function: {0}".format(func))
             return
         order = '' if func + '.order' not in queries else queries[func + '.order']
-        logs = self._fetch_log(item, queries[func], start, end, order=order)
+        logs = self._fetch_log(item, queries[func], start, end, order=order, func=func, expression=expression)
         if logs['tuples'] is None:
             return
         return logs['tuples'][0][0]
 
-    def _precision_query(self, query):
-        if self._precision >= 0:
-            return 'ROUND({}, {})'.format(query, self._precision)
-        return query
+    def _precision_round(self, func, value):
+        """
+        Rounds the values of avg and on to the configured precision
+
+        The values are rounded in Python for the queries of the log table as
+        well as for the partial aggregates, so both return the same results
+        (ROUND of the database rounds ties differently).
+        """
+        if func in ('avg', 'on') and value is not None and self._precision >= 0:
+            return round(value, self._precision)
+        return value
+
+    def _fetch_log(self, item, columns, start, end, step=None, count=100, group='', order='', func=None,
+                   expression=None):
+        """
+        Fetches the aggregated log data of an item
 
-    def _fetch_log(self, item, columns, start, end, step=None, count=100, group='', order=''):
+        If the result cache or the rollup tables are enabled, the functions
+        supporting it are aggregated from partial aggregates instead of using
+        the given columns (see _fetch_partials()).
+        """
         _item = self.items.return_item(item)
 
         istart = self._parse_ts(start)
@@ -557,10 +1230,281 @@ class Database(SmartPlugin):
             else:
                 step = iend - istart
 
-        if self._buffer[_item] != []:
-            self._dump(items=[_item])
+        if func in PARTIAL_FUNCS and (self._rollup or self._cache_size > 0) and id is not None and iend > istart:
+            logs = self._fetch_partials(_item, id, istart, iend, inow, step if group else None, end, func, expression)
+            if group:
+                logs = [(p[PARTIAL_TIME], self._partial_value(func, p)) for p in logs]
+            else:
+                logs = [(self._partial_value(func, self._partial_merge(logs)),)]
+        else:
+            if self._buffer[_item] != []:
+                self._dump(items=[_item])
+
+            params = {'id': id, 'time_start': istart, 'time_end': iend, 'inow': inow, 'step': step}
+            logs = self._fetchall(self._log_query(columns, group, order), params)
+            if logs is not None and func in ('avg', 'on'):
+                logs = [tuple(log[:-1]) + (self._precision_round(func, log[-1]),) for log in logs]
+
+        return {
+            'tuples': logs,
+            'item': _item,
+            'istart': istart,
+            'iend': iend,
+            'step': step,
+            'count': count
+        }
 
+    def _fetch_partials(self, _item, id, istart, iend, inow, step, end, func, expression):
+        """
+        Fetches the partial aggregates of the log data of an item grouped by step
+
+        The range is split into the bucket containing the start, the closed
+        buckets and the tail. Closed buckets are taken from the result cache,
+        from the rollup table or from the log table (in this order). Values in
+        the buffer which are not dumped yet are merged into the tail instead of
+        dumping them.
+
+        When step is None (single value) the partials are grouped by the
+        coarsest rollup tier fitting into the range (for caching).
+
+        :return: list of partials sorted by time
+        """
+        if step is None:
+            step = ROLLUP_TIERS[0]
+            for tier in ROLLUP_TIERS:
+                if iend - istart >= 10 * tier:
+                    step = tier
+        # rollups do not contain the conditional count
+        cond = "{op}{value}".format(**expression['params']) if func == 'count' else None
+        columns = PARTIAL_COLUMNS.format(cond=cond or '!=0')
         params = {'id': id, 'time_start': istart, 'time_end': iend, 'inow': inow, 'step': step}
+
+        self._buffer_lock.acquire()
+        buffered = list(self._buffer.get(_item, []))
+        self._buffer_lock.release()
+        if buffered and buffered[0][0] < istart:
+            # values before start change the records used for the start, so dump them
+            self._dump(items=[_item])
+            buffered = []
+        params['db_end'] = buffered[0][0] if buffered else iend + 1
+
+        # closed buckets: after the bucket containing the start, before the bucket of the last change
+        last = min(iend, params['db_end'], self._timestamp(_item.last_change()))
+        params['closed_start'] = (istart // step + 1) * step
+        params['closed_end'] = last - last % step
+
+        partials = {}
+        if params['closed_end'] > params['closed_start']:
+            queries = [self._log_query(columns, 'GROUP BY time - time % :step',
+                                       conditions="AND time < :closed_start "),
+                       self._log_query(columns, 'GROUP BY time - time % :step',
+                                       conditions="AND time >= :closed_end AND time < :db_end ")]
+            closed = self._cache_partials(id, step, cond, end, columns, params)
+        else:
+            queries = [self._log_query(columns, 'GROUP BY time - time % :step', conditions="AND time < :db_end ")]
+            closed = []
+        for query in queries:
+            rows = self._fetchall(query, params)
+            self._partials_add(partials, step, [] if rows is None else rows)
+        self._partials_add(partials, step, closed)
+        self._partials_add(partials, step, self._buffer_partials(_item, buffered, istart, iend, inow, expression))
+        return [partials[k] for k in sorted(partials)]
+
+    def _fetch_closed(self, id, start, end, cond, columns, params):
+        """
+        Fetches the partials of the closed buckets between start and end
+        from the rollup table (if available) or the log table
+
+        Rollup buckets are used if they do not overlap a step boundary. Since
+        the rollups split durations across buckets, while the log query
+        accounts the (clipped) duration of a record to the step it starts in,
+        the steps are corrected by the records crossing the bounds of the
+        rollup buckets used (see _rollup_correct()).
+        """
+        params = dict(params)
+        step = params['step']
+        tier = None if cond is not None else self._rollup_tier(id, start, step)
+        rows = []
+        if tier is not None:
+            params.update({'tier': tier, 'rollup_start': start + (-start % tier), 'rollup_end': end - end % tier})
+            if params['rollup_end'] > params['rollup_start']:
+                groups = self._fetchall(
+                    "SELECT time - time % :step, " + PARTIAL_ROLLUP_COLUMNS + " FROM {rollup} WHERE item_id = :id AND "
+                    "tier = :tier AND time >= :rollup_start AND time < :rollup_end AND time % :step + :tier <= :step "
+                    "GROUP BY time - time % :step;", params) or []
+                rows += self._rollup_correct(id, tier, step, params, groups)
+            else:
+                tier = None
+        if tier is None:
+            params.update({'tier': step, 'rollup_start': end, 'rollup_end': end})
+        params.update({'closed_start': start, 'closed_end': end})
+        query = self._log_query(columns, 'GROUP BY time - time % :step',
+                                conditions="AND time >= :closed_start AND time < :closed_end AND "
+                                           "(time < :rollup_start OR time >= :rollup_end OR "
+                                           "(time - time % :tier) % :step + :tier > :step) ")
+        rows += self._fetchall(query, params) or []
+        return rows
+
+    def _rollup_correct(self, id, tier, step, params, groups):
+        """
+        Converts the rollups grouped by step into partials equal to the ones
+        of the log query
+
+        Within a step the rollup buckets used cover the interval [a, b). The
+        record covering a (started before) is removed from the step, the
+        record crossing b (started within) is accounted completely, with its
+        duration clipped at :time_end like the log query does.
+
+        :param groups: rows of step and rollup partial
+        :return: list of partials
+        """
+        partials = {int(row[0]): list(row[1:]) for row in groups}
+        last = None
+
+        def record(point):
+            # the last record starting before point, points are increasing and a record reaching point is still the last
+            nonlocal last
+            if last is None or last[1] is None or last[0] + last[1] < point:
+                last = self._fetchone("SELECT time, duration, val_num, val_bool FROM {log} WHERE item_id = :id AND "
+                                      "time < :point ORDER BY time DESC LIMIT 1;", {'id': id, 'point': point})
+            return last
+
+        def correct(partial, rec, delta):
+            if delta:
+                partial[6] += delta
+                partial[7] = (partial[7] or 0) + (rec[3] or 0) * delta
+                if rec[2] is not None:
+                    partial[5] = (partial[5] or 0) + rec[2] * delta
+
+        time_end = params['time_end']
+        for group in sorted(partials):
+            partial = partials[group]
+            a = max(params['rollup_start'], group + (-group % tier))
+            b = min(params['rollup_end'], group + step - (group + step) % tier)
+            rec = record(a)
+            if rec is not None and rec[1] is not None and rec[0] + rec[1] > a:
+                correct(partial, rec, a - min(rec[0] + rec[1], b))
+            rec = record(b)
+            if rec is not None and rec[1] is not None and rec[0] >= a:
+                ts, duration = rec[0], rec[1]
+                clipped = duration * (ts + duration <= time_end) + (time_end - ts) * (ts + duration >= time_end)
+                correct(partial, rec, clipped - (min(ts + duration, b) - ts))
+        return [tuple(partial) for group, partial in sorted(partials.items()) if partial[PARTIAL_COUNT]]
+
+    def _cache_partials(self, id, step, cond, end, columns, params):
+        """
+        Returns the partials of the closed buckets, using the result cache
+
+        Closed buckets never change (except by dumping records for them, which
+        invalidates the cache), so they are cached without expiration. Only
+        buckets after the cached range are fetched. The cache is used for
+        absolute end times or 'now' only.
+        """
+        start, stop = params['closed_start'], params['closed_end']
+        try:
+            key = (id, step, cond, None if end == 'now' else int(end))
+        except (TypeError, ValueError):
+            key = None
+        if self._cache_size <= 0 or key is None:
+            return self._fetch_closed(id, start, stop, cond, columns, params)
+
+        with self._cache_lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                self._cache.move_to_end(key)
+            if entry is None or entry['start'] > start or entry['end'] < start:
+                self._cache_stats['misses'] += 1
+                entry = None
+            else:
+                self._cache_stats['hits'] += 1
+        if entry is None:
+            entry = {'start': start, 'end': start, 'partials': {}}
+        # buckets before the start are not required anymore (e.g. for relative start times)
+        partials = {k: p for k, p in entry['partials'].items() if k * step >= start}
+        if entry['end'] < stop:
+            self._partials_add(partials, step, self._fetch_closed(id, entry['end'], stop, cond, columns, params))
+        entry = {'start': start, 'end': max(entry['end'], stop), 'partials': partials}
+        with self._cache_lock:
+            self._cache[key] = entry
+            self._cache.move_to_end(key)
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        return [p for k, p in entry['partials'].items() if k * step < stop]
+
+    def _cache_invalidate(self, id, time=None):
+        """
+        Removes the cached results of an item (containing the given time)
+        """
+        id = int(id)
+        with self._cache_lock:
+            for key in [key for key, entry in self._cache.items() if
+                        key[0] == id and (time is None or entry['end'] > time)]:
+                del self._cache[key]
+
+    def _buffer_partials(self, item, buffered, istart, iend, inow, expression):
+        """
+        Returns the partials of the buffered values (using the same duration
+        calculation as the log query)
+        """
+        ops = {'=': lambda a, b: a == b, '!=': lambda a, b: a != b, '<>': lambda a, b: a != b,
+               '<': lambda a, b: a < b, '>': lambda a, b: a > b}
+        op, value = ops[expression['params']['op']], float(expression['params']['value'])
+        rows = []
+        for (ts, duration, val) in buffered:
+            if ts > iend or val is None:
+                continue
+            values = self._item_value_tuple(item.type(), val)
+            duration_now = inow - ts if duration is None else duration
+            d = 0
+            if duration is not None and ts >= istart and ts + duration <= iend:
+                d += duration
+            if duration_now and ts + duration_now >= iend:
+                d += iend - ts
+            val_num = values['val_num']
+            rows.append((ts, 1, val_num, val_num, val_num, None if val_num is None else val_num * d, d,
+                         values['val_bool'] * d, int(val_num is not None and op(val_num, value))))
+        return rows
+
+    def _partials_add(self, partials, step, rows):
+        for row in rows:
+            if row[PARTIAL_TIME] is None or not row[PARTIAL_COUNT]:
+                continue
+            k = row[PARTIAL_TIME] // step
+            partials[k] = self._partial_merge([partials[k], row] if k in partials else [row])
+
+    def _partial_merge(self, rows):
+        """
+        Merges partials (time, count, sum, min, max, duration weighted sum,
+        duration, on duration, conditional count) into one
+        """
+        def combine(i, op):
+            values = [row[i] for row in rows if row[i] is not None]
+            return op(values) if len(values) else None
+
+        return (combine(0, min), combine(1, sum), combine(2, sum), combine(3, min), combine(4, max),
+                combine(5, sum), combine(6, sum), combine(7, sum), combine(8, sum))
+
+    def _partial_value(self, func, partial):
+        if not partial[PARTIAL_COUNT]:
+            return None
+        duration = partial[6]
+        value = {
+            'avg': partial[5] / duration if duration and partial[5] is not None else None,
+            'integrate': partial[5],
+            'count': partial[8],
+            'countall': partial[1],
+            'min': partial[3],
+            'max': partial[4],
+            'on': partial[7] / duration if duration and partial[7] is not None else None,
+            'sum': partial[2]
+        }[func]
+        return self._precision_round(func, value)
+
+    def _log_query(self, columns, group='', order='', conditions=''):
+        """
+        Returns the query for aggregating the log table within :time_start and
+        :time_end, optionally restricted by further conditions
+        """
         duration_now = "COALESCE(duration, :inow - time)"
 
         # Duration calculation (S=Start, E=End):
@@ -590,23 +1534,13 @@ class Database(SmartPlugin):
                                       "time >= (SELECT COALESCE(MAX(time), 0) FROM {log} WHERE item_id = :id AND time < :time_start) AND "
                                       "time <= :time_end AND "
                                       "time + duration_now > (SELECT COALESCE(MAX(time), 0) FROM {log} WHERE item_id = :id AND time < :time_start) "
+                                      "" + conditions +
                                       "" + group + " " + order
         )
 
         # Replace duration_now with value from start time til current time to
         # get a duration value referring to the current timestamp - if required.
-        query = query.replace('duration_now', duration_now)
-
-        logs = self._fetchall(query, params)
-
-        return {
-            'tuples': logs,
-            'item': _item,
-            'istart': istart,
-            'iend': iend,
-            'step': step,
-            'count': count
-        }
+        return query.replace('duration_now', duration_now)
 
     def _fetchone(self, query, params={}, cur=None):
         tuples = self._query(self._db.fetchone, query, params, cur)
@@ -651,20 +1585,14 @@ class Database(SmartPlugin):
                 self._db.setup(
                     {i: [self._prepare(query[0]), self._prepare(query[1])] for i, query in self._setup.items()})
                 self._initialized = True
+                self._item_ids = None
         except Exception as e:
             self.logger.error("Database: Initialization failed: {}".format(e))
             return False
         return True
 
     def _parse_ts(self, frame):
-        minute = 60 * 1000
-        hour = 60 * minute
-        day = 24 * hour
-        week = 7 * day
-        month = 30 * day
-        year = 365 * day
-
-        _frames = {'i': minute, 'h': hour, 'd': day, 'w': week, 'm': month, 'y': year}
+        _frames = TIME_FRAMES
         try:
             return int(frame)
         except:
@@ -684,6 +1612,16 @@ class Database(SmartPlugin):
             self.logger.warning("Database: Unknown time frame '{0}'".format(frame))
         return ts
 
+    def _parse_duration(self, frame):
+        """
+        Returns the duration (in milliseconds) of the given time frame (e.g. '30d')
+        """
+        try:
+            return int(float(frame[:-1]) * TIME_FRAMES[frame[-1]])
+        except Exception:
+            self.logger.warning("Database: Unknown duration '{0}'".format(frame))
+            return None
+
     def _timestamp(self, dt):
         return int(time.mktime(dt.timetuple())) * 1000 + int(dt.microsecond / 1000)
 
@@ -730,6 +1668,8 @@ class Database(SmartPlugin):
 
 import cherrypy
 import csv
+import io
+import zlib
 from jinja2 import Environment, FileSystemLoader
 
 
@@ -813,53 +1753,65 @@ class WebInterface(SmartPluginWebIf):
                            language=self.plugin.get_sh().get_defaultlanguage())
 
     @cherrypy.expose
-    def item_csv(self, item_id):
+    @cherrypy.config(**{'response.stream': True})
+    def item_csv(self, item_id, compress=None):
         """
         Returns CSV Output for item log data
 
+        The CSV is streamed while reading the log data in chunks (optionally
+        gzip compressed).
+
         :return: item log data as CSV
         """
         if item_id is None:
             return None
-        else:
-            rows = self.plugin.readLogs(item_id)
-            log_array = []
-            for row in rows:
-                value_dict = {}
-                for key in [COL_LOG_TIME, COL_LOG_ITEM_ID, COL_LOG_DURATION, COL_LOG_VAL_STR, COL_LOG_VAL_NUM,
-                            COL_LOG_VAL_BOOL, COL_LOG_CHANGED]:
-                    value_dict[key] = row[key]
-                log_array.append(value_dict)
-            reversed_arr = log_array[::-1]
-            csv_file_path = '%s/var/db/%s_item_%s.csv' % (
-            self.plugin._sh.base_dir, self.plugin.get_instance_name(), item_id)
-
-            with open(csv_file_path, 'w', encoding='utf-8') as f:
-                writer = csv.writer(f, dialect="excel")
-                writer.writerow(['time', 'item_id', 'duration', 'val_str', 'val_num', 'val_bool', 'changed'])
-                for dataset in reversed_arr:
-                    writer.writerow(
-                        [dataset[0], dataset[1], dataset[2], dataset[3], dataset[4], dataset[5], dataset[6]])
-
-            cherrypy.request.fileName = csv_file_path
-            cherrypy.request.hooks.attach('on_end_request', self.download_complete)
-            return cherrypy.lib.static.serve_download(csv_file_path)
-
-    def download_complete(self):
-        os.unlink(cherrypy.request.fileName)
+
+        def lines():
+            out = io.StringIO()
+            writer = csv.writer(out, dialect="excel")
+            writer.writerow(['time', 'item_id', 'duration', 'val_str', 'val_num', 'val_bool', 'changed'])
+            for rows in self.plugin.readLogsChunked(item_id, order='DESC'):
+                writer.writerows(rows)
+                yield out.getvalue()
+                out.seek(0)
+                out.truncate()
+            yield out.getvalue()
+
+        return self._download(lines(), '%s_item_%s.csv' % (self.plugin.get_instance_name(), item_id), 'text/csv',
+                              compress)
 
     @cherrypy.expose
-    def db_dump(self):
+    @cherrypy.config(**{'response.stream': True})
+    def db_dump(self, compress=None):
         """
-        returns the smarthomeNG sqlite database as download
+        returns the smarthomeNG database log as dump download
+
+        The dump is streamed while reading the log data in chunks (optionally
+        gzip compressed).
         """
+        return self._download(self.plugin.export(), 'smarthomedb_%s.dump' % self.plugin.get_instance_name(),
+                              'application/octet-stream', compress)
 
-        self.plugin.dump(
-            '%s/var/db/smarthomedb_%s.dump' % (self.plugin.get_sh().base_dir, self.plugin.get_instance_name()))
-        mime = 'application/octet-stream'
-        return cherrypy.lib.static.serve_file(
-            "%s/var/db/smarthomedb_%s.dump" % (self.plugin.get_sh().base_dir, self.plugin.get_instance_name()),
-            mime, "%s/var/db/" % self.plugin.get_sh().base_dir)
+    def _download(self, lines, filename, mime, compress=None):
+        """
+        Streams the given lines as download (gzip compressed if requested)
+        """
+        compress = compress is not None and Utils.to_bool(compress)
+        cherrypy.response.headers['Content-Type'] = 'application/gzip' if compress else mime
+        cherrypy.response.headers['Content-Disposition'] = 'attachment; filename="%s%s"' % (
+            filename, '.gz' if compress else '')
+
+        def encode():
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if compress else None
+            for line in lines:
+                data = line.encode('utf-8')
+                data = compressor.compress(data) if compressor else data
+                if data:
+                    yield data
+            if compressor:
+                yield compressor.flush()
+
+        return encode()
 
     @cherrypy.expose
     def cleanup(self):
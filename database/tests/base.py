@@ -11,10 +11,10 @@ class TestDatabaseBase(unittest.TestCase):
 
     TIME_FACTOR = 1000
 
-    def plugin(self):
+    def plugin(self, **kwargs):
         self.sh = MockSmartHome()
         self.sh.with_items_from(common.BASE + '/plugins/database/tests/test_items.yaml')
-        plugin = Database(self.sh, 'sqlite3', {'database' : ':memory:'})
+        plugin = Database(self.sh, 'sqlite3', {'database' : ':memory:'}, **kwargs)
         for item in self.sh.return_items():
             plugin.parse_item(item)
         return plugin
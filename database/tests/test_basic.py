@@ -1,4 +1,5 @@
 import os
+import gzip
 import datetime
 import tempfile
 
@@ -49,6 +50,16 @@ class TestDatabaseBasic(TestDatabaseBase):
         plugin.deleteItem(plugin.id(item, True))
         self.assertIsNone(plugin.id(item, False))
 
+    def test_id_cache_in_sync(self):
+        plugin = self.plugin()
+        item = self.sh.return_item('main.num')
+        id = plugin.insertItem(item.id())
+        self.assertEqual(id, plugin._item_ids[item.id()])
+        self.assertEqual(id, plugin.id(item, False))
+        plugin.deleteItem(id)
+        self.assertNotIn(item.id(), plugin._item_ids)
+        self.assertIsNone(plugin.id(item, False))
+
     def test_readItems(self):
         plugin = self.plugin()
         self.create_item(plugin, 'main.num')
@@ -248,6 +259,34 @@ class TestDatabaseBasic(TestDatabaseBase):
           self.read_tmpfile(name)
         )
 
+    def test_dump_log_compressed(self):
+        name = self.create_tmpfile()
+        plugin = self.plugin()
+        id = self.create_item(plugin, 'main.num')
+        plugin.insertLog(id, time=   0, duration=3600, val=10, it='num', changed=0)
+        plugin.insertLog(id, time=3600, duration=3600, val=20, it='num', changed=3600)
+        plugin.dump(name, compress=True)
+        with gzip.open(name, 'rt') as f:
+            self.assertLines(
+              "item_id;item_name;time;duration;val_str;val_num;val_bool;changed;time_date;changed_date\n"
+              "1;main.num;0;3600;;10.0;1;0;1970-01-01 00:00:00;1970-01-01 00:00:00\n"
+              "1;main.num;3600;3600;;20.0;1;3600;1970-01-01 00:00:03.600000;1970-01-01 00:00:03.600000\n",
+              f.read()
+            )
+        self.assertEqual(2, plugin._export_stats['rows'])
+        self.assertFalse(plugin._export_stats['running'])
+
+    def test_readLogsChunked(self):
+        plugin = self.plugin()
+        id = self.create_item(plugin, 'main.num')
+        for i in range(5):
+            plugin.insertLog(id, time=i * 3600, duration=3600, val=i, it='num')
+        chunks = list(plugin.readLogsChunked(id, chunk=2))
+        self.assertEqual([2, 2, 1], [len(rows) for rows in chunks])
+        self.assertEqual(plugin.readLogs(id), [row for rows in chunks for row in rows])
+        chunks = list(plugin.readLogsChunked(id, order='DESC', chunk=2))
+        self.assertEqual([14400, 10800, 7200, 3600, 0], [row[0] for rows in chunks for row in rows])
+
     def test_cleanup_empty(self):
         plugin = self.plugin()
         plugin.cleanup()
@@ -0,0 +1,57 @@
+
+from plugins.database import Database
+from plugins.database.tests.base import TestDatabaseBase
+
+class TestDatabaseCache(TestDatabaseBase):
+
+    def test_series_cached_equals_uncached(self):
+        plugin = self.plugin(cache_size=10)
+        self.create_log(plugin, 'main.num', self.log_slice(0, 60, [10, 20, 30, 40, 50, 60]))
+        self.dump_log(plugin, 'main.num')
+        first = plugin._series('avg', start=self.t(0), end=self.t(360), item='main.num', count=6)
+        second = plugin._series('avg', start=self.t(0), end=self.t(360), item='main.num', count=6)
+        self.assertEqual(first['series'], second['series'])
+        self.assertEqual(1, plugin._cache_stats['hits'])
+        plugin._cache_size = 0
+        self.assertEqual(first['series'], plugin._series('avg', start=self.t(0), end=self.t(360), item='main.num', count=6)['series'])
+
+    def test_dump_invalidates_cache(self):
+        plugin = self.plugin(cache_size=10)
+        self.create_log(plugin, 'main.num', self.log_slice(0, 60, [10, 20, 30, 40]))
+        self.dump_log(plugin, 'main.num')
+        self.assertSingle(100, plugin._single('sum', start=self.t(0), end=self.t(3600), item='main.num'))
+        self.assertEqual(1, len(plugin._cache))
+        id = plugin.id(self.sh.return_item('main.num'), False)
+        plugin.insertLog(id, time=self.t(300), duration=self.t(60), val=1, it='num')
+        self.assertEqual(0, len(plugin._cache))
+        self.assertSingle(101, plugin._single('sum', start=self.t(0), end=self.t(3600), item='main.num'))
+
+    def test_cache_size_is_limited(self):
+        plugin = self.plugin(cache_size=2)
+        self.create_log(plugin, 'main.num', self.log_slice(0, 60, [10, 20, 30, 40]))
+        self.dump_log(plugin, 'main.num')
+        for func in ['avg', 'min', 'max', 'sum']:
+            plugin._series(func, start=self.t(0), end=self.t(240), item='main.num', count=4)
+        self.assertLessEqual(len(plugin._cache), 2)
+
+    def test_series_not_step_aligned(self):
+        plugin = self.plugin(cache_size=10)
+        self.create_log(plugin, 'main.num', [(10, 40, 1), (40, 70, 2), (70, 100, 3), (100, 130, 4), (130, 250, 5)])
+        expected = {}
+        for func in ['avg', 'count', 'integrate', 'max', 'min', 'on', 'sum']:
+            expected[func] = plugin._series(func, start=self.t(0), end=self.t(240), step=self.t(60), item='main.num')['series']
+        self.assertEqual([(self.t(10), 1.5), (self.t(70), 3.5), (self.t(130), 5.0), (self.t(240), 5.0)], expected['avg'])
+        self.assertEqual([(self.t(10), 3.0), (self.t(70), 7.0), (self.t(130), 5.0), (self.t(240), 5.0)], expected['sum'])
+        plugin._cache_size = 0
+        for func in ['avg', 'count', 'integrate', 'max', 'min', 'on', 'sum']:
+            self.assertEqual(expected[func], plugin._series(func, start=self.t(0), end=self.t(240), step=self.t(60), item='main.num')['series'])
+
+    def test_on_cached_equals_uncached(self):
+        plugin = self.plugin(cache_size=10)
+        self.create_log(plugin, 'main.num', [(0, 20, 1), (20, 60, 0), (60, 70, 1), (70, 120, 0), (120, 180, 0)])
+        series = plugin._series('on', start=self.t(0), end=self.t(180), step=self.t(60), item='main.num')['series']
+        single = plugin._single('on', start=self.t(0), end=self.t(180), item='main.num')
+        self.assertEqual([(self.t(0), 0.33), (self.t(60), 0.17), (self.t(120), 0.0), (self.t(180), 0.0)], series)
+        plugin._cache_size = 0
+        self.assertEqual(series, plugin._series('on', start=self.t(0), end=self.t(180), step=self.t(60), item='main.num')['series'])
+        self.assertSingle(single, plugin._single('on', start=self.t(0), end=self.t(180), item='main.num'))
@@ -0,0 +1,64 @@
+from plugins.database import Database, ROLLUP_TIERS
+from plugins.database.tests.base import TestDatabaseBase
+
+class TestDatabaseRetention(TestDatabaseBase):
+
+    def test_retention_deletes_old_logs(self):
+        plugin = self.plugin(retention_batch=3)
+        self.create_log(plugin, 'main.retention_delete', self.log_slice(0, 600, [10, 20, 30, 40, 50, 60, 70]))
+        id = plugin.id(self.sh.return_item('main.retention_delete'), False)
+        stats = plugin.retention()
+        self.assertEqual(0, len(plugin.readLogs(id)))
+        self.assertEqual(7, stats['removed'])
+        self.assertEqual(0, stats['written'])
+        self.assertEqual(3, stats['batches'])
+
+    def test_retention_downsamples_old_logs(self):
+        plugin = self.plugin(retention_batch=4)
+        self.create_log(plugin, 'main.retention', self.log_slice(0, 1800, [10, 20, 30, 40, 50]))
+        id = plugin.id(self.sh.return_item('main.retention'), False)
+        stats = plugin.retention()
+        logs = plugin.readLogs(id)
+        self.assertEqual([(self.t(0), self.t(3600), 15.0), (self.t(3600), self.t(3600), 35.0), (self.t(7200), self.t(1800), 50.0)],
+                         [(log[0], log[2], log[4]) for log in logs])
+        self.assertEqual(5, stats['removed'])
+        self.assertEqual(3, stats['written'])
+
+    def test_retention_keeps_downsampled_logs(self):
+        plugin = self.plugin()
+        self.create_log(plugin, 'main.retention', self.log_slice(0, 1800, [10, 20, 30, 40]))
+        id = plugin.id(self.sh.return_item('main.retention'), False)
+        plugin.retention()
+        logs = plugin.readLogs(id)
+        plugin._retention_done = {}
+        stats = plugin.retention()
+        self.assertEqual(logs, plugin.readLogs(id))
+        self.assertEqual(0, stats['removed'])
+
+    def test_retention_keeps_current_value(self):
+        plugin = self.plugin()
+        self.create_log(plugin, 'main.retention_delete', [(0, 600, 10), (600, 1200, 20), (1200, None, 30)])
+        id = plugin.id(self.sh.return_item('main.retention_delete'), False)
+        stats = plugin.retention()
+        self.assertEqual([(self.t(1200), None, 30.0)], [(log[0], log[2], log[4]) for log in plugin.readLogs(id)])
+        self.assertEqual(2, stats['removed'])
+
+    def test_retention_keeps_logs_ending_after_cutoff(self):
+        plugin = self.plugin()
+        now = plugin._timestamp(plugin.shtime.now()) // 1000
+        self.create_log(plugin, 'main.retention', [(0, 1800, 10), (1800, 3600, 20), (3600, 5400, 30), (5400, now, 40)])
+        id = plugin.id(self.sh.return_item('main.retention'), False)
+        stats = plugin.retention()
+        self.assertEqual([(self.t(0), self.t(3600), 15.0), (self.t(3600), self.t(1800), 30.0), (self.t(5400), self.t(now - 5400), 40.0)],
+                         sorted((log[0], log[2], log[4]) for log in plugin.readLogs(id)))
+        self.assertEqual(2, stats['removed'])
+
+    def test_retention_prunes_rollups(self):
+        plugin = self.plugin(rollup=True)
+        self.create_log(plugin, 'main.retention_delete', self.log_slice(0, 600, [10, 20, 30, 40]))
+        id = plugin.id(self.sh.return_item('main.retention_delete'), False)
+        plugin.rollup_rebuild(id)
+        plugin.retention()
+        self.assertEqual([], plugin._fetchall("SELECT * FROM {rollup} WHERE item_id = :id;", {'id': id}))
+        self.assertGreater(plugin._rollup_since[id], self.t(2400))
+        self.assertEqual(0, plugin._rollup_since[id] % ROLLUP_TIERS[-1])
@@ -0,0 +1,69 @@
+from plugins.database import Database, ROLLUP_TIERS
+from plugins.database.tests.base import TestDatabaseBase
+
+class TestDatabaseRollup(TestDatabaseBase):
+
+    def rollup_counts(self, plugin, id):
+        return plugin._fetchall("SELECT tier, SUM(cnt) FROM {rollup} WHERE item_id = :id GROUP BY tier ORDER BY tier;", {'id': id})
+
+    def test_rollup_rebuild_creates_buckets(self):
+        plugin = self.plugin(rollup=True)
+        self.create_log(plugin, 'main.num', self.log_slice(0, 600, [10, 20, 30, 40]))
+        id = plugin.id(self.sh.return_item('main.num'), False)
+        plugin.rollup_rebuild(id)
+        self.assertEqual([(tier, 4) for tier in ROLLUP_TIERS], self.rollup_counts(plugin, id))
+        self.assertEqual(0, plugin._rollup_since[id])
+
+    def test_rollup_rebuild_disabled(self):
+        plugin = self.plugin()
+        self.create_log(plugin, 'main.num', self.log_slice(0, 600, [10, 20, 30, 40]))
+        id = plugin.id(self.sh.return_item('main.num'), False)
+        plugin.rollup_rebuild(id)
+        self.assertEqual([], self.rollup_counts(plugin, id))
+
+    def test_single_uses_rollup(self):
+        plugin = self.plugin(rollup=True)
+        self.create_log(plugin, 'main.num', self.log_slice(0, 600, [10, 20, 30, 40]))
+        plugin.rollup_rebuild()
+        expected = {}
+        for func in ['avg', 'min', 'max', 'sum']:
+            expected[func] = plugin._single(func, start=self.t(0), end=self.t(3600), item='main.num')
+        plugin._rollup = False
+        for func in ['avg', 'min', 'max', 'sum']:
+            self.assertSingle(expected[func], plugin._single(func, start=self.t(0), end=self.t(3600), item='main.num'))
+
+    def test_deleteLog_invalidates_rollup(self):
+        plugin = self.plugin(rollup=True)
+        self.create_log(plugin, 'main.num', self.log_slice(0, 600, [10, 20, 30, 40]))
+        id = plugin.id(self.sh.return_item('main.num'), False)
+        plugin.rollup_rebuild(id)
+        plugin.deleteLog(id, time=0)
+        self.assertNotIn(id, plugin._rollup_since)
+        self.assertIsNone(plugin._rollup_tier(id, 0, self.t(3600)))
+
+    def test_rollup_splits_durations(self):
+        plugin = self.plugin(rollup=True)
+        self.create_log(plugin, 'main.num', [(30, 150, 10), (150, 4000, 20)])
+        id = plugin.id(self.sh.return_item('main.num'), False)
+        plugin.rollup_rebuild(id)
+        buckets = plugin._fetchall("SELECT time, cnt, duration, val_dsum FROM {rollup} WHERE item_id = :id AND tier = :tier ORDER BY time;",
+                                   {'id': id, 'tier': ROLLUP_TIERS[0]})
+        self.assertEqual((0, 1, self.t(30), 10 * self.t(30)), buckets[0])
+        self.assertEqual((self.t(60), 0, self.t(60), 10 * self.t(60)), buckets[1])
+        self.assertEqual((self.t(120), 1, self.t(60), 10 * self.t(30) + 20 * self.t(30)), buckets[2])
+        self.assertEqual(self.t(3970), sum(bucket[2] for bucket in buckets))
+
+    def test_series_spanning_buckets_equals_log(self):
+        plugin = self.plugin(rollup=True)
+        self.create_log(plugin, 'main.num', [(30, 150, 10), (150, 4000, 20), (4000, 4030, 30), (4030, 7600, 40)])
+        plugin.rollup_rebuild()
+        expected = {}
+        for func in ['avg', 'integrate', 'sum']:
+            for step in [60, 3600, 3660]:
+                expected[(func, step)] = plugin._series(func, start=self.t(0), end=self.t(7550), step=self.t(step), item='main.num')['series']
+            expected[func] = plugin._single(func, start=self.t(0), end=self.t(7550), item='main.num')
+        plugin._rollup = False
+        for func in ['avg', 'integrate', 'sum']:
+            for step in [60, 3600, 3660]:
+                self.assertEqual(expected[(func, step)], plugin._series(func, start=self.t(0), end=self.t(7550), step=self.t(step), item='main.num')['series'])
+            self.assertSingle(expected[func], plugin._single(func, start=self.t(0), end=self.t(7550), item='main.num'))
@@ -19,12 +19,32 @@
 #  along with SmartHomeNG. If not, see <http://www.gnu.org/licenses/>.
 #########################################################################
 
+import bisect
+import datetime
+import glob
+import gzip
+import json
 import logging
+import os
+import queue
+import re
+import string
 import time
 import threading
 
 from lib.model.smartplugin import SmartPlugin
 
+try:
+    import zstandard
+    ZSTD_IMPORTED = True
+except ImportError:
+    ZSTD_IMPORTED = False
+
+INDEX_SUFFIX = '.idx'
+COMPRESSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+# formats of the time field (str() of the datetime, with or without microseconds and time zone)
+TIME_FORMATS = ('%Y-%m-%d %H:%M:%S.%f%z', '%Y-%m-%d %H:%M:%S%z', '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S')
+
 
 class DataLog(SmartPlugin):
 
@@ -35,8 +55,12 @@ class DataLog(SmartPlugin):
     logpatterns = {}
     cycle = 0
     _items = {}
+    _item_ids = []
+    _item_index = {}
     _buffer = {}
     _buffer_lock = None
+    _files = {}
+    _handles = {}
 
     def __init__(self, smarthome, *args, **kwargs):
         self._sh = smarthome
@@ -46,6 +70,12 @@ class DataLog(SmartPlugin):
         filepatterns = self.get_parameter_value('filepatterns')
         logpatterns = self.get_parameter_value('logpatterns')
         cycle = self.get_parameter_value('cycle')
+        self.compression = self.get_parameter_value('compression')
+        self.max_size = self.get_parameter_value('max_size')
+        self.index = self.get_parameter_value('index')
+        if self.compression == 'zstd' and not ZSTD_IMPORTED:
+            self.logger.warning('DataLog: Python package zstandard not installed, using gzip compression')
+            self.compression = 'gzip'
 
         newfilepatterns = {}
         if isinstance(filepatterns, str):
@@ -81,8 +111,23 @@ class DataLog(SmartPlugin):
 
         self.cycle = int(cycle)
         self._items = {}
+        # buffered entries are (timestamp, item index, value) tuples
+        self._item_ids = []
+        self._item_index = {}
         self._buffer = {}
         self._buffer_lock = threading.Lock()
+        # current file of every log: (start and end timestamp of the day, filename)
+        self._files = {}
+        # open files by filename
+        self._handles = {}
+        self._uses_time = {log: 'time' in self._fields(self.logpatterns[log]) for log in self.logpatterns}
+        # byte ranges of the entries of the open files
+        self._indexes = {}
+        self._index_lock = threading.Lock()
+        self._regexes = {}
+        self._compress_queue = queue.Queue()
+        self._compressor = None
+        self._stats = {'entries': 0, 'bytes': 0, 'dumps': 0, 'last_entries': 0, 'last_duration': 0, 'throughput': 0, 'buffer_max': 0}
 
         self.logger.info('DataLog: Initialized, logging to "{}"'.format(self.path))
         for log in self.filepatterns:
@@ -91,10 +136,26 @@ class DataLog(SmartPlugin):
     def run(self):
         self.alive = True
         self._sh.scheduler.add('DataLog', self._dump, cycle=self.cycle)
+        if self.compression != 'none':
+            # compress the files finished before the last stop
+            # (found by the file patterns, the files need not have an index)
+            current = {os.path.normpath(self.path + '/' + self._filename(log, time.time())) for log in self.filepatterns}
+            for root, dirs, files in os.walk(self.path):
+                for name in files:
+                    path = os.path.normpath(os.path.join(root, name))
+                    if path not in current and self._log(path) is not None:
+                        self._compress_queue.put(path)
+            self._start_compression()
 
     def stop(self):
         self.alive = False
         self._dump()
+        for filename in list(self._handles):
+            self._close(filename)
+        if self._compressor is not None:
+            self._compress_queue.put(None)
+            self._compressor.join(10)
+            self._compressor = None
 
     def parse_item(self, item):
         if self.has_iattr(item.conf, 'datalog'):
@@ -115,6 +176,8 @@ class DataLog(SmartPlugin):
 
                 if item.id() not in self._items:
                     self._items[item.id()] = []
+                    self._item_index[item.id()] = len(self._item_ids)
+                    self._item_ids.append(item.id())
 
                 if log not in self._items[item.id()]:
                    self._items[item.id()].append(log)
@@ -133,13 +196,91 @@ class DataLog(SmartPlugin):
             pass
 
         if item.id() in self._items:
+            entry = (time.time(), self._item_index[item.id()], item())
             for log in self._items[item.id()]:
-                self._buffer[log].append({ 'time' : self._sh.now(), 'item' : item.id(), 'value' : item() })
+                self._buffer[log].append(entry)
+
+    def stats(self):
+        """
+        Returns the statistics of the writer: number of entries and bytes
+        written, duration and throughput (entries per second) of the last dump
+        and the current and maximum number of buffered entries
+        """
+        stats = dict(self._stats)
+        stats['buffer'] = sum(len(entries) for entries in self._buffer.values())
+        return stats
+
+    def _fields(self, pattern):
+        return {field for text, field, spec, conversion in string.Formatter().parse(pattern) if field}
+
+    def _filename(self, log, stamp):
+        """
+        Returns the filename of the given log for the timestamp. The filename
+        is only built again if the day changed.
+        """
+        current = self._files.get(log)
+        if current is not None and current[0] <= stamp < current[1]:
+            return current[2]
+        day = datetime.datetime.fromtimestamp(stamp, self._sh.now().tzinfo)
+        start = day.replace(hour=0, minute=0, second=0, microsecond=0)
+        end = datetime.datetime.combine(day.date() + datetime.timedelta(days=1), datetime.time(), start.tzinfo)
+        filename = self.filepatterns[log].format(**{ 'log' : log, 'year' : day.year, 'month' : day.month, 'day' : day.day })
+        self._files[log] = (start.timestamp(), end.timestamp(), filename)
+        return filename
+
+    def _handle(self, log, filename):
+        if filename not in self._handles:
+            path = self.path + '/' + filename
+            if self.index:
+                self._indexes[filename] = self._open_index(log, path)
+            self._handles[filename] = open(path, 'ab')
+        return self._handles[filename]
+
+    def _close(self, filename, finished=False):
+        """
+        Closes a file and writes its index. Finished files (of a previous day or
+        exceeding max_size) are compressed in the background.
+        """
+        path = self.path + '/' + filename
+        try:
+            self._handles.pop(filename).close()
+        except Exception as e:
+            self.logger.error('Error while closing {}: {}'.format(filename, e))
+        with self._index_lock:
+            index = self._indexes.pop(filename, None)
+        if index is not None:
+            index['size'] = os.path.getsize(path)
+            self._write_index(path, index)
+        if finished and self.compression != 'none':
+            self._compress_queue.put(path)
+            self._start_compression()
+
+    def _rotate(self, filename):
+        """
+        Closes a file exceeding max_size and renames it (and its index) to the
+        next free part number, e.g. default-2019-1-1.csv.1
+        """
+        self._close(filename)
+        path = self.path + '/' + filename
+        number = 1 + max([part for base, part in self._parts(path)] + [0])
+        try:
+            os.rename(path, '{}.{}'.format(path, number))
+            if os.path.isfile(path + INDEX_SUFFIX):
+                os.rename(path + INDEX_SUFFIX, '{}.{}{}'.format(path, number, INDEX_SUFFIX))
+        except Exception as e:
+            self.logger.error('Error while rotating {}: {}'.format(filename, e))
+            return
+        self.logger.info('Rotated {} to part {}'.format(filename, number))
+        if self.compression != 'none':
+            self._compress_queue.put('{}.{}'.format(path, number))
+            self._start_compression()
 
     def _dump(self):
-        data = {}
-        now = self._sh.now()
-        handles = {}
+        start = time.time()
+        tz = self._sh.now().tzinfo
+        written = 0
+        size = 0
+        depth = 0
 
         for log in self._buffer:
             self._buffer_lock.acquire()
@@ -147,25 +288,356 @@ class DataLog(SmartPlugin):
             entries = self._buffer[log]
             self._buffer[log] = []
             self._buffer_lock.release()
+            depth += len(entries)
 
             if len(entries):
                 logpattern = self.logpatterns[log]
+                uses_time = self._uses_time[log]
+                filename = None
+                lines = []
 
                 try:
-                    for entry in entries:
-                        filename = self.filepatterns[log].format(**{ 'log' : log, 'year' : entry['time'].year, 'month' : entry['time'].month, 'day' : entry['time'].day })
-
-                        if filename not in handles:
-                            handles[filename] = open(self.path + '/' + filename, 'a')
-
-                        data = entry
-                        data['stamp'] = data['time'].timestamp();
-                        handles[filename].write(logpattern.format(**data))
+                    for stamp, index, value in entries:
+                        entry_filename = self._filename(log, stamp)
+                        if entry_filename != filename:
+                            if lines:
+                                size += self._write(log, filename, lines)
+                                lines = []
+                            filename = entry_filename
+
+                        data = { 'stamp' : stamp, 'item' : self._item_ids[index], 'value' : value }
+                        if uses_time:
+                            data['time'] = datetime.datetime.fromtimestamp(stamp, tz)
+                        lines.append((logpattern.format(**data).encode('utf-8'), stamp, index))
+                        written += 1
+
+                    if lines:
+                        size += self._write(log, filename, lines)
 
                 except Exception as e:
                     self.logger.error('Error while writing to {}: {}'.format(filename, e))
+                    if filename in self._handles:
+                        self._close(filename)
+                    continue
+
+                if self.max_size and filename in self._handles and self._handles[filename].tell() >= self.max_size:
+                    self._rotate(filename)
+
+        # close the files of the previous days
+        current = {self._files[log][2] for log in self._files}
+        for filename in list(self._handles):
+            if filename not in current:
+                self._close(filename, finished=True)
+
+        duration = time.time() - start
+        self._stats['entries'] += written
+        self._stats['bytes'] += size
+        self._stats['dumps'] += 1
+        self._stats['last_entries'] = written
+        self._stats['last_duration'] = duration
+        self._stats['throughput'] = written / duration if duration > 0 else 0
+        self._stats['buffer_max'] = max(self._stats['buffer_max'], depth)
+        self.logger.debug('Dump done! {} entries ({} bytes) in {:.3f}s'.format(written, size, duration))
+
+    def _write(self, log, filename, lines):
+        handle = self._handle(log, filename)
+        offset = handle.tell()
+        data = b''.join(line for line, stamp, index in lines)
+        handle.write(data)
+        handle.flush()
+        if self.index:
+            # byte range of the lines of every item in every hour
+            index = self._indexes[filename]
+            with self._index_lock:
+                for line, stamp, item_index in lines:
+                    end = offset + len(line)
+                    self._index_add(index, self._item_ids[item_index], stamp, offset, end)
+                    offset = end
+                index['size'] = offset
+        return len(data)
+
+    def _start_compression(self):
+        if self._compressor is None or not self._compressor.is_alive():
+            self._compressor = threading.Thread(target=self._compress_files, name='DataLog compression')
+            self._compressor.daemon = True
+            self._compressor.start()
+
+    def _compress_files(self):
+        while True:
+            path = self._compress_queue.get()
+            if path is None:
+                return
+            self._compress(path)
+
+    def _compress(self, path):
+        """
+        Compresses a finished log file. Every hour is compressed separately
+        (as member of the gzip file or frame of the zstd file), so reading
+        an hour only decompresses this part of the file.
+        """
+        if not os.path.isfile(path):
+            return
+        start = time.time()
+        size = os.path.getsize(path)
+        index = self._read_index(path)
+        if index is None or index.get('compression', 'none') != 'none' or index.get('size') != size:
+            log = self._log(path)
+            try:
+                index = self._build_index(log, path) if log is not None else None
+            except Exception as e:
+                self.logger.warning('Error while indexing {}: {}'.format(path, e))
+                index = None
+            if index is None or index['size'] != size:
+                # not indexed, the file is compressed as one block
+                index = self._new_index(path)
+                index['size'] = size
+        suffix = COMPRESSIONS[self.compression]
+        offsets = sorted({0} | {r[0] for r in index['hours'].values()})
+        blocks = []
+        try:
+            with open(path, 'rb') as f, open(path + suffix + '.tmp', 'wb') as out:
+                for i, ustart in enumerate(offsets):
+                    uend = offsets[i + 1] if i + 1 < len(offsets) else size
+                    if uend <= ustart:
+                        continue
+                    data = f.read(uend - ustart)
+                    if self.compression == 'zstd':
+                        data = zstandard.ZstdCompressor().compress(data)
+                    else:
+                        data = gzip.compress(data)
+                    blocks.append([ustart, uend, out.tell(), len(data)])
+                    out.write(data)
+            os.replace(path + suffix + '.tmp', path + suffix)
+            index['data'] = os.path.basename(path) + suffix
+            index['compression'] = self.compression
+            index['blocks'] = blocks
+            self._write_index(path, index)
+            os.remove(path)
+        except Exception as e:
+            self.logger.error('Error while compressing {}: {}'.format(path, e))
+            return
+        self.logger.info('Compressed {} ({} bytes) in {:.1f}s'.format(path, size, time.time() - start))
+
+    def _new_index(self, path):
+        return {'data': os.path.basename(path), 'compression': 'none', 'size': 0, 'hours': {}, 'items': {}}
+
+    def _index_add(self, index, item, stamp, start, end):
+        hour = str(int(stamp // 3600) * 3600)
+        for ranges in (index['hours'], index['items'].setdefault(item, {})):
+            if hour in ranges:
+                ranges[hour][0] = min(ranges[hour][0], start)
+                ranges[hour][1] = max(ranges[hour][1], end)
+            else:
+                ranges[hour] = [start, end]
+
+    def _read_index(self, path):
+        try:
+            with open(path + INDEX_SUFFIX, 'r') as f:
+                return json.load(f)
+        except Exception:
+            return None
+
+    def _write_index(self, path, index):
+        try:
+            with open(path + INDEX_SUFFIX + '.tmp', 'w') as f:
+                json.dump(index, f, separators=(',', ':'))
+            os.replace(path + INDEX_SUFFIX + '.tmp', path + INDEX_SUFFIX)
+        except Exception as e:
+            self.logger.error('Error while writing index of {}: {}'.format(path, e))
+
+    def _open_index(self, log, path):
+        """
+        Returns the index of a plain log file, which is built again if the file
+        has been written without updating the index
+        """
+        if not os.path.isfile(path):
+            return self._new_index(path)
+        index = self._read_index(path)
+        if index is not None and index.get('compression', 'none') == 'none' and index.get('size') == os.path.getsize(path):
+            return index
+        return self._build_index(log, path)
+
+    def _log(self, path):
+        """
+        Returns the log writing the given file (or a rotated part of it)
+        """
+        filename = os.path.relpath(path, self.path)
+        for log, pattern in self.filepatterns.items():
+            parts = []
+            for text, field, spec, conversion in string.Formatter().parse(pattern):
+                parts.append(re.escape(text))
+                if field == 'log':
+                    parts.append(re.escape(log))
+                elif field is not None:
+                    parts.append(r'\d+')
+            if re.fullmatch(''.join(parts) + r'(\.\d+)?', filename):
+                return log
+        return None
 
-        for filename in handles:
-            handles[filename].close()
+    def _build_index(self, log, path):
+        index = self._new_index(path)
+        regex = self._regex(log)
+        offset = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                end = offset + len(line)
+                match = regex.fullmatch(line.decode('utf-8', 'replace')) if regex is not None else None
+                stamp = self._stamp(match) if match is not None else None
+                if stamp is not None:
+                    self._index_add(index, match.group('item'), stamp, offset, end)
+                offset = end
+        index['size'] = offset
+        self.logger.debug('Built index of {} with {} items'.format(path, len(index['items'])))
+        return index
+
+    def _regex(self, log):
+        """
+        Returns the regular expression to parse the lines of a log, or None if
+        the log pattern does not contain the item and the time of the entries
+        """
+        if log not in self._regexes:
+            pattern = self.logpatterns[log]
+            parts = []
+            fields = set()
+            for text, field, spec, conversion in string.Formatter().parse(pattern):
+                parts.append(re.escape(text))
+                if field is None:
+                    continue
+                if field in fields or field not in ('time', 'stamp', 'item', 'value') or (field == 'time' and spec):
+                    parts.append('.*?')
+                else:
+                    parts.append('(?P<{}>.*?)'.format(field))
+                    fields.add(field)
+            if pattern.endswith('\n') and 'item' in fields and ('stamp' in fields or 'time' in fields):
+                self._regexes[log] = re.compile(''.join(parts))
+            else:
+                self._regexes[log] = None
+        return self._regexes[log]
+
+    def _stamp(self, match):
+        try:
+            if 'stamp' in match.groupdict():
+                return float(match.group('stamp'))
+            value = match.group('time')
+            if value[-3:-2] == ':' and value[-6:-5] in ('+', '-'):
+                # strptime supports UTC offsets with colon (written by str()) since Python 3.7 only
+                value = value[:-3] + value[-2:]
+            for fmt in TIME_FORMATS:
+                try:
+                    return datetime.datetime.strptime(value, fmt).timestamp()
+                except ValueError:
+                    pass
+        except Exception:
+            pass
+        return None
 
-            self.logger.debug('Dump done!')
+    def _timestamp(self, value):
+        if isinstance(value, datetime.datetime):
+            return value.timestamp()
+        return float(value)
+
+    def _parts(self, path):
+        """
+        Returns the paths and part numbers of the rotated parts of a log file
+        """
+        parts = set()
+        for name in glob.glob(glob.escape(path) + '.*'):
+            part = name[len(path) + 1:].split('.')[0]
+            if part.isdigit():
+                parts.add((path + '.' + part, int(part)))
+        return sorted(parts, key=lambda part: part[1])
+
+    def read(self, item, start, end=None, log=None):
+        """
+        Returns the entries of an item between start and end (timestamps or
+        datetime objects, end defaults to now) from the log files
+
+        Only the parts of the files containing entries of the item in the hours
+        between start and end are read (and decompressed).
+
+        :return: generator of (timestamp, value) tuples, the value is the string written to the log
+        """
+        start = self._timestamp(start)
+        end = time.time() if end is None else self._timestamp(end)
+        logs = [log] if log is not None else self._items.get(item, [])
+        for log in logs:
+            if log in self.filepatterns and self._regex(log) is not None:
+                break
+        else:
+            self.logger.warning('Item {} is not logged to a log which can be read'.format(item))
+            return
+        first = str(int(start // 3600) * 3600)
+        tz = self._sh.now().tzinfo
+        filenames = []
+        day = datetime.datetime.fromtimestamp(start, tz).date()
+        while day <= datetime.datetime.fromtimestamp(end, tz).date():
+            filename = self.filepatterns[log].format(**{ 'log' : log, 'year' : day.year, 'month' : day.month, 'day' : day.day })
+            if filename not in filenames:
+                filenames.append(filename)
+            day += datetime.timedelta(days=1)
+
+        regex = self._regex(log)
+        for filename in filenames:
+            path = self.path + '/' + filename
+            for base in [part for part, number in self._parts(path)] + [path]:
+                with self._index_lock:
+                    index = self._indexes.get(filename) if base == path else None
+                    if index is not None:
+                        # copy the ranges of the open file, which are extended by the writer
+                        index = {'data': index['data'], 'compression': 'none', 'items': {item: {hour: list(r) for hour, r in index['items'].get(item, {}).items()}}}
+                if index is None:
+                    index = self._read_index(base)
+                if index is None:
+                    if not os.path.isfile(base):
+                        continue
+                    index = self._build_index(log, base)
+                    index['size'] = os.path.getsize(base)
+                    self._write_index(base, index)
+                hours = index['items'].get(item, {})
+                ranges = sorted(r for hour, r in hours.items() if int(hour) >= int(first) and int(hour) <= end)
+                if index.get('compression', 'none') != 'none':
+                    base = os.path.join(os.path.dirname(base), index['data'])
+                for data in self._read_ranges(base, index, ranges):
+                    for line in data.decode('utf-8', 'replace').splitlines(True):
+                        match = regex.fullmatch(line)
+                        if match is None or match.group('item') != item:
+                            continue
+                        stamp = self._stamp(match)
+                        if stamp is not None and start <= stamp <= end:
+                            yield stamp, match.groupdict().get('value')
+
+    def _read_ranges(self, path, index, ranges):
+        """
+        Returns the data of the given byte ranges of the uncompressed file
+        (overlapping ranges are merged)
+        """
+        merged = []
+        for start, end in ranges:
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        if not merged:
+            return
+        with open(path, 'rb') as f:
+            if index.get('compression', 'none') == 'none':
+                for start, end in merged:
+                    f.seek(start)
+                    yield f.read(end - start)
+                return
+            blocks = index['blocks']
+            cache = {}
+            for start, end in merged:
+                data = []
+                for ustart, uend, offset, length in blocks[max(bisect.bisect_right([b[0] for b in blocks], start) - 1, 0):]:
+                    if ustart >= end:
+                        break
+                    if ustart not in cache:
+                        cache.clear()
+                        f.seek(offset)
+                        if index['compression'] == 'zstd':
+                            cache[ustart] = zstandard.ZstdDecompressor().decompress(f.read(length))
+                        else:
+                            cache[ustart] = gzip.decompress(f.read(length))
+                    data.append(cache[ustart][max(start - ustart, 0):end - ustart])
+                yield b''.join(data)
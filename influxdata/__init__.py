@@ -19,62 +19,196 @@
 #  along with SmartHomeNG. If not, see <http://www.gnu.org/licenses/>.
 #########################################################################
 
+import collections
+import functools
 import logging
 import socket
 import re
+import threading
+import time
 from lib.model.smartplugin import SmartPlugin
 
+RE_NON_WORD = re.compile(r"[^\w\s]")
+RE_SPACES = re.compile(r"\s+")
+
+
+@functools.lru_cache(maxsize=256)
+def _clean(s):
+    return RE_SPACES.sub('-', RE_NON_WORD.sub('', str(s)))
+
+
+@functools.lru_cache(maxsize=256)
+def _escape_tag(value):
+    return str(value).replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
 
 class InfluxData(SmartPlugin):
     PLUGIN_VERSION = "1.0.0"
     ALLOW_MULTIINSTANCE = False
 
-    def __init__(self, smarthome, influx_host='localhost', influx_port=8089, influx_keyword='influx'):
+    def __init__(self, smarthome, influx_host='localhost', influx_port=8089, influx_keyword='influx', flush_interval=0.5, max_packet=1400):
         self.logger = logging.getLogger(__name__)
         self.logger.info('Init InfluxData')
         self._sh = smarthome
         self.influx_host = influx_host
         self.influx_port = influx_port
         self.influx_keyword = influx_keyword
+        self.flush_interval = float(flush_interval)
+        self.max_packet = int(max_packet)
         self._items = []
+        self._item_config = {}
+
+        self._lock = threading.Lock()
+        self._queue = collections.deque()
+        self._queue_bytes = 0
+        # items with a rate limited line waiting to be sent
+        self._pending = set()
+        self._wakeup = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._address = None
+        self._sock = None
+        self._sender = None
+        self.stats = {'lines': 0, 'packets': 0, 'skipped': 0, 'errors': 0}
 
     def cleanstring(self, s):
-        s = re.sub(r"[^\w\s]", '', s)
-        s = re.sub(r"\s+", '-', s)
-        return s
+        return _clean(s)
 
     def run(self):
         self.alive = True
+        # without flush interval the lines are sent synchronously by update_item(), the
+        # sender thread is only required for the delayed lines of rate limited items
+        intervals = [config['min_interval'] for config in self._item_config.values() if config['min_interval']]
+        interval = self.flush_interval if self.flush_interval > 0 else min(intervals, default=None)
+        if interval is not None:
+            self._sender = threading.Thread(target=self._send_loop, args=(interval,), name='InfluxData sender')
+            self._sender.daemon = True
+            self._sender.start()
 
     def stop(self):
         self.alive = False
-
-    def udp(self, data):
-        try:
-            family, type, proto, canonname, sockaddr = socket.getaddrinfo(self.influx_host, self.influx_port)[0]
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            sock.sendto(data.encode(), (sockaddr[0], sockaddr[1]))
-            sock.close()
-            del sock
-        except Exception as e:
-            self.logger.warning(
-                "InfluxData: Problem sending data to {}:{}: {}".format(self.influx_host, self.influx_port, e))
-            pass
+        self._wakeup.set()
+        if self._sender is not None:
+            self._sender.join(5)
+            self._sender = None
         else:
-            self.logger.debug("InfluxData: Sending data to {}:{}: {}".format(self.influx_host, self.influx_port, data))
+            self.flush()
+        self._close()
+
+    def _connect(self):
+        """
+        Resolves the address of the database once and opens the socket used
+        for all datagrams
+        """
+        family, type, proto, canonname, sockaddr = socket.getaddrinfo(self.influx_host, self.influx_port, 0, socket.SOCK_DGRAM)[0]
+        self._sock = socket.socket(family, socket.SOCK_DGRAM)
+        self._address = sockaddr
+
+    def _close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        self._address = None
 
     def parse_item(self, item):
         if self.influx_keyword in item.conf:
             if item.type() not in ['num', 'bool']:
                 self.logger.debug("InfluxData: only supports 'num' and 'bool' as types. Item: {} ".format(item.id()))
                 return
+            config = {
+                # measurement and first tag key, escaped once
+                'prefix': item.id().replace(',', '\\,').replace(' ', '\\ ') + ',caller=',
+                'min_interval': float(item.conf.get('influx_min_interval', 0)),
+                'deadband': float(item.conf.get('influx_deadband', 0)),
+                'last_time': None,
+                'last_value': None,
+                'line': None
+            }
+            self._item_config[item.id()] = config
             self._items.append(item)
             return self.update_item
 
     def update_item(self, item, caller=None, source=None, dest=None):
-        message = "{},caller={},source={},dest={} value={}".format(item.id(), self.cleanstring(caller), source, dest, float(item()))
-        self.udp(message)
+        config = self._item_config[item.id()]
+        value = float(item())
+        if config['deadband'] and config['last_value'] is not None and abs(value - config['last_value']) < config['deadband']:
+            self.stats['skipped'] += 1
+            return None
+        message = "{}{},source={},dest={} value={}".format(config['prefix'], _clean(caller), _escape_tag(source), _escape_tag(dest), value)
+        now = time.monotonic()
+        with self._lock:
+            config['last_value'] = value
+            if config['min_interval'] and config['last_time'] is not None and now - config['last_time'] < config['min_interval']:
+                # only the latest line is sent when the interval has elapsed
+                if config['line'] is not None:
+                    self.stats['skipped'] += 1
+                config['line'] = message
+                self._pending.add(item.id())
+                return None
+            config['last_time'] = now
+            self._queue_line(message)
+        if self.flush_interval <= 0:
+            self.flush()
         return None
 
+    def _queue_line(self, message):
+        data = message.encode()
+        self._queue.append(data)
+        self._queue_bytes += len(data) + 1
+        if self._queue_bytes >= self.max_packet:
+            self._wakeup.set()
+
+    def _send_loop(self, interval):
+        while self.alive:
+            self._wakeup.wait(interval)
+            self._wakeup.clear()
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        """
+        Sends the queued lines and the rate limited lines which are due, packed
+        into as few datagrams as possible
+        """
+        with self._flush_lock:
+            now = time.monotonic()
+            with self._lock:
+                for item_id in list(self._pending):
+                    config = self._item_config[item_id]
+                    if now - config['last_time'] >= config['min_interval'] or not self.alive:
+                        config['last_time'] = now
+                        self._queue_line(config['line'])
+                        config['line'] = None
+                        self._pending.discard(item_id)
+                lines = list(self._queue)
+                self._queue.clear()
+                self._queue_bytes = 0
+            packet = []
+            size = 0
+            for line in lines:
+                if packet and size + len(line) > self.max_packet:
+                    self._send(packet)
+                    packet = []
+                    size = 0
+                packet.append(line)
+                size += len(line) + 1
+            if packet:
+                self._send(packet)
+
+    def _send(self, lines):
+        try:
+            if self._sock is None:
+                self._connect()
+            self._sock.sendto(b'\n'.join(lines), self._address)
+        except Exception as e:
+            self.stats['errors'] += 1
+            self.logger.warning(
+                "InfluxData: Problem sending {} lines to {}:{}: {}".format(len(lines), self.influx_host, self.influx_port, e))
+            # resolve the address again with the next datagram
+            self._close()
+        else:
+            self.stats['lines'] += len(lines)
+            self.stats['packets'] += 1
+            self.logger.debug("InfluxData: Sent {} lines to {}:{}".format(len(lines), self.influx_host, self.influx_port))
+
     def _update_values(self):
         return None
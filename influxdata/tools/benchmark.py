@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# vim: set encoding=utf-8 tabstop=4 softtabstop=4 shiftwidth=4 expandtab
+#########################################################################
+#  This file is part of SmartHomeNG.
+#
+#  SmartHomeNG is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  SmartHomeNG is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with SmartHomeNG. If not, see <http://www.gnu.org/licenses/>.
+#########################################################################
+
+
+"""
+Measures the item updates per second the influxdata plugin handles, compared
+to sending one datagram with a new socket per update (as done before the
+batch sender was introduced).
+
+The lines are sent to a local UDP socket. Run it from the base directory of
+SmartHomeNG:
+
+    python3 plugins/influxdata/tools/benchmark.py --updates 100000
+"""
+
+import argparse
+import os
+import re
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..'))
+
+from plugins.influxdata import InfluxData
+
+
+class Item():
+
+    def __init__(self, path, conf):
+        self._path = path
+        self._value = 0.0
+        self.conf = conf
+
+    def __call__(self, value=None):
+        if value is None:
+            return self._value
+        self._value = value
+
+    def id(self):
+        return self._path
+
+    def type(self):
+        return 'num'
+
+
+class Receiver(threading.Thread):
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.settimeout(0.5)
+        self.port = self.sock.getsockname()[1]
+        self.lines = 0
+
+    def run(self):
+        while True:
+            try:
+                data = self.sock.recv(65535)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            self.lines += data.count(b'\n') + 1
+
+
+def legacy_update(host, port, item, caller, source, dest):
+    # the former implementation of update_item and udp
+    caller = re.sub(r"\s+", '-', re.sub(r"[^\w\s]", '', caller))
+    data = "{},caller={},source={},dest={} value={}".format(item.id(), caller, source, dest, float(item()))
+    family, type, proto, canonname, sockaddr = socket.getaddrinfo(host, port)[0]
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.sendto(data.encode(), (sockaddr[0], sockaddr[1]))
+    sock.close()
+
+
+def run(updates, count, conf):
+    items = [Item('bench.item{}'.format(i), dict(conf, influx='yes')) for i in range(count)]
+
+    receiver = Receiver()
+    receiver.start()
+    start = time.perf_counter()
+    for n in range(updates):
+        item = items[n % count]
+        item(float(n % 100))
+        legacy_update('localhost', receiver.port, item, 'KNX', '1.1.1', None)
+    legacy = time.perf_counter() - start
+    print("legacy:  {:>10.0f} updates/s".format(updates / legacy))
+
+    plugin = InfluxData(None, influx_host='localhost', influx_port=receiver.port)
+    for item in items:
+        plugin.parse_item(item)
+    plugin.run()
+    start = time.perf_counter()
+    for n in range(updates):
+        item = items[n % count]
+        item(float(n % 100))
+        plugin.update_item(item, 'KNX', '1.1.1', None)
+    queued = time.perf_counter() - start
+    plugin.stop()
+    total = time.perf_counter() - start
+    print("batched: {:>10.0f} updates/s ({:.0f} updates/s including the final flush)".format(updates / queued, updates / total))
+    print("         {} lines in {} datagrams, {} updates skipped".format(plugin.stats['lines'], plugin.stats['packets'], plugin.stats['skipped']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the influxdata plugin")
+    parser.add_argument('--updates', type=int, default=50000, help="number of item updates")
+    parser.add_argument('--items', type=int, default=100, help="number of items")
+    parser.add_argument('--min-interval', type=float, default=0, help="influx_min_interval of the items")
+    parser.add_argument('--deadband', type=float, default=0, help="influx_deadband of the items")
+    args = parser.parse_args()
+    conf = {}
+    if args.min_interval:
+        conf['influx_min_interval'] = args.min_interval
+    if args.deadband:
+        conf['influx_deadband'] = args.deadband
+    run(args.updates, args.items, conf)
+
+
+if __name__ == '__main__':
+    main()
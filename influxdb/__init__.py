@@ -22,6 +22,11 @@
 import logging
 import socket
 import json
+import collections
+import threading
+import time
+import urllib.parse
+import urllib.request
 from lib.model.smartplugin import SmartPlugin
 
 
@@ -29,7 +34,14 @@ class InfluxDB(SmartPlugin):
     PLUGIN_VERSION = "1.0.0"
     ALLOW_MULTIINSTANCE = False
 
-    def __init__(self, smarthome, host='localhost', udp_port=8089, keyword='influxdb', tags={}, fields={}, value_field='value'):
+    # tags set for every update (may be overridden by static tags)
+    DYNAMIC_TAGS = ('caller', 'source', 'dest')
+    # number of lines written with one HTTP request before the flush interval elapsed
+    HTTP_BATCH = 5000
+
+    def __init__(self, smarthome, host='localhost', udp_port=8089, keyword='influxdb', tags={}, fields={}, value_field='value',
+                 mode='udp', http_port=8086, database='smarthome', username=None, password=None, flush_interval=0.5,
+                 max_packet=1400, retry_queue=10000):
         self.logger = logging.getLogger(__name__)
         self.logger.info('Init InfluxDB')
 
@@ -41,11 +53,43 @@ class InfluxDB(SmartPlugin):
         self.value_field = value_field
         self.item_config = {}
 
+        self.mode = mode
+        self.http_port = int(http_port)
+        self.database = database
+        self.username = username
+        self.password = password
+        self.flush_interval = float(flush_interval)
+        self.max_packet = int(max_packet)
+        self.retry_queue = int(retry_queue)
+
+        # lines waiting to be sent (bounded, the oldest lines are dropped)
+        self._queue = collections.deque(maxlen=max(self.retry_queue, 1))
+        self._queue_bytes = 0
+        self._queue_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._retry = collections.deque()
+        self._sock = None
+        self._sender = None
+        self.stats = {'lines': 0, 'packets': 0, 'dropped': 0, 'errors': 0}
+
     def run(self):
         self.alive = True
+        # without flush interval every line is sent synchronously by send()
+        if self.flush_interval > 0:
+            self._sender = threading.Thread(target=self._send_loop, name='InfluxDB sender')
+            self._sender.daemon = True
+            self._sender.start()
 
     def stop(self):
         self.alive = False
+        self._wakeup.set()
+        if self._sender is not None:
+            self._sender.join(5)
+            self._sender = None
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
 
     def parse_item(self, item):
         if self.keyword in item.conf or 'influxdb_name' in item.conf or 'influxdb_tags' in item.conf or 'influxdb_fields' in item.conf:
@@ -82,6 +126,7 @@ class InfluxDB(SmartPlugin):
                     self.logger.error("InfluxDB: item {} has invalid fields {}, parsing JSON failed with: {}".format(item.id(), fields_json, e))
                     return
 
+            config['template'] = self.create_template(item, config)
             self.logger.debug("InfluxDB: item {} config: {}".format(item.id(), config))
 
             self.item_config[ item.id() ] = config
@@ -89,15 +134,15 @@ class InfluxDB(SmartPlugin):
             self.logger.info("InfluxDB: logging item {} as {}".format(item.id(), config['name']))
             return self.update_item
 
-    def update_item(self, item, caller=None, source=None, dest=None):
-        config = self.item_config[ item.id() ]
-        name = config['name']
+    def create_template(self, item, config):
+        """
+        Creates the line protocol template of an item
 
-        tags = {
-            'caller': caller,
-            'source': source,
-            'dest': dest
-        }
+        The measurement, the static tags and fields are merged and sorted once,
+        only the dynamic tags (caller, source, dest) and the value have to be
+        filled in for every update.
+        """
+        tags = {key: None for key in self.DYNAMIC_TAGS}
         tags.update( self.tags ) # + plugin.conf tags
         tags.update( config['tags'] ) # + item's tags
 
@@ -109,21 +154,122 @@ class InfluxDB(SmartPlugin):
         fields = {}
         fields.update( self.fields ) # + plugin.conf fields
         fields.update( config['fields'] ) # + item's fields
-        fields[config['value_field']] = float( item() )
+        fields[config['value_field']] = None
 
-        line = self.create_line(name, tags, fields)
+        def escape(value):
+            return str(value).replace('{', '{{').replace('}', '}}')
+
+        dynamic = [key for key in self.DYNAMIC_TAGS if key in tags and key not in self.tags and key not in config['tags']]
+        tags = {escape(key): '{' + key + '}' if key in dynamic else escape(value) for key, value in tags.items()}
+        fields = {escape(key): '{value}' if key == config['value_field'] else escape(value) for key, value in fields.items()}
+        return self.create_line(escape(config['name']), tags, fields)
+
+    def update_item(self, item, caller=None, source=None, dest=None):
+        config = self.item_config[ item.id() ]
+        line = config['template'].format(caller=caller, source=source, dest=dest, value=float( item() ))
         self.send( line )
         return None
 
     def send(self, data):
+        """
+        Queues the given line, which is sent by the sender thread within the
+        next batch (or immediately if flush_interval is 0)
+        """
+        if self.mode == 'http':
+            data += ' {}'.format(int(time.time() * 1000))
+        data = data.encode()
+        with self._queue_lock:
+            if len(self._queue) == self._queue.maxlen:
+                self.stats['dropped'] += 1
+                self._queue_bytes -= len(self._queue[0]) + 1
+            self._queue.append(data)
+            self._queue_bytes += len(data) + 1
+            if self.mode == 'http':
+                full = len(self._queue) >= self.HTTP_BATCH
+            else:
+                full = self._queue_bytes >= self.max_packet
+        if self.flush_interval <= 0:
+            self.flush()
+        elif full:
+            self._wakeup.set()
+
+    def _send_loop(self):
+        while self.alive:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        """
+        Sends all queued lines, packed into as few UDP datagrams (or HTTP
+        requests) as possible
+        """
+        with self._flush_lock:
+            with self._queue_lock:
+                lines = list(self._queue)
+                self._queue.clear()
+                self._queue_bytes = 0
+            if self.mode == 'http':
+                self._flush_http(lines)
+            else:
+                self._flush_udp(lines)
+
+    def _flush_udp(self, lines):
+        packet = []
+        size = 0
+        for line in lines:
+            if packet and size + len(line) > self.max_packet:
+                self._send_udp(b'\n'.join(packet), len(packet))
+                packet = []
+                size = 0
+            packet.append(line)
+            size += len(line) + 1
+        if packet:
+            self._send_udp(b'\n'.join(packet), len(packet))
+
+    def _send_udp(self, data, count):
+        try:
+            if self._sock is None:
+                self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._sock.sendto(data, (self.host, self.udp_port))
+        except Exception as e:
+            self.stats['errors'] += 1
+            self.logger.error("InfluxDB: failed sending UDP datagram with {} lines to {}:{} with error: {}".format(count, self.host, self.udp_port, e))
+            if self._sock is not None:
+                self._sock.close()
+                self._sock = None
+        else:
+            self.stats['lines'] += count
+            self.stats['packets'] += 1
+            self.logger.debug("InfluxDB: sent UDP datagram with {} lines to {}:{}".format(count, self.host, self.udp_port))
+
+    def _flush_http(self, lines):
+        self._retry.extend(lines)
+        # bounded retry queue: drop the oldest lines if the database is not reachable for a longer time
+        while len(self._retry) > self.retry_queue:
+            self._retry.popleft()
+            self.stats['dropped'] += 1
+        if not self._retry:
+            return
+        lines = list(self._retry)
+        params = {'db': self.database, 'precision': 'ms'}
+        if self.username:
+            params.update({'u': self.username, 'p': self.password or ''})
+        url = 'http://{}:{}/write?{}'.format(self.host, self.http_port, urllib.parse.urlencode(params))
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            sock.sendto(data.encode(), (self.host, self.udp_port))
-            sock.close()
+            request = urllib.request.Request(url, data=b'\n'.join(lines), method='POST')
+            with urllib.request.urlopen(request, timeout=5) as response:
+                response.read()
         except Exception as e:
-            self.logger.error("InfluxDB: failed sending UDP datagram [{}] to {}:{} with error: {}".format(data, self.host, self.udp_port, e))
+            self.stats['errors'] += 1
+            self.logger.warning("InfluxDB: failed writing {} lines to {}:{}, retrying later: {}".format(len(lines), self.host, self.http_port, e))
         else:
-            self.logger.debug("InfluxDB: sent UDP datagram [{}] to {}:{}".format(data, self.host, self.udp_port))
+            for _ in lines:
+                self._retry.popleft()
+            self.stats['lines'] += len(lines)
+            self.stats['packets'] += 1
+            self.logger.debug("InfluxDB: wrote {} lines to {}:{}".format(len(lines), self.host, self.http_port))
 
     def create_line(self, name, tags, fields):
         # https://docs.influxdata.com/influxdb/v1.0/guides/writing_data/
@@ -25,34 +25,59 @@
 #########################################################################
 
 import logging
+import os
 import struct
+import array
 import binascii
+import bisect
+import collections
+import functools
+import heapq
 import random
+import threading
 import time
-from datetime import timedelta
 
 import lib.connection
 from lib.utils import Utils
 from lib.item import Items
 from lib.model.smartplugin import *
 from lib.shtime import Shtime
+from datetime import timedelta
 
 from . import dpts
+from . import capture
 
 # types from knxd\src\include\eibtypes.h
+KNXD_PROCESSING_ERROR = 1    # 0x01
 KNXD_OPEN_GROUPCON  = 38     # 0x26
 KNXD_GROUP_PACKET   = 39     # 0x27 ‭
 KNXD_CACHE_ENABLE   = 112    # 0x70
 KNXD_CACHE_DISABLE  = 113    # 0x71
 KNXD_CACHE_READ     = 116    # 0x74
 
-KNXD_CACHEREAD_DELAY  = 0.35
-KNXD_CACHEREAD_DELAY  = 0.0
+# cache and init reads at startup, which are not answered within the timeout, are sent again
+READ_TIMEOUT = 3
+READ_RETRIES = 2
+
+# a poll sent this number of seconds after it was due is counted as late
+POLL_LATE = 2
 
 KNXREAD = 0x00
 KNXRESP = 0x40
 KNXWRITE = 0x80
 
+FLAGS = {KNXREAD: 'read', KNXRESP: 'response', KNXWRITE: 'write'}
+FLAG_NAMES = ('read', 'response', 'write')     # indexed by flag >> 6
+
+# windows (in seconds) of the telegram rates and number of telegrams kept for them (about 36 telegrams/s for one hour)
+STATS_WINDOWS = (60, 900, 3600)
+STATS_RING = 1 << 17
+
+# priority classes of the send queue
+PRIO_TIME   = 0     # time and date
+PRIO_STATUS = 1     # writes of items and logics, responses to read requests
+PRIO_BULK   = 2     # group reads (init and poll)
+
 # deprecated due to the new smartplugin model
 # KNX_INSTANCE = 'knx_instance'     # which instance of plugin to use for a given item (deprecated!)
 KNX_DPT      = 'knx_dpt'          # data point type
@@ -72,6 +97,42 @@ LOGIC = 'logic'
 LOGICS = 'logics'
 DPT='dpt'
 
+
+def _ga_int(ga):
+    """
+    returns the raw 16 bit value of a group address given as string (x/y/z)
+    """
+    ga = dpts.enga(ga)
+    if not (0 <= ga[0] <= 0xff and 0 <= ga[1] <= 0xff):
+        raise ValueError("group address out of range")
+    return ga[0] << 8 | ga[1]
+
+
+def _ga_str(ga):
+    return "{0}/{1}/{2}".format((ga >> 11) & 0x1f, (ga >> 8) & 0x07, ga & 0xff)
+
+
+@functools.lru_cache(maxsize=1024)
+def _pa_str(pa):
+    return "{0}.{1}.{2}".format((pa >> 12) & 0x0f, (pa >> 8) & 0x0f, pa & 0xff)
+
+
+class _Poll():
+    """
+    A group address polled by the poll engine of the plugin
+
+    The times are taken from time.monotonic().
+    """
+    __slots__ = ('ga', 'interval', 'value', 'write', 'sent')
+
+    def __init__(self, ga, interval):
+        self.ga = ga
+        self.interval = interval
+        self.value = None       # last telegram with a value (write or response)
+        self.write = None       # last write telegram, a fresh value sent by a device
+        self.sent = None        # last poll
+
+
 class KNX(lib.connection.Client,SmartPlugin):
     ALLOW_MULTIINSTANCE = True
     PLUGIN_VERSION = "1.6.0"
@@ -98,9 +159,27 @@ class KNX(lib.connection.Client,SmartPlugin):
 
         self.gal = {}                   # group addresses to listen to {DPT: dpt, ITEMS: [item 1, item 2, ..., item n], LOGICS: [ logic 1, logic 2, ..., logic n]}
         self.gar = {}                   # group addresses to reply if requested from knx, {DPT: dpt, ITEM: item, LOGIC: None}
+        self._gal = {}                  # dispatch table keyed by the raw group address: (ga, dpt, decoder, items, logics)
+        self._gar = {}                  # reply table keyed by the raw group address: (ga, entry of self.gar)
         self._init_ga = []
         self._cache_ga = []             # group addresses which should be initalized by the knxd cache
         self._cache_ga_response_pending = []
+        self.read_window = self.get_parameter_value('read_window')
+        self._read_phase = None         # reads at startup: 'cache' (knxd cache reads), 'init' (group reads) or None
+        self._read_todo = collections.deque()
+        self._read_outstanding = collections.OrderedDict()     # {ga: [time sent, number of tries]} in the order sent
+        self._read_fallback = []        # cached group addresses without a value in the knxd cache
+        self._read_lock = threading.Lock()
+        self._read_start = None
+        self.poll_budget = self.get_parameter_value('poll_budget')
+        self._polls = {}                # {raw ga: _Poll}
+        self._poll_heap = []            # [(due, ga)], the next poll on top
+        self._poll_lock = threading.Lock()
+        self._poll_tokens = 0.0
+        self._poll_time = None
+        self._poll_job = False
+        self.poll_stats = {'polls': 0, 'skipped': 0, 'late': 0, 'missed': 0}
+        self.read_stats = {'cache': 0, 'cache_values': 0, 'reads': 0, 'responses': 0, 'retries': 0, 'failed': 0, 'duration': None}
         self.time_ga = self.get_parameter_value('time_ga')
         self.date_ga = self.get_parameter_value('date_ga')
         send_time = self.get_parameter_value('send_time')
@@ -109,33 +188,56 @@ class KNX(lib.connection.Client,SmartPlugin):
 
         # following needed for statistics
         self.enable_stats = self.get_parameter_value('enable_stats')
-        self.stats_ga = {}              # statistics for used group addresses on the BUS
-        self.stats_pa = {}              # statistics for used group addresses on the BUS
-        self.stats_last_read = None     # last read request from KNX
-        self.stats_last_write = None    # last write from KNX
-        self.stats_last_response = None # last response from KNX
-        self.stats_last_action = None   # the newes
+        self._stats_ring_time = None    # the counters and ring buffers are allocated when the first telegram is counted
 
+        # the busmonitor messages are only formatted, if the level is enabled for the logger
+        self._bm_logger = self.logger
+        self._bm_level = logging.DEBUG
         if busmonitor.lower() in ['on','true']:
-            self._busmonitor = self.logger.info
+            self._bm_level = logging.INFO
         elif busmonitor.lower() in ['off','false']:
-            self._busmonitor = self.logger.debug
+            pass
         elif busmonitor.lower() == 'logger':
             self._bm_separatefile = True
             self._bm_format = "{0};{1};{2};{3}"
-            self._busmonitor = logging.getLogger("knx_busmonitor").info
+            self._bm_logger = logging.getLogger("knx_busmonitor")
+            self._bm_level = logging.INFO
             self.logger.warning("Using busmonitor (L) = '{}'".format(busmonitor))
         else:
             self.logger.warning("Invalid value '{}' configured for parameter 'busmonitor', using 'false'".format(busmonitor))
-            self._busmonitor = self.logger.debug
+        self._busmonitor = functools.partial(self._bm_logger.log, self._bm_level)
+
+        # prefix of the source passed to items and logics
+        self._src_prefix = self.get_instance_name()
+        if self._src_prefix != '':
+            self._src_prefix += ':'
 
         if send_time:
             self._sh.scheduler.add('KNX[{0}] time'.format(self.get_instance_name()), self._send_time, prio=5, cycle=int(send_time))
 
+        self.dpt_tables = self.get_parameter_value('dpt_tables')
         self.readonly = self.get_parameter_value('readonly')
         if self.readonly:
             self.logger.warning("!!! KNX Plugin in READONLY mode !!! ")
 
+        # outgoing telegrams are queued per priority class and sent with at most send_rate telegrams/s,
+        # a telegram to a group address which is still pending replaces the pending telegram
+        self.send_rate = self.get_parameter_value('send_rate')
+        self._queue = [collections.deque() for prio in (PRIO_TIME, PRIO_STATUS, PRIO_BULK)]
+        self._queue_pending = {}        # {(raw ga, flag): [packet, time queued]}
+        self._queue_lock = threading.Lock()
+        self._queue_event = threading.Event()
+        self._sender = None
+        self.send_stats = {'sent': 0, 'coalesced': 0, 'max_depth': 0, 'latency_sum': 0.0, 'latency_max': 0.0}
+
+        # binary capture of the received frames (for tools/replay.py)
+        self.capture_file = self.get_parameter_value('capture_file')
+        if self.capture_file and self.capture_file[0] != '/':
+            self.capture_file = os.path.join(self._sh.base_dir, self.capture_file)
+        self.capture_size = self.get_parameter_value('capture_size')
+        self.capture_backups = self.get_parameter_value('capture_backups')
+        self._capture = None
+
         self.init_webinterface()
         return
 
@@ -148,7 +250,57 @@ class KNX(lib.connection.Client,SmartPlugin):
         send.extend(data)
         self.send(send)
 
-    def groupwrite(self, ga, payload, dpt, flag='write'):
+    def _enqueue(self, pkt, prio=PRIO_STATUS):
+        """
+        Queues a group telegram for the sender thread
+
+        If a telegram with the same flag to the same group address is still
+        pending, only its packet is replaced (it keeps its place in the queue).
+        """
+        if not self.send_rate or self._sender is None:
+            self._send(pkt)
+            return
+        key = (pkt[2] << 8 | pkt[3], pkt[5] & 0xC0)
+        with self._queue_lock:
+            entry = self._queue_pending.get(key)
+            if entry is not None:
+                entry[0] = pkt
+                self.send_stats['coalesced'] += 1
+                return
+            self._queue_pending[key] = [pkt, time.monotonic()]
+            self._queue[prio].append(key)
+            if len(self._queue_pending) > self.send_stats['max_depth']:
+                self.send_stats['max_depth'] = len(self._queue_pending)
+        self._queue_event.set()
+
+    def _send_loop(self):
+        interval = 1.0 / self.send_rate
+        next_send = time.monotonic()
+        while self.alive:
+            pkt = None
+            with self._queue_lock:
+                for queue in self._queue:
+                    if queue:
+                        pkt, queued = self._queue_pending.pop(queue.popleft())
+                        break
+                else:
+                    self._queue_event.clear()
+            if pkt is None:
+                self._queue_event.wait(1)
+                continue
+            now = time.monotonic()
+            if next_send > now:
+                time.sleep(next_send - now)
+                now = next_send
+            next_send = now + interval
+            self._send(pkt)
+            latency = time.monotonic() - queued
+            self.send_stats['sent'] += 1
+            self.send_stats['latency_sum'] += latency
+            if latency > self.send_stats['latency_max']:
+                self.send_stats['latency_max'] = latency
+
+    def groupwrite(self, ga, payload, dpt, flag='write', prio=PRIO_STATUS):
         pkt = bytearray([0, KNXD_GROUP_PACKET])
         try:
             pkt.extend(self.encode(ga, 'ga'))
@@ -170,7 +322,7 @@ class KNX(lib.connection.Client,SmartPlugin):
         if self.readonly:
             self.logger.info("groupwrite telegram for: {} - Value: {} not send. Plugin in READONLY mode. ".format(ga,payload))
         else:
-            self._send(pkt)
+            self._enqueue(pkt, prio)
 
     def _cacheread(self, ga):
         pkt = bytearray([0, KNXD_CACHE_READ])
@@ -183,7 +335,7 @@ class KNX(lib.connection.Client,SmartPlugin):
         self.logger.debug('reading knxd cache for ga: {}'.format(ga))
         self._send(pkt)
 
-    def groupread(self, ga):
+    def groupread(self, ga, prio=PRIO_BULK):
         pkt = bytearray([0, KNXD_GROUP_PACKET])
         try:
             pkt.extend(self.encode(ga, 'ga'))
@@ -191,26 +343,85 @@ class KNX(lib.connection.Client,SmartPlugin):
             self.logger.warning('problem encoding ga: {}'.format(ga))
             return
         pkt.extend([0, KNXREAD])
-        self._send(pkt)
+        self._enqueue(pkt, prio)
 
-    def _poll(self, **kwargs):
-        if ITEM in kwargs:
-            item = kwargs[ITEM]
-        else:
-            item = 'unknown item'
-
-        if 'ga' in kwargs:
-            self.groupread(kwargs['ga'])
-        else:
-            self.logger.warning('problem polling {}, no known ga'.format(item))
+    def _add_poll(self, ga, interval):
+        """
+        Adds a group address to the poll engine (the shortest interval of
+        all items polling the group address is used)
 
-        if 'interval' in kwargs and 'ga' in kwargs:
-            ga = kwargs['ga']
-            interval = int(kwargs['interval'])
-            next = self.shtime.now() + timedelta(seconds=interval)
-            self._sh.scheduler.add('KNX poll {}'.format(item), self._poll,
-                                   value={'instance': self.get_instance_name(), ITEM: item, 'ga': ga, 'interval': interval},
-                                   next=next)
+        The polls are kept by the raw group address, like the listen table,
+        so parse_telegram finds them without converting the address.
+        """
+        try:
+            raw = _ga_int(ga)
+        except (ValueError, IndexError):
+            self.logger.warning("Ignoring invalid group address {} for polling".format(ga))
+            return
+        with self._poll_lock:
+            poll = self._polls.get(raw)
+            if poll is None:
+                poll = _Poll(ga, interval)
+                self._polls[raw] = poll
+                if self._poll_job:
+                    heapq.heappush(self._poll_heap, (time.monotonic() + random.uniform(0, interval), raw))
+            elif interval < poll.interval:
+                poll.interval = interval
+        if self.alive:
+            self._start_polls()
+
+    def _start_polls(self):
+        """
+        Schedules the first poll of all group addresses, spread evenly over
+        their interval, and adds the timer of the poll engine
+        """
+        with self._poll_lock:
+            if self._poll_job or not self._polls:
+                return
+            now = time.monotonic()
+            intervals = {}
+            for raw, poll in self._polls.items():
+                intervals.setdefault(poll.interval, []).append(raw)
+            for interval, polls in intervals.items():
+                for n, raw in enumerate(polls):
+                    heapq.heappush(self._poll_heap, (now + interval * (n + 1) / len(polls), raw))
+            self._poll_time = now
+            self._poll_job = True
+        self.logger.info("Polling {} ga with at most {} reads/s".format(len(self._polls), self.poll_budget))
+        self._sh.scheduler.add('KNX[{0}] poll'.format(self.get_instance_name()), self._poll, prio=5, cycle=1)
+
+    def _poll(self):
+        """
+        Sends the group reads of all polls due, as far as the bus load budget
+        (poll_budget reads/s) allows. A poll is skipped, if a device sent a new
+        value within the interval.
+        """
+        with self._poll_lock:
+            now = time.monotonic()
+            self._poll_tokens = min(max(self.poll_budget, 1), self._poll_tokens + (now - self._poll_time) * self.poll_budget)
+            self._poll_time = now
+            heap = self._poll_heap
+            while heap and heap[0][0] <= now:
+                due, raw = heap[0]
+                poll = self._polls[raw]
+                if poll.sent is not None and (poll.value is None or poll.value < poll.sent):
+                    # no response to the last poll
+                    self.poll_stats['missed'] += 1
+                    poll.sent = None
+                if poll.write is not None and now - poll.write < poll.interval:
+                    self.poll_stats['skipped'] += 1
+                    heapq.heapreplace(heap, (poll.write + poll.interval, raw))
+                    continue
+                if self._poll_tokens < 1:
+                    # the remaining polls are sent within the next cycles
+                    break
+                self._poll_tokens -= 1
+                if now - due >= POLL_LATE:
+                    self.poll_stats['late'] += 1
+                heapq.heapreplace(heap, (max(due + poll.interval, now), raw))
+                poll.sent = now
+                self.poll_stats['polls'] += 1
+                self.groupread(poll.ga)
 
     def _send_time(self):
         self.send_time(self.time_ga, self.date_ga)
@@ -218,39 +429,147 @@ class KNX(lib.connection.Client,SmartPlugin):
     def send_time(self, time_ga=None, date_ga=None):
         now = self.shtime.now()
         if time_ga:
-            self.groupwrite(time_ga, now, '10')
+            self.groupwrite(time_ga, now, '10', prio=PRIO_TIME)
         if date_ga:
-            self.groupwrite(date_ga, now.date(), '11')
+            self.groupwrite(date_ga, now.date(), '11', prio=PRIO_TIME)
 
     def handle_connect(self):
         if not self.connected:
             self.logger.error('connection was unexpectedly lost')
             return
         self.discard_buffers()
+        # self.found_terminator is introduced in lib/connection.py
+        self.found_terminator = self.parse_length
+        self.terminator = 2
         enable_cache = bytearray([0, KNXD_CACHE_ENABLE])
         self._send(enable_cache)
-        self.found_terminator = self.parse_length
-        if self._cache_ga != []:
-            self.logger.debug('reading knxd cache')
-            for ga in self._cache_ga:
-                self._cache_ga_response_pending.append(ga)
-            for ga in self._cache_ga:
-                self._cacheread(ga)
-                # wait a little to not overdrive the knxd unless there is a fix
-                time.sleep(KNXD_CACHEREAD_DELAY)
-            self._cache_ga = []
-            self.logger.debug('finished reading knxd cache')
+        with self._read_lock:
+            self._read_start = time.monotonic()
+            self._read_outstanding.clear()
+            self._read_fallback = []
+            if self._cache_ga != []:
+                self.logger.debug('reading knxd cache for {} ga'.format(len(self._cache_ga)))
+                self._cache_ga_response_pending = list(self._cache_ga)
+                self._read_phase = 'cache'
+                self._read_todo = collections.deque(self._cache_ga)
+                self.read_stats['cache'] = len(self._cache_ga)
+                self._cache_ga = []
+            else:
+                self._open_groupcon()
+            self._read_next()
+        if self._read_phase is not None:
+            self._sh.scheduler.add('KNX[{0}] startup reads'.format(self.get_instance_name()), self._read_check, prio=5, cycle=1)
 
+    def _open_groupcon(self):
+        """
+        Opens the group monitor and starts the knx_init reads (and the group
+        reads of cached group addresses without a value in the knxd cache)
+        """
         self.logger.debug('enable group monitor')
         init = bytearray([0, KNXD_OPEN_GROUPCON, 0, 0, 0])
         self._send(init)
-        self.terminator = 2
-        if self._init_ga != []:
-            self.logger.debug('knxd init read for {} ga'.format(len(self._init_ga)))
-            for ga in self._init_ga:
-                self.groupread(ga)
-            self._init_ga = []
-            self.logger.debug('finished knxd init read')
+        gas = self._init_ga + self._read_fallback
+        self._init_ga = []
+        self._read_phase = 'init'
+        self._read_todo = collections.deque(dict.fromkeys(gas))
+        self.read_stats['reads'] += len(self._read_todo)
+        if self._read_todo:
+            self.logger.debug('knxd init read for {} ga'.format(len(self._read_todo)))
+
+    def _read_next(self):
+        """
+        Sends the next cache or init reads, so at most read_window requests are
+        outstanding, and finishes the phase if all requests are answered
+        (has to be called with the read lock held)
+        """
+        while self._read_todo and len(self._read_outstanding) < self.read_window:
+            ga = self._read_todo.popleft()
+            self._read_outstanding[ga] = [time.monotonic(), 1]
+            self._read_request(ga)
+        if self._read_todo or self._read_outstanding:
+            return
+        if self._read_phase == 'cache':
+            self.logger.debug('finished reading knxd cache')
+            self._open_groupcon()
+            self._read_next()
+        elif self._read_phase == 'init':
+            self._read_phase = None
+            self.read_stats['duration'] = time.monotonic() - self._read_start
+            stats = self.read_stats
+            self.logger.info("Startup reads finished in {:.1f} s: {} of {} ga from knxd cache, {} of {} group reads answered, {} retries, {} failed".format(
+                stats['duration'], stats['cache_values'], stats['cache'], stats['responses'], stats['reads'], stats['retries'], stats['failed']))
+
+    def _read_request(self, ga):
+        if self._read_phase == 'cache':
+            self._cacheread(ga)
+        else:
+            self.groupread(ga)
+
+    def _read_answered(self, ga, cache=False):
+        """
+        Called if a value for a group address arrived (from the knxd cache, if cache is True)
+        """
+        if self._read_phase is None:
+            return
+        with self._read_lock:
+            if ga not in self._read_outstanding:
+                return
+            if cache != (self._read_phase == 'cache'):
+                return
+            del self._read_outstanding[ga]
+            self.read_stats['cache_values' if cache else 'responses'] += 1
+            self._read_next()
+
+    def _read_cache_miss(self, data):
+        """
+        Called if knxd answered a cache read without a value, the group address
+        is read from the bus after opening the group monitor
+        """
+        with self._read_lock:
+            if self._read_phase != 'cache' or not self._read_outstanding:
+                return
+            ga = None
+            if len(data) >= 6:
+                entry = self._gal.get(data[4] << 8 | data[5])
+                if entry is not None and entry[0] in self._read_outstanding:
+                    ga = entry[0]
+            if ga is None:
+                # knxd answers the requests in order
+                ga = next(iter(self._read_outstanding))
+            del self._read_outstanding[ga]
+            self._read_fallback.append(ga)
+            self._read_next()
+
+    def _read_check(self):
+        """
+        Sends requests again, which are not answered within READ_TIMEOUT seconds,
+        and gives up after READ_RETRIES retries
+        """
+        with self._read_lock:
+            if self._read_phase is None:
+                self._sh.scheduler.remove('KNX[{0}] startup reads'.format(self.get_instance_name()))
+                return
+            now = time.monotonic()
+            for ga, request in list(self._read_outstanding.items()):
+                if now - request[0] < READ_TIMEOUT:
+                    continue
+                if request[1] <= READ_RETRIES:
+                    request[0] = now
+                    request[1] += 1
+                    self.read_stats['retries'] += 1
+                    self._read_outstanding.move_to_end(ga)
+                    self._read_request(ga)
+                else:
+                    del self._read_outstanding[ga]
+                    if self._read_phase == 'cache':
+                        self._read_fallback.append(ga)
+                    else:
+                        self.read_stats['failed'] += 1
+                        self.logger.warning("No response to the init read of ga {}".format(ga))
+            self._read_next()
+            if self._read_phase is not None:
+                done = self.read_stats['cache'] + self.read_stats['reads'] - len(self._read_todo) - len(self._read_outstanding)
+                self.logger.debug("Startup reads: {} requests done, {} waiting, {:.0f} s".format(done, len(self._read_todo) + len(self._read_outstanding), now - self._read_start))
 
 #   def collect_incoming_data(self, data):
 #       print('#  bin   h  d')
@@ -288,106 +607,140 @@ class KNX(lib.connection.Client,SmartPlugin):
         # self.found_terminator is introduced in lib/connection.py
         self.found_terminator = self.parse_length  # reset parser and terminator
         self.terminator = 2
-        typ = struct.unpack(">H", data[0:2])[0]
+        cap = self._capture
+        if cap is not None:
+            cap.write(data)
+        if len(data) < 2:
+            return
+        typ = data[0] << 8 | data[1]
+        if self._read_phase == 'cache' and (typ == KNXD_PROCESSING_ERROR or (typ == KNXD_CACHE_READ and len(data) < 8)):
+            # no value for the group address in the knxd cache
+            self._read_cache_miss(data)
+            return
         if (typ != KNXD_GROUP_PACKET and typ != KNXD_CACHE_READ) or len(data) < 8:
             # self.logger.debug("Ignore telegram.")
             return
         if (data[6] & 0x03 or (data[7] & 0xC0) == 0xC0):
             self.logger.debug("Unknown APDU")
             return
-        src = self.decode(data[2:4], 'pa')
-        dst = self.decode(data[4:6], 'ga')
+        # source and destination are kept as raw 16 bit values, they are only
+        # converted to strings if something consumes them
+        src = data[2] << 8 | data[3]
+        dst = data[4] << 8 | data[5]
         flg = data[7] & 0xC0
-        if flg == KNXWRITE:
-            flg = 'write'
-        elif flg == KNXREAD:
-            flg = 'read'
-        elif flg == KNXRESP:
-            flg = 'response'
-        else:
-            self.logger.warning("Unknown flag: {:02x} src: {} dest: {}".format(flg, src, dst))
-            return
         if len(data) == 8:
             payload = bytearray([data[7] & 0x3f])
         else:
             payload = data[8:]
 
         if self.enable_stats:
-            # update statistics on used group addresses
-            if not dst in self.stats_ga:
-                self.stats_ga[dst] = {}
-
-            if not flg in self.stats_ga[dst]:
-                self.stats_ga[dst][flg] = 1
-            else:
-                self.stats_ga[dst][flg] = self.stats_ga[dst][flg] + 1
-            self.stats_ga[dst]['last_'+flg] = self.shtime.now()
-
-            # update statistics on used physical addresses
-            if not src in self.stats_pa:
-                self.stats_pa[src] = {}
-
-            if not flg in self.stats_pa[src]:
-                self.stats_pa[src][flg] = 1
-            else:
-                self.stats_pa[src][flg] = self.stats_pa[src][flg] + 1
-            self.stats_pa[src]['last_'+flg] = self.shtime.now()
+            self._update_stats(dst, src, flg)
 
         # further inspect what to do next
-        if flg == 'write' or flg == 'response':
-            if dst not in self.gal:  # update item/logic
-                self._busmonitor(self._bm_format.format(self.get_instance_name(), src, dst, binascii.hexlify(payload).decode()))
+        if flg != KNXREAD:
+            poll = self._polls.get(dst)
+            if poll is not None:
+                # every value counts as response to a poll, even without
+                # knx_listen on the group address
+                poll.value = time.monotonic()
+                if flg == KNXWRITE:
+                    poll.write = poll.value
+            entry = self._gal.get(dst)
+            if entry is None:  # update item/logic
+                if self._bm_logger.isEnabledFor(self._bm_level):
+                    self._busmonitor(self._bm_format.format(self.get_instance_name(), _pa_str(src), _ga_str(dst), binascii.hexlify(payload).decode()))
                 return
-            dpt = self.gal[dst][DPT]
+            ga, dpt, decoder, items, logics = entry
+            if self._read_phase is not None:
+                self._read_answered(ga, typ == KNXD_CACHE_READ)
             try:
-                val = self.decode(payload, dpt)
+                val = decoder(payload)
             except Exception as e:
-                self.logger.exception("Problem decoding frame from {} to {} with '{}' and DPT {}. Exception: {}".format(src, dst, binascii.hexlify(payload).decode(), dpt, e))
+                self.logger.exception("Problem decoding frame from {} to {} with '{}' and DPT {}. Exception: {}".format(_pa_str(src), ga, binascii.hexlify(payload).decode(), dpt, e))
                 return
             if val is not None:
-                self._busmonitor(self._bm_format.format(self.get_instance_name(), src, dst, val))
-                #print "in:  {0}".format(self.decode(payload, 'hex'))
-                #out = ''
-                #for i in self.encode(val, dpt):
-                #    out += " {0:x}".format(i)
-                #print "out:{0}".format(out)
+                if self._bm_logger.isEnabledFor(self._bm_level):
+                    self._busmonitor(self._bm_format.format(self.get_instance_name(), _pa_str(src), ga, val))
 
                 # remove all ga that came from a cache read request
                 if typ == KNXD_CACHE_READ:
-                    if dst in self._cache_ga_response_pending:
-                        self._cache_ga_response_pending.remove(dst)
-                way = "" if typ != KNXD_CACHE_READ else " (from knxd Cache)"
-                self.logger.debug("{} request from {} to {} with '{}' and DPT {}{}".format(flg, src, dst, binascii.hexlify(payload).decode(), dpt, way))
-                src_wrk = self.get_instance_name()
-                if src_wrk != '':
-                    src_wrk += ':'
-                src_wrk += src + ':ga=' + dst
-                for item in self.gal[dst][ITEMS]:
-                    item(val, self.get_shortname(), src_wrk, dst)
-                for logic in self.gal[dst][LOGICS]:
-                    logic.trigger(self.get_shortname(), src_wrk, val, dst)
+                    if ga in self._cache_ga_response_pending:
+                        self._cache_ga_response_pending.remove(ga)
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    way = "" if typ != KNXD_CACHE_READ else " (from knxd Cache)"
+                    self.logger.debug("{} request from {} to {} with '{}' and DPT {}{}".format(FLAGS[flg], _pa_str(src), ga, binascii.hexlify(payload).decode(), dpt, way))
+                src_wrk = self._src_prefix + _pa_str(src) + ':ga=' + ga
+                for item in items:
+                    item(val, self.get_shortname(), src_wrk, ga)
+                for logic in logics:
+                    logic.trigger(self.get_shortname(), src_wrk, val, ga)
             else:
-                self.logger.warning("Wrong payload '{2}' for ga '{1}' with dpt '{0}'.".format(dpt, dst, binascii.hexlify(payload).decode()))
-            if self.enable_stats:
-                if flg == 'write':
-                    self.stats_last_write = self.shtime.now()
-                else:
-                    self.stats_last_response = self.shtime.now()
-        elif flg == 'read':
-            self.logger.debug("{} read {}".format(src, dst))
-            if self.enable_stats:
-                self.stats_last_read = self.shtime.now()
-            if dst in self.gar:  # read item
-                if self.gar[dst][ITEM] is not None:
-                    item = self.gar[dst][ITEM]
-                    self.groupwrite(dst, item(), self.get_iattr_value(item.conf,KNX_DPT), 'response')
-                if self.gar[dst][LOGIC] is not None:
-                    src_wrk = self.get_instance_name()
-                    if src_wrk != '':
-                        src_wrk += ':'
-                    src_wrk += src + ':ga=' + dst
-                    self.gar[dst][LOGIC].trigger(self.get_shortname(), src_wrk, None, dst)
+                self.logger.warning("Wrong payload '{2}' for ga '{1}' with dpt '{0}'.".format(dpt, ga, binascii.hexlify(payload).decode()))
+        else:
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug("{} read {}".format(_pa_str(src), _ga_str(dst)))
+            if dst in self._gar:  # read item
+                ga, entry = self._gar[dst]
+                if entry[ITEM] is not None:
+                    self.groupwrite(ga, entry[ITEM](), entry[DPT], 'response')
+                if entry[LOGIC] is not None:
+                    src_wrk = self._src_prefix + _pa_str(src) + ':ga=' + ga
+                    entry[LOGIC].trigger(self.get_shortname(), src_wrk, None, ga)
+
+    def _update_stats(self, dst, src, flg):
+        """
+        updates the statistics on used group addresses and physical addresses
 
+        The counters and the times (integer seconds of time.monotonic()) of the
+        last telegrams are preallocated arrays indexed by address * 3 + flag
+        index. Every telegram is written to ring buffers, the rates are computed
+        from them on request.
+
+        :param dst: raw group address
+        :param src: raw physical address
+        :param flg: KNXREAD, KNXRESP or KNXWRITE
+        """
+        if self._stats_ring_time is None:
+            self._init_stats()
+        now = time.monotonic()
+        sec = int(now)
+        f = flg >> 6
+        i = dst * 3 + f
+        self._stats_ga_count[i] += 1
+        self._stats_ga_last[i] = sec
+        i = src * 3 + f
+        self._stats_pa_count[i] += 1
+        self._stats_pa_last[i] = sec
+        self._stats_gas.add(dst)
+        self._stats_pas.add(src)
+        self._stats_last[f] = now
+        i = self._stats_n & (STATS_RING - 1)
+        self._stats_ring_ga[i] = dst
+        self._stats_ring_pa[i] = src
+        self._stats_ring_flag[i] = f
+        self._stats_ring_time[i] = sec
+        self._stats_n += 1
+
+    def _init_stats(self, ga=True, pa=True):
+        """
+        allocates (and clears) the counters and ring buffers of the statistics
+        """
+        if ga:
+            self._stats_ga_count = array.array('I', [0]) * (3 * 65536)
+            self._stats_ga_last = array.array('I', [0]) * (3 * 65536)
+            self._stats_gas = set()
+        if pa:
+            self._stats_pa_count = array.array('I', [0]) * (3 * 65536)
+            self._stats_pa_last = array.array('I', [0]) * (3 * 65536)
+            self._stats_pas = set()
+        if ga and pa:
+            self._stats_last = [None, None, None]
+            self._stats_ring_ga = array.array('H', [0]) * STATS_RING
+            self._stats_ring_pa = array.array('H', [0]) * STATS_RING
+            self._stats_ring_flag = array.array('B', [0]) * STATS_RING
+            self._stats_ring_time = array.array('I', [0]) * STATS_RING
+            self._stats_n = 0
+            self._stats_start = time.monotonic()
 
     def run(self):
         """
@@ -395,6 +748,18 @@ class KNX(lib.connection.Client,SmartPlugin):
         """
         self.logger.debug("run method called")
         self.alive = True
+        if self.capture_file:
+            try:
+                self._capture = capture.Capture(self.capture_file, int(self.capture_size * 1024 * 1024), self.capture_backups)
+                self.logger.info("Capturing the frames from knxd to {}".format(self.capture_file))
+                self._sh.scheduler.add('KNX[{0}] capture'.format(self.get_instance_name()), self._capture.flush, prio=5, cycle=capture.FLUSH_INTERVAL)
+            except OSError as e:
+                self.logger.error("Unable to open capture file {}: {}".format(self.capture_file, e))
+        self._start_polls()
+        if self.send_rate:
+            self._sender = threading.Thread(target=self._send_loop, name='KNX[{}] sender'.format(self.get_instance_name()))
+            self._sender.daemon = True
+            self._sender.start()
 
 
     def stop(self):
@@ -403,6 +768,14 @@ class KNX(lib.connection.Client,SmartPlugin):
         """
         self.logger.debug("stop method called")
         self.alive = False
+        self._queue_event.set()
+        if self._sender is not None:
+            self._sender.join(5)
+            self._sender = None
+        if self._capture is not None:
+            self._sh.scheduler.remove('KNX[{0}] capture'.format(self.get_instance_name()))
+            self._capture.close()
+            self._capture = None
         self.close()
 
 
@@ -441,11 +814,7 @@ class KNX(lib.connection.Client,SmartPlugin):
                 knx_listen = [knx_listen, ]
             for ga in knx_listen:
                 self.logger.debug("{} listen on {}".format(item, ga))
-                if not ga in self.gal:
-                    self.gal[ga] = {DPT: dpt, ITEMS: [item], LOGICS: []}
-                else:
-                    if not item in self.gal[ga][ITEMS]:
-                        self.gal[ga][ITEMS].append(item)
+                self._add_listener(ga, dpt, item=item)
 
         if self.has_iattr(item.conf, KNX_INIT):
             ga = self.get_iattr_value(item.conf, KNX_INIT)
@@ -453,12 +822,9 @@ class KNX(lib.connection.Client,SmartPlugin):
             if Utils.get_type(ga) == 'list':
                 self.logger.warning("{} Problem while doing knx_init: Multiple GA specified in item definition, using first GA ({}) for reading value".format(item, ga))
                 ga = ga[0]
-            if not ga in self.gal:
-                self.gal[ga] = {DPT: dpt, ITEMS: [item], LOGICS: []}
-            else:
-                if not item in self.gal[ga][ITEMS]:
-                    self.gal[ga][ITEMS].append(item)
-            self._init_ga.append(ga)
+            ga = self._add_listener(ga, dpt, item=item)
+            if ga is not None:
+                self._init_ga.append(ga)
 
         if self.has_iattr(item.conf, KNX_CACHE):
             ga = self.get_iattr_value(item.conf, KNX_CACHE)
@@ -466,12 +832,9 @@ class KNX(lib.connection.Client,SmartPlugin):
             if Utils.get_type(ga) == 'list':
                 self.logger.warning("{} Problem while reading KNX cache: Multiple GA specified in item definition, using first GA ({}) for reading cache".format(item, ga))
                 ga = ga[0]
-            if not ga in self.gal:
-                self.gal[ga] = {DPT: dpt, ITEMS: [item], LOGICS: []}
-            else:
-                if not item in self.gal[ga][ITEMS]:
-                    self.gal[ga][ITEMS].append(item)
-            self._cache_ga.append(ga)
+            ga = self._add_listener(ga, dpt, item=item)
+            if ga is not None:
+                self._cache_ga.append(ga)
 
         if self.has_iattr(item.conf, KNX_REPLY):
             knx_reply = self.get_iattr_value(item.conf, KNX_REPLY)
@@ -479,11 +842,7 @@ class KNX(lib.connection.Client,SmartPlugin):
                 knx_reply = [knx_reply, ]
             for ga in knx_reply:
                 self.logger.debug("{} reply to {}".format(item, ga))
-                if ga not in self.gar:
-                    self.gar[ga] = {DPT: dpt, ITEM: item, LOGIC: None}
-                else:
-                    self.logger.warning(
-                        "{} knx_reply ({}) already defined for {}".format( item.id(), ga, self.gar[ga][ITEM]))
+                self._add_reply(ga, {DPT: dpt, ITEM: item, LOGIC: None})
 
         if self.has_iattr(item.conf, KNX_SEND):
             if isinstance(self.get_iattr_value(item.conf, KNX_SEND), str):
@@ -499,14 +858,11 @@ class KNX(lib.connection.Client,SmartPlugin):
                 knx_poll = [knx_poll, ]
             if len(knx_poll) == 2:
                 poll_ga = knx_poll[0]
-                poll_interval = knx_poll[1]
+                poll_interval = int(knx_poll[1])
 
                 self.logger.info(
                     "Item {} is polled on GA {} every {} seconds".format(item, poll_ga, poll_interval))
-                randomwait = random.randrange(15)
-                next = self.shtime.now() + timedelta(seconds=poll_interval + randomwait)
-                self._sh.scheduler.add('KNX poll {}'.format(item), self._poll,
-                                       value={ITEM: item, 'ga': poll_ga, 'interval': poll_interval}, next=next)
+                self._add_poll(poll_ga, poll_interval)
             else:
                 self.logger.warning(
                     "Ignoring knx_poll for item {}: We need two parameters, one for the GA and one for the polling interval.".format(
@@ -539,10 +895,7 @@ class KNX(lib.connection.Client,SmartPlugin):
                 knx_listen = [knx_listen, ]
             for ga in knx_listen:
                 self.logger.debug("{} listen on {}".format(logic, ga))
-                if not ga in self.gal:
-                    self.gal[ga] = {DPT: dpt, ITEMS: [], LOGICS: [logic]}
-                else:
-                    self.gal[ga][LOGICS].append(logic)
+                self._add_listener(ga, dpt, logic=logic)
 
         if KNX_REPLY in logic.conf:
             knx_reply = logic.conf[KNX_REPLY]
@@ -550,14 +903,54 @@ class KNX(lib.connection.Client,SmartPlugin):
                 knx_reply = [knx_reply, ]
             for ga in knx_reply:
                 self.logger.debug("{} reply to {}".format(logic, ga))
-                if ga in self.gar:
-                    if self.gar[ga][LOGIC] is False:
-                        obj = self.gar[ga][ITEM]
-                    else:
-                        obj = self.gar[ga][LOGIC]
-                    self.logger.warning("{} knx_reply ({}) already defined for {}".format(logic, ga, obj))
-                else:
-                    self.gar[ga] = {DPT: dpt, ITEM: None, LOGIC: logic}
+                self._add_reply(ga, {DPT: dpt, ITEM: None, LOGIC: logic})
+
+    def _add_listener(self, ga, dpt, item=None, logic=None):
+        """
+        Adds an item or a logic to the group addresses to listen to
+
+        The entry of the dispatch table is keyed by the raw group address and
+        references the decoder and the lists of items and logics of self.gal,
+        so parse_telegram does not need to convert or look up anything else.
+        Both tables are keyed by the normalized group address (x/y/z), so all
+        spellings of a group address (e.g. 1/2/3 and 1/2/03) share one entry.
+
+        :return: the normalized group address, None if it is invalid
+        """
+        try:
+            raw = _ga_int(ga)
+        except (ValueError, IndexError):
+            self.logger.warning("Ignoring invalid group address {} for {}".format(ga, item if logic is None else logic))
+            return None
+        ga = _ga_str(raw)
+        if not ga in self.gal:
+            self.gal[ga] = {DPT: dpt, ITEMS: [], LOGICS: []}
+            decoder = dpts.table_decoder(dpt) if self.dpt_tables else dpts.decode[str(dpt)]
+            self._gal[raw] = (ga, dpt, decoder, self.gal[ga][ITEMS], self.gal[ga][LOGICS])
+        if item is not None and not item in self.gal[ga][ITEMS]:
+            self.gal[ga][ITEMS].append(item)
+        if logic is not None and not logic in self.gal[ga][LOGICS]:
+            self.gal[ga][LOGICS].append(logic)
+        return ga
+
+    def _add_reply(self, ga, entry):
+        """
+        Adds an entry to the group addresses to reply to, keyed by the
+        normalized group address string (x/y/z) and by the raw group address
+        """
+        obj = entry[ITEM] if entry[LOGIC] is None else entry[LOGIC]
+        try:
+            raw = _ga_int(ga)
+        except (ValueError, IndexError):
+            self.logger.warning("Ignoring invalid group address {} for {}".format(ga, obj))
+            return
+        ga = _ga_str(raw)
+        if ga in self.gar:
+            other = self.gar[ga][ITEM] if self.gar[ga][LOGIC] is None else self.gar[ga][LOGIC]
+            self.logger.warning("{} knx_reply ({}) already defined for {}".format(obj, ga, other))
+            return
+        self.gar[ga] = entry
+        self._gar[raw] = (ga, entry)
 
 
     def update_item(self, item, caller=None, source=None, dest=None):
@@ -661,24 +1054,43 @@ class KNX(lib.connection.Client,SmartPlugin):
         """
         clear all statistic values
         """
-        self.clear_stats_ga()
-        self.clear_stats_pa()
+        self._init_stats()
 
     def clear_stats_ga(self):
         """
         clear statistic values for group addresses
         """
-        if len(self.stats_ga):
-            for ga in self.stats_ga:
-                self.stats_ga[ga] = {}
+        if self._stats_ring_time is not None:
+            self._init_stats(pa=False)
 
     def clear_stats_pa(self):
         """
         clear statistic values for physical addresses
         """
-        if len(self.stats_pa):
-            for ga in self.stats_pa:
-                self.stats_pa[ga] = {}
+        if self._stats_ring_time is not None:
+            self._init_stats(ga=False)
+
+    def _stats_time(self, mono):
+        """
+        converts a time.monotonic() value of the statistics to a datetime
+        """
+        if mono is None:
+            return None
+        return self.shtime.now() - timedelta(seconds=time.monotonic() - mono)
+
+    def _get_stats(self, addresses, counts, lasts, name):
+        result = {}
+        if self._stats_ring_time is None:
+            return result
+        for address in list(addresses):
+            stats = {}
+            for f, flag in enumerate(FLAG_NAMES):
+                i = address * 3 + f
+                if counts[i]:
+                    stats[flag] = counts[i]
+                    stats['last_' + flag] = self._stats_time(lasts[i])
+            result[name(address)] = stats
+        return result
 
     def get_stats_ga(self):
         """
@@ -692,9 +1104,12 @@ class KNX(lib.connection.Client,SmartPlugin):
                              'last_response' : datetime },  # and response
                      ga2 : {...} }
         ```
+        Counters (and times) of kinds of requests which did not occur yet are omitted.
         :return: dict
         """
-        return self.stats_ga
+        if self._stats_ring_time is None:
+            return {}
+        return self._get_stats(self._stats_gas, self._stats_ga_count, self._stats_ga_last, _ga_str)
 
     def get_stats_pa(self):
         """
@@ -708,37 +1123,100 @@ class KNX(lib.connection.Client,SmartPlugin):
                              'last_response' : datetime },  # and response
                      pa2 : {...} }
         ```
+        Counters (and times) of kinds of requests which did not occur yet are omitted.
         :return: dict
         """
-        return self.stats_pa
+        if self._stats_ring_time is None:
+            return {}
+        return self._get_stats(self._stats_pas, self._stats_pa_count, self._stats_pa_last, _pa_str)
+
+    def get_stats_rates(self, key='pa'):
+        """
+        returns the telegram rates (telegrams/s) within the windows of STATS_WINDOWS
+        (the last minute, 15 minutes and hour) per source, group address or flag
+        ```
+        { pa1 : [rate 1 min, rate 15 min, rate 1 h], pa2 : [...] }
+        ```
+        :param key: 'pa' (physical address of the source), 'ga' (group address) or 'flag' (read, write, response)
+        :return: dict
+        """
+        result = {}
+        if self._stats_ring_time is None:
+            return result
+        if key == 'ga':
+            ring, name = self._stats_ring_ga, _ga_str
+        elif key == 'pa':
+            ring, name = self._stats_ring_pa, _pa_str
+        else:
+            ring, name = self._stats_ring_flag, FLAG_NAMES.__getitem__
+        now = time.monotonic()
+        n = self._stats_n
+        # the telegrams in the order received
+        if n <= STATS_RING:
+            times = self._stats_ring_time[:n]
+            keys = ring[:n]
+        else:
+            i = n & (STATS_RING - 1)
+            times = self._stats_ring_time[i:] + self._stats_ring_time[:i]
+            keys = ring[i:] + ring[:i]
+        for w, window in enumerate(STATS_WINDOWS):
+            start = bisect.bisect_right(times, int(now) - window)
+            span = min(window, now - self._stats_start)
+            if n > STATS_RING and start == 0:
+                # the ring buffer does not cover the whole window
+                span = min(span, now - times[0])
+            span = max(span, 1)
+            for k, count in collections.Counter(keys[start:]).items():
+                result.setdefault(name(k), [0.0] * len(STATS_WINDOWS))[w] = count / span
+        return result
+
+    def get_stats_top(self, key='pa', count=10):
+        """
+        returns the top talkers: the sources (or group addresses) with the highest
+        telegram rates in the last minute (then 15 minutes and hour)
+        ```
+        [ (pa1, [rate 1 min, rate 15 min, rate 1 h]), (pa2, [...]), ... ]
+        ```
+        :param key: 'pa' (physical address of the source) or 'ga' (group address)
+        :param count: maximum number of entries
+        :return: list
+        """
+        rates = self.get_stats_rates(key)
+        return sorted(rates.items(), key=lambda entry: entry[1], reverse=True)[:count]
 
     def get_stats_last_read(self):
         """
         return the time of the last read request on KNX
         :return: datetime of last time read
         """
-        return self.stats_last_read
+        if self._stats_ring_time is None:
+            return None
+        return self._stats_time(self._stats_last[KNXREAD >> 6])
 
     def get_stats_last_write(self):
         """
         return the time of the last write request on KNX
         :return: datetime of last time write
         """
-        return self.stats_last_write
+        if self._stats_ring_time is None:
+            return None
+        return self._stats_time(self._stats_last[KNXWRITE >> 6])
 
     def get_stats_last_response(self):
         """
         return the time of the last response on KNX
         :return: datetime of last response write
         """
-        return self.stats_last_response
+        if self._stats_ring_time is None:
+            return None
+        return self._stats_time(self._stats_last[KNXRESP >> 6])
 
     def get_stats_last_action(self):
         """
         gives back the last point in time when a telegram from KNX arrived
         :return: datetime of last time
         """
-        ar = [ self.stats_last_response, self.stats_last_write, self.stats_last_read ]
+        ar = [ self.get_stats_last_response(), self.get_stats_last_write(), self.get_stats_last_read() ]
         while None in ar:
             ar.remove(None)
         if ar == []:
@@ -746,6 +1224,67 @@ class KNX(lib.connection.Client,SmartPlugin):
         else:
             return max(ar)
 
+    def get_send_stats(self):
+        """
+        returns a dict with the statistics of the send queue
+        ```
+        { 'depth' : n,          # telegrams currently waiting in the queue
+          'max_depth' : n,      # maximum number of telegrams waiting in the queue
+          'sent' : n,           # telegrams sent by the queue
+          'coalesced' : n,      # telegrams replaced by a newer telegram to the same group address
+          'latency_avg' : s,    # average time in seconds between queueing and sending a telegram
+          'latency_max' : s }   # maximum time in seconds between queueing and sending a telegram
+        ```
+        :return: dict
+        """
+        stats = self.send_stats
+        return {'depth': len(self._queue_pending), 'max_depth': stats['max_depth'],
+                'sent': stats['sent'], 'coalesced': stats['coalesced'],
+                'latency_avg': stats['latency_sum'] / stats['sent'] if stats['sent'] else 0.0,
+                'latency_max': stats['latency_max']}
+
+    def get_poll_stats(self):
+        """
+        returns a dict with the statistics of the poll engine
+        ```
+        { 'gas' : n,            # polled group addresses
+          'polls' : n,          # group reads sent
+          'skipped' : n,        # polls skipped, because a device sent a value within the interval
+          'late' : n,           # polls sent POLL_LATE seconds or more after they were due (bus load budget)
+          'missed' : n,         # polls without response until the next poll was due
+          'due' : n }           # polls due, but not sent yet
+        ```
+        :return: dict
+        """
+        stats = dict(self.poll_stats)
+        stats['gas'] = len(self._polls)
+        now = time.monotonic()
+        stats['due'] = len([due for due, ga in self._poll_heap if due <= now])
+        return stats
+
+    def get_read_stats(self):
+        """
+        returns a dict with the progress of the reads at startup
+        ```
+        { 'phase' : phase,      # 'cache' (reading the knxd cache), 'init' (group reads) or None (finished)
+          'cache' : n,          # group addresses read from the knxd cache
+          'cache_values' : n,   # group addresses with a value in the knxd cache
+          'reads' : n,          # group reads (knx_init and cached group addresses without value)
+          'responses' : n,      # answered group reads
+          'retries' : n,        # requests sent again after READ_TIMEOUT seconds
+          'failed' : n,         # group reads without response
+          'waiting' : n,        # requests not sent or not answered yet
+          'duration' : s }      # seconds since the start (or duration if finished)
+        ```
+        :return: dict
+        """
+        stats = dict(self.read_stats)
+        stats['phase'] = self._read_phase
+        stats['waiting'] = len(self._read_todo) + len(self._read_outstanding)
+        if self._read_phase is not None and self._read_start is not None:
+            stats['duration'] = time.monotonic() - self._read_start
+        return stats
+
     def get_unsatisfied_cache_read_ga(self):
         """
         At start all items that have a knx_cache attribute will be queried to knxd
@@ -827,13 +1366,23 @@ class WebInterface(SmartPluginWebIf):
             if any(elem in item.property.attributes  for elem in [KNX_DPT,KNX_STATUS,KNX_SEND,KNX_REPLY,KNX_CACHE,KNX_INIT,KNX_LISTEN,KNX_POLL]):
                 plgitems.append(item)
 
+        stats_ga = self.plugin.get_stats_ga()
+        stats_pa = self.plugin.get_stats_pa()
+
         tmpl = self.tplenv.get_template('index.html')
         # add values to be passed to the Jinja2 template eg: tmpl.render(p=self.plugin, interface=interface, ...)
         return tmpl.render(p=self.plugin,
                            items=sorted(plgitems, key=lambda k: str.lower(k['_path'])),
                            knxdeamon=self.knxdeamon,
-                           stats_ga=self.plugin.get_stats_ga(), stats_ga_list=sorted(self.plugin.get_stats_ga(), key=lambda k: str(int(k.split('/')[0])+100)+str(int(k.split('/')[1])+100)+str(int(k.split('/')[2])+1000) ),
-                           stats_pa=self.plugin.get_stats_pa(), stats_pa_list=sorted(self.plugin.get_stats_pa(), key=lambda k: str(int(k.split('.')[0])+100)+str(int(k.split('.')[1])+100)+str(int(k.split('.')[2])+1000) )
+                           send_stats=self.plugin.get_send_stats(),
+                           read_stats=self.plugin.get_read_stats(),
+                           poll_stats=self.plugin.get_poll_stats(),
+                           stats_windows=STATS_WINDOWS,
+                           stats_flags=self.plugin.get_stats_rates('flag'),
+                           top_pa=self.plugin.get_stats_top('pa'),
+                           top_ga=self.plugin.get_stats_top('ga'),
+                           stats_ga=stats_ga, stats_ga_list=sorted(stats_ga, key=lambda k: str(int(k.split('/')[0])+100)+str(int(k.split('/')[1])+100)+str(int(k.split('/')[2])+1000) ),
+                           stats_pa=stats_pa, stats_pa_list=sorted(stats_pa, key=lambda k: str(int(k.split('.')[0])+100)+str(int(k.split('.')[1])+100)+str(int(k.split('.')[2])+1000) )
                           )
 
 
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# vim: set encoding=utf-8 tabstop=4 softtabstop=4 shiftwidth=4 expandtab
+#########################################################################
+#  This file is part of SmartHomeNG.
+#
+#  SmartHomeNG is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  SmartHomeNG is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with SmartHomeNG.  If not, see <http://www.gnu.org/licenses/>.
+#########################################################################
+
+"""
+Binary capture of the frames received from knxd
+
+A capture file starts with MAGIC, followed by one record per frame: the time
+(seconds since the epoch as double) and the length of the frame (unsigned
+short), both big endian, and the frame as received from knxd without its
+length prefix (the data passed to parse_telegram).
+"""
+
+import os
+import struct
+import threading
+import time
+
+MAGIC = b'KNXCAP1\n'
+RECORD = struct.Struct('>dH')
+
+FLUSH_INTERVAL = 1      # seconds between flushes of the write buffer
+
+
+class Capture():
+    """
+    Appends frames to a capture file, which is rotated like a RotatingFileHandler
+    of the logging module: if the file exceeds max_bytes, it is renamed to
+    filename.1 (filename.1 to filename.2 and so on, up to backups files).
+
+    write only appends to the buffered file, flush has to be called
+    periodically (the plugin does so every FLUSH_INTERVAL seconds).
+    """
+
+    def __init__(self, filename, max_bytes=10 * 1024 * 1024, backups=3):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.frames = 0
+        self._lock = threading.Lock()
+        self._file = None
+        self._open()
+
+    def _open(self):
+        self._file = open(self.filename, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+            self._file.flush()
+
+    def write(self, data, timestamp=None):
+        """
+        appends a frame to the capture file
+
+        :param data: frame as received from knxd, without the length prefix
+        :param timestamp: time of the frame, defaults to the current time
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(RECORD.pack(timestamp, len(data)))
+            self._file.write(data)
+            self.frames += 1
+
+    def flush(self):
+        """
+        writes the buffered frames to the capture file and rotates it, if it
+        exceeds max_bytes
+        """
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.flush()
+            if self.max_bytes and self._file.tell() >= self.max_bytes:
+                self._rotate()
+
+    def _rotate(self):
+        self._file.close()
+        for n in range(self.backups - 1, 0, -1):
+            name = '{}.{}'.format(self.filename, n)
+            if os.path.exists(name):
+                os.replace(name, '{}.{}'.format(self.filename, n + 1))
+        if self.backups > 0:
+            os.replace(self.filename, self.filename + '.1')
+        else:
+            os.remove(self.filename)
+        self._open()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def read(filename):
+    """
+    generator of the frames of a capture file
+
+    :param filename: name of the capture file
+    :return: tuples of the time and the frame
+    """
+    with open(filename, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is no knx capture file".format(filename))
+        while True:
+            record = f.read(RECORD.size)
+            if len(record) < RECORD.size:
+                return
+            timestamp, length = RECORD.unpack(record)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield timestamp, data
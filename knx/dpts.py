@@ -155,17 +155,18 @@ def de8(payload):
     For all Datapoint Types 9.xxx, the encoded value 7FFFh shall always be used to denote invalid data.
 """
 
-def en9(value):
+def _en9(value):
     s = 0
-    e = 0
     if value < 0:
         s = 0x8000
     m = int(value * 100)
-    while (m > 2047) or (m < -2048):
-        e = e + 1
-        m = m >> 1
-    num = s | (e << 11) | (int(m) & 0x07ff)
-    return en7(num)
+    # the exponent is the number of shifts needed to fit the mantissa into 11 bits (plus sign)
+    e = max(0, (m if m >= 0 else ~m).bit_length() - 11)
+    return s | (e << 11) | ((m >> e) & 0x07ff)
+
+
+def en9(value):
+    return en7(_en9(value))
 
 
 def de9(payload):
@@ -493,3 +494,116 @@ encode = {
     'ga': enga
 }
 # DPT: 19, 28
+
+
+"""
+    Table driven codecs
+
+    The values of the DPTs with a payload of 1 or 2 bytes are looked up in
+    tables with 256 or 65536 entries. A table is built from the decode function
+    of the DPT when it is used first.
+
+    decode_many and encode_many convert concatenated payloads (without the
+    APCI byte) of a DPT with a fixed payload size at once.
+"""
+
+TABLE_DPTS = {'5': 1, '5001': 1, '5.001': 1, '6': 1, '9': 2}
+
+# payload size (without the APCI byte) of the DPTs supported by decode_many and encode_many
+SIZES = {
+    '1': 1, '2': 1, '3': 1, '4002': 1, '4.002': 1, '5': 1, '5001': 1, '5.001': 1, '6': 1,
+    '7': 2, '8': 2, '9': 2, '10': 3, '11': 3, '12': 4, '13': 4, '14': 4,
+    '16000': 14, '16': 14, '16001': 14, '16.001': 14, '17': 1, '17001': 1, '17.001': 1,
+    '18001': 1, '18.001': 1, '20': 1, '229': 6, '232': 3, '275.100': 8
+}
+
+_tables = {}
+
+
+def table(dpt):
+    """
+    returns the decoded values of all payloads of a DPT listed in TABLE_DPTS,
+    indexed by the payload as (big endian) integer
+    """
+    dpt = str(dpt)
+    values = _tables.get(dpt)
+    if values is None:
+        size = TABLE_DPTS[dpt]
+        func = decode[dpt]
+        values = tuple(func(code.to_bytes(size, 'big')) for code in range(1 << 8 * size))
+        _tables[dpt] = values
+    return values
+
+
+def table_decoder(dpt):
+    """
+    returns a decode function for the DPT, which looks up the value in the
+    table of the DPT (or the decode function itself, if there is no table)
+    """
+    dpt = str(dpt)
+    if dpt not in TABLE_DPTS:
+        return decode[dpt]
+    values = table(dpt)
+    if TABLE_DPTS[dpt] == 1:
+        def detable(payload):
+            if len(payload) != 1:
+                return None
+            return values[payload[0]]
+    else:
+        def detable(payload):
+            if len(payload) != 2:
+                return None
+            return values[payload[0] << 8 | payload[1]]
+    return detable
+
+
+def decode_many(dpt, data):
+    """
+    decodes concatenated payloads of a DPT
+
+    :param dpt: DPT with a fixed payload size (see SIZES)
+    :param data: bytes, bytearray or memoryview with the payloads
+    :return: list of the decoded values
+    """
+    dpt = str(dpt)
+    size = SIZES[dpt]
+    if len(data) % size:
+        raise ValueError("length of data ({}) is not a multiple of the payload size {} of DPT {}".format(len(data), size, dpt))
+    count = len(data) // size
+    if dpt == '7':
+        return list(struct.unpack('>{}H'.format(count), data))
+    if dpt == '8':
+        return list(struct.unpack('>{}h'.format(count), data))
+    if dpt in TABLE_DPTS:
+        values = table(dpt)
+        if size == 1:
+            return [values[code] for code in bytes(data)]
+        return [values[code] for code in struct.unpack('>{}H'.format(count), data)]
+    func = decode[dpt]
+    data = bytes(data)
+    return [func(data[i:i + size]) for i in range(0, len(data), size)]
+
+
+def encode_many(dpt, values):
+    """
+    encodes values of a DPT to concatenated payloads
+
+    :param dpt: DPT with a fixed payload size (see SIZES)
+    :param values: sequence of the values
+    :return: bytes with the payloads
+    """
+    dpt = str(dpt)
+    size = SIZES[dpt]
+    if dpt in ('7', '8', '9'):
+        if dpt == '9':
+            codes = [_en9(value) for value in values]
+        elif dpt == '8':
+            codes = [int(min(max(value, -32768), 32767)) for value in values]
+        else:
+            codes = [int(value) for value in values]
+        return struct.pack('>{}{}'.format(len(codes), 'h' if dpt == '8' else 'H'), *codes)
+    func = encode[dpt]
+    data = bytearray()
+    for value in values:
+        data.extend(func(value)[-size:])
+    return bytes(data)
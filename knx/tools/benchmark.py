@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# vim: set encoding=utf-8 tabstop=4 softtabstop=4 shiftwidth=4 expandtab
+#########################################################################
+#  This file is part of SmartHomeNG.
+#
+#  SmartHomeNG is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  SmartHomeNG is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with SmartHomeNG. If not, see <http://www.gnu.org/licenses/>.
+#########################################################################
+
+
+"""
+Replays recorded-like knxd telegrams through parse_telegram of the knx plugin
+and measures the telegrams per second, compared to the implementation looking
+up every group address as string (as done before the dispatch table keyed by
+the raw group address was introduced).
+
+With --stats the statistics are enabled for both implementations, the former
+statistics keep the counters in dicts keyed by the addresses as strings and
+take the time of every telegram from shtime.
+
+With --capture the generated telegrams are written to a capture file (100
+telegrams/s), which can be replayed by replay.py.
+
+The telegrams are generated: writes to group addresses items listen to
+(DPT 1, 5.001 and 9) mixed with telegrams to unknown group addresses, which
+only go to the bus monitor. Run it from the base directory of SmartHomeNG:
+
+    python3 plugins/knx/tools/benchmark.py --telegrams 200000 --stats
+"""
+
+import argparse
+import binascii
+import logging
+import os
+import random
+import struct
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..'))
+
+from plugins.knx import KNX, dpts, capture, KNXD_GROUP_PACKET, KNXD_CACHE_READ, KNXREAD, KNXRESP, KNXWRITE, DPT, ITEMS, LOGICS
+
+
+class Item():
+
+    def __init__(self, path, conf):
+        self._path = path
+        self._value = None
+        self.conf = conf
+
+    def __call__(self, value=None, caller=None, source=None, dest=None):
+        if value is None:
+            return self._value
+        self._value = value
+
+    def __str__(self):
+        return self._path
+
+    def id(self):
+        return self._path
+
+
+class Shtime():
+
+    def now(self):
+        return datetime.now().astimezone()
+
+
+def legacy_update_stats(self, dst, src, flg):
+    # the former implementation of _update_stats
+    if not dst in self.stats_ga:
+        self.stats_ga[dst] = {}
+    if not flg in self.stats_ga[dst]:
+        self.stats_ga[dst][flg] = 1
+    else:
+        self.stats_ga[dst][flg] = self.stats_ga[dst][flg] + 1
+    self.stats_ga[dst]['last_'+flg] = self.shtime.now()
+    if not src in self.stats_pa:
+        self.stats_pa[src] = {}
+    if not flg in self.stats_pa[src]:
+        self.stats_pa[src][flg] = 1
+    else:
+        self.stats_pa[src][flg] = self.stats_pa[src][flg] + 1
+    self.stats_pa[src]['last_'+flg] = self.shtime.now()
+
+
+def legacy_parse_telegram(self, data):
+    # the former implementation of parse_telegram
+    self.found_terminator = self.parse_length  # reset parser and terminator
+    self.terminator = 2
+    typ = struct.unpack(">H", data[0:2])[0]
+    if (typ != KNXD_GROUP_PACKET and typ != KNXD_CACHE_READ) or len(data) < 8:
+        return
+    if (data[6] & 0x03 or (data[7] & 0xC0) == 0xC0):
+        self.logger.debug("Unknown APDU")
+        return
+    src = self.decode(data[2:4], 'pa')
+    dst = self.decode(data[4:6], 'ga')
+    flg = data[7] & 0xC0
+    if flg == KNXWRITE:
+        flg = 'write'
+    elif flg == KNXREAD:
+        flg = 'read'
+    elif flg == KNXRESP:
+        flg = 'response'
+    else:
+        self.logger.warning("Unknown flag: {:02x} src: {} dest: {}".format(flg, src, dst))
+        return
+    if self.enable_stats:
+        legacy_update_stats(self, dst, src, flg)
+    if len(data) == 8:
+        payload = bytearray([data[7] & 0x3f])
+    else:
+        payload = data[8:]
+    if flg == 'write' or flg == 'response':
+        if dst not in self.gal:  # update item/logic
+            self._busmonitor(self._bm_format.format(self.get_instance_name(), src, dst, binascii.hexlify(payload).decode()))
+            return
+        dpt = self.gal[dst][DPT]
+        try:
+            val = self.decode(payload, dpt)
+        except Exception as e:
+            self.logger.exception("Problem decoding frame from {} to {} with '{}' and DPT {}. Exception: {}".format(src, dst, binascii.hexlify(payload).decode(), dpt, e))
+            return
+        if val is not None:
+            self._busmonitor(self._bm_format.format(self.get_instance_name(), src, dst, val))
+            if typ == KNXD_CACHE_READ:
+                if dst in self._cache_ga_response_pending:
+                    self._cache_ga_response_pending.remove(dst)
+            way = "" if typ != KNXD_CACHE_READ else " (from knxd Cache)"
+            self.logger.debug("{} request from {} to {} with '{}' and DPT {}{}".format(flg, src, dst, binascii.hexlify(payload).decode(), dpt, way))
+            src_wrk = self.get_instance_name()
+            if src_wrk != '':
+                src_wrk += ':'
+            src_wrk += src + ':ga=' + dst
+            for item in self.gal[dst][ITEMS]:
+                item(val, self.get_shortname(), src_wrk, dst)
+            for logic in self.gal[dst][LOGICS]:
+                logic.trigger(self.get_shortname(), src_wrk, val, dst)
+            if self.enable_stats:
+                if flg == 'write':
+                    self.legacy_last_write = self.shtime.now()
+                else:
+                    self.legacy_last_response = self.shtime.now()
+    elif self.enable_stats:
+        self.legacy_last_read = self.shtime.now()
+
+
+def create_plugin(tables=False):
+    # the plugin is set up without the connection to knxd and the web interface
+    plugin = KNX.__new__(KNX)
+    plugin.logger = logging.getLogger(__name__)
+    plugin.gal = {}
+    plugin.gar = {}
+    plugin._gal = {}
+    plugin._gar = {}
+    plugin._init_ga = []
+    plugin._cache_ga = []
+    plugin._cache_ga_response_pending = []
+    plugin._read_phase = None
+    plugin._polls = {}
+    plugin._capture = None
+    plugin._bm_format = "BM': {1} set {2} to {3}"
+    plugin._bm_logger = plugin.logger
+    plugin._bm_level = logging.DEBUG
+    plugin._busmonitor = plugin.logger.debug
+    plugin._src_prefix = ''
+    plugin.enable_stats = False
+    plugin.stats_ga = {}
+    plugin.stats_pa = {}
+    plugin.shtime = Shtime()
+    plugin._stats_ring_time = None
+    plugin.dpt_tables = tables
+    plugin.get_instance_name = lambda: ''
+    plugin.get_shortname = lambda: 'knx'
+    return plugin
+
+
+def telegram(src, ga, payload):
+    data = bytearray(struct.pack('>HHH', KNXD_GROUP_PACKET, src, ga))
+    if len(payload) == 1 and payload[0] <= 0x3f:
+        data.extend([0, KNXWRITE | payload[0]])
+    else:
+        data.extend([0, KNXWRITE])
+        data.extend(payload)
+    return data
+
+
+def create_telegrams(plugin, count, gas, unknown):
+    conf = [('1', 1), ('5.001', 80), ('9', 21.5)]
+    known = []
+    for n in range(gas):
+        dpt, value = conf[n % len(conf)]
+        ga = "{}/{}/{}".format(1 + n // 2048, n // 256 % 8, n % 256)
+        item = Item('bench.item{}'.format(n), {'knx_dpt': dpt, 'knx_listen': ga})
+        plugin.parse_item(item)
+        known.append((dpts.enga(ga), dpts.encode[dpt](value)[1:] if dpt != '1' else dpts.encode[dpt](value)))
+
+    rnd = random.Random(0)
+    telegrams = []
+    for n in range(count):
+        src = 0x1100 | rnd.randrange(64)
+        if rnd.random() < unknown:
+            raw = 0x7800 | rnd.randrange(0x800)
+            telegrams.append(telegram(src, raw, bytearray([rnd.randrange(256), rnd.randrange(256)])))
+        else:
+            ga, payload = known[rnd.randrange(len(known))]
+            telegrams.append(telegram(src, ga[0] << 8 | ga[1], bytearray(payload)))
+    return telegrams
+
+
+def measure(name, parse, telegrams):
+    start = time.perf_counter()
+    for data in telegrams:
+        parse(data)
+    duration = time.perf_counter() - start
+    print("{:<16} {:>10.0f} telegrams/s".format(name + ':', len(telegrams) / duration))
+    return duration / len(telegrams)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay benchmark of parse_telegram of the knx plugin")
+    parser.add_argument('--telegrams', type=int, default=200000, help="number of telegrams to replay")
+    parser.add_argument('--gas', type=int, default=500, help="number of group addresses items listen to")
+    parser.add_argument('--unknown', type=float, default=0.3, help="share of telegrams to unknown group addresses")
+    parser.add_argument('--tables', action='store_true', help="use the table driven decoders (parameter dpt_tables)")
+    parser.add_argument('--stats', action='store_true', help="measure the cost of the statistics (parameter enable_stats)")
+    parser.add_argument('--capture', metavar='FILE', help="write the generated telegrams to a capture file")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    plugin = create_plugin(args.tables)
+    telegrams = create_telegrams(plugin, args.telegrams, args.gas, args.unknown)
+    if args.capture:
+        cap = capture.Capture(args.capture, 0)
+        start = time.time()
+        for n, data in enumerate(telegrams):
+            cap.write(data, start + n / 100)
+        cap.close()
+        print("{} telegrams written to {}".format(len(telegrams), args.capture))
+
+    legacy = measure('legacy', lambda data: legacy_parse_telegram(plugin, data), telegrams)
+    dispatch = measure('dispatch', plugin.parse_telegram, telegrams)
+    if args.stats:
+        plugin.enable_stats = True
+        legacy_stats = measure('legacy stats', lambda data: legacy_parse_telegram(plugin, data), telegrams)
+        dispatch_stats = measure('dispatch stats', plugin.parse_telegram, telegrams)
+        print("statistics per telegram: legacy {:.2f} us, dispatch {:.2f} us".format((legacy_stats - legacy) * 1e6, (dispatch_stats - dispatch) * 1e6))
+        counters = lambda stats: {address: {flag: n for flag, n in entry.items() if not flag.startswith('last_')} for address, entry in stats.items()}
+        if counters(plugin.stats_ga) != counters(plugin.get_stats_ga()) or counters(plugin.stats_pa) != counters(plugin.get_stats_pa()):
+            print("counters differ")
+        print("{} group addresses, {} sources, top talker: {}".format(len(plugin.stats_ga), len(plugin.stats_pa), plugin.get_stats_top('pa', 1)))
+
+
+if __name__ == '__main__':
+    main()
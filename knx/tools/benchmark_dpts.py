@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# vim: set encoding=utf-8 tabstop=4 softtabstop=4 shiftwidth=4 expandtab
+#########################################################################
+#  This file is part of SmartHomeNG.
+#
+#  SmartHomeNG is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  SmartHomeNG is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with SmartHomeNG. If not, see <http://www.gnu.org/licenses/>.
+#########################################################################
+
+
+"""
+Checks the table driven codecs of the knx dpts module against the decode and
+encode functions of the DPTs and measures the values per second of both.
+
+The checks compare
+- the table of every DPT in TABLE_DPTS with the decode function for all payloads
+- decode_many with the decode function for random payloads
+- encode_many with the encode function (and the loop based DPT 9 encoder used
+  before) for random values
+- the round trip decode_many(encode_many(values)) with decode(encode(value))
+
+The script exits with status 1 if a check fails. Run it from the base directory
+of SmartHomeNG:
+
+    python3 plugins/knx/tools/benchmark_dpts.py --values 100000
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..'))
+
+from plugins.knx import dpts
+
+
+def legacy_en9(value):
+    # the former implementation of dpts.en9
+    s = 0
+    e = 0
+    if value < 0:
+        s = 0x8000
+    m = int(value * 100)
+    while (m > 2047) or (m < -2048):
+        e = e + 1
+        m = m >> 1
+    num = s | (e << 11) | (int(m) & 0x07ff)
+    return dpts.en7(num)
+
+
+# generators of random values for the encode checks
+VALUES = {
+    '5': lambda rnd: rnd.randrange(-10, 266),
+    '5.001': lambda rnd: rnd.uniform(-1, 101),
+    '6': lambda rnd: rnd.randrange(-140, 140),
+    '7': lambda rnd: rnd.randrange(0, 65536),
+    '8': lambda rnd: rnd.randrange(-40000, 40000),
+    '9': lambda rnd: round(rnd.uniform(-671088.64, 670760.96) / 10 ** rnd.randrange(7), 2),
+    '12': lambda rnd: rnd.randrange(0, 1 << 32),
+    '13': lambda rnd: rnd.randrange(-(1 << 31), 1 << 31),
+    '232': lambda rnd: [rnd.randrange(256) for i in range(3)],
+}
+
+# DPTs whose decode functions accept any payload of their size
+DECODE_DPTS = ['1', '2', '3', '5', '5001', '5.001', '6', '7', '8', '9', '12', '13', '14', '17', '17001', '18001', '20', '229', '232', '275.100']
+
+
+def same(a, b):
+    # NaN of DPT 14 are equal for the checks
+    return a == b or (a != a and b != b)
+
+
+def check(rnd, count):
+    failed = 0
+    for dpt in dpts.TABLE_DPTS:
+        size = dpts.TABLE_DPTS[dpt]
+        values = dpts.table(dpt)
+        wrong = [code for code in range(1 << 8 * size) if values[code] != dpts.decode[dpt](code.to_bytes(size, 'big'))]
+        failed += report("table of DPT {}".format(dpt), wrong)
+
+    for dpt in DECODE_DPTS:
+        size = dpts.SIZES[dpt]
+        data = bytes(rnd.randrange(256) for i in range(count * size))
+        many = dpts.decode_many(dpt, memoryview(data))
+        wrong = [i for i in range(count) if not same(many[i], dpts.decode[dpt](data[i * size:(i + 1) * size]))]
+        failed += report("decode_many of DPT {}".format(dpt), wrong)
+
+    for dpt, generate in VALUES.items():
+        size = dpts.SIZES[dpt]
+        values = [generate(rnd) for i in range(count)]
+        data = dpts.encode_many(dpt, values)
+        wrong = [i for i in range(count) if data[i * size:(i + 1) * size] != bytes(dpts.encode[dpt](values[i])[-size:])]
+        if dpt == '9':
+            wrong += [i for i in range(count) if dpts.en9(values[i]) != legacy_en9(values[i])]
+        failed += report("encode_many of DPT {}".format(dpt), wrong)
+        decoded = dpts.decode_many(dpt, data)
+        wrong = [i for i in range(count) if decoded[i] != dpts.decode[dpt](bytes(dpts.encode[dpt](values[i])[-size:]))]
+        failed += report("round trip of DPT {}".format(dpt), wrong)
+    return failed
+
+
+def report(name, wrong):
+    if wrong:
+        print("FAILED {}: {} values differ, e.g. index {}".format(name, len(wrong), wrong[0]))
+        return 1
+    return 0
+
+
+def measure(name, func, count):
+    start = time.perf_counter()
+    func()
+    duration = time.perf_counter() - start
+    print("{:<32} {:>12.0f} values/s".format(name + ':', count / duration))
+
+
+def benchmark(rnd, count):
+    data = bytes(rnd.randrange(256) for i in range(count * 2))
+    payloads = [data[i:i + 2] for i in range(0, len(data), 2)]
+    values = [VALUES['9'](rnd) for i in range(count)]
+
+    # the table was already built by the checks
+    dpts._tables.pop('9', None)
+    start = time.perf_counter()
+    dpts.table('9')
+    print("table of DPT 9 built in {:.3f} s".format(time.perf_counter() - start))
+
+    decoder = dpts.table_decoder('9')
+    measure('decode[str(dpt)] DPT 9', lambda: [dpts.decode[str(9)](payload) for payload in payloads], count)
+    measure('table_decoder DPT 9', lambda: [decoder(payload) for payload in payloads], count)
+    measure('decode_many DPT 9', lambda: dpts.decode_many('9', data), count)
+    measure('decode_many DPT 8', lambda: dpts.decode_many('8', data), count)
+    measure('legacy en9', lambda: [legacy_en9(value) for value in values], count)
+    measure('en9', lambda: [dpts.en9(value) for value in values], count)
+    measure('encode_many DPT 9', lambda: dpts.encode_many('9', values), count)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Checks and benchmark of the table driven codecs of the knx plugin")
+    parser.add_argument('--values', type=int, default=100000, help="number of values per check and benchmark")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the random values")
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    failed = check(rnd, args.values)
+    print("{} checks failed".format(failed) if failed else "all checks passed")
+    benchmark(rnd, args.values)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# vim: set encoding=utf-8 tabstop=4 softtabstop=4 shiftwidth=4 expandtab
+#########################################################################
+#  This file is part of SmartHomeNG.
+#
+#  SmartHomeNG is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  SmartHomeNG is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with SmartHomeNG. If not, see <http://www.gnu.org/licenses/>.
+#########################################################################
+
+
+"""
+Replays a capture of the knx plugin (parameter capture_file) through a local
+knxd stand-in: a TCP server sends the captured frames with their length prefix
+like knxd, the plugin receives them with its own framing (parse_length and
+parse_telegram) as it does from knxd.
+
+The frames are sent at the speed they were captured (--speed 1), faster or
+slower (e.g. --speed 10) or as fast as possible (--speed 0, the default), which
+measures the decode and dispatch throughput. Items listen to the group addresses
+given by --listen, all other telegrams only go to the bus monitor. At the end the
+number of item updates and a checksum of the item values are printed, they are
+the same for every replay of a capture and allow comparing the results of
+changes of the plugin. Run it from the base directory of SmartHomeNG:
+
+    python3 plugins/knx/tools/replay.py var/knx.cap --listen 1/1/1:1 --listen 1/2/3:9 --stats
+"""
+
+import argparse
+import hashlib
+import logging
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..'))
+
+from plugins.knx import capture
+from benchmark import Item, create_plugin
+
+
+class KnxdStandIn(threading.Thread):
+    """
+    Accepts one connection and sends the frames of a capture to it
+    """
+
+    def __init__(self, frames, speed):
+        super().__init__(daemon=True)
+        self.frames = frames
+        self.speed = speed
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(1)
+        self.port = self.server.getsockname()[1]
+
+    def run(self):
+        conn, addr = self.server.accept()
+        if self.speed:
+            start = time.perf_counter()
+            first = self.frames[0][0] if self.frames else 0
+            for timestamp, data in self.frames:
+                delay = start + (timestamp - first) / self.speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                conn.sendall(struct.pack('>H', len(data)) + data)
+        else:
+            chunk = bytearray()
+            for timestamp, data in self.frames:
+                chunk += struct.pack('>H', len(data))
+                chunk += data
+                if len(chunk) >= 65536:
+                    conn.sendall(chunk)
+                    chunk = bytearray()
+            conn.sendall(chunk)
+        conn.close()
+        self.server.close()
+
+
+def receive(plugin, sock):
+    # the framing of lib.connection.Client: found_terminator is called with terminator bytes
+    plugin.found_terminator = plugin.parse_length
+    plugin.terminator = 2
+    buffer = bytearray()
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            break
+        buffer += data
+        pos = 0
+        while len(buffer) - pos >= plugin.terminator:
+            end = pos + plugin.terminator
+            plugin.found_terminator(bytes(buffer[pos:end]))
+            pos = end
+        del buffer[:pos]
+
+
+class CountingItem(Item):
+
+    updates = 0
+
+    def __call__(self, value=None, caller=None, source=None, dest=None):
+        if value is not None:
+            CountingItem.updates += 1
+        return super().__call__(value, caller, source, dest)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay of a capture of the knx plugin through a local knxd stand-in")
+    parser.add_argument('capture', help="capture file (parameter capture_file of the plugin)")
+    parser.add_argument('--speed', type=float, default=0, help="replay speed relative to the capture, 0 for as fast as possible")
+    parser.add_argument('--listen', action='append', default=[], metavar='GA:DPT', help="group address and DPT of an item listening to it")
+    parser.add_argument('--tables', action='store_true', help="use the table driven decoders (parameter dpt_tables)")
+    parser.add_argument('--stats', action='store_true', help="enable the statistics and show the top talkers")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    frames = list(capture.read(args.capture))
+    if not frames:
+        print("{} contains no frames".format(args.capture))
+        sys.exit(1)
+
+    plugin = create_plugin(args.tables)
+    plugin.enable_stats = args.stats
+    items = []
+    for n, listen in enumerate(args.listen):
+        ga, sep, dpt = listen.partition(':')
+        item = CountingItem('replay.item{}'.format(n), {'knx_dpt': dpt or '1', 'knx_listen': ga})
+        plugin.parse_item(item)
+        items.append(item)
+
+    standin = KnxdStandIn(frames, args.speed)
+    standin.start()
+    sock = socket.create_connection(('127.0.0.1', standin.port))
+    start = time.perf_counter()
+    receive(plugin, sock)
+    duration = time.perf_counter() - start
+    sock.close()
+    standin.join()
+
+    print("{} frames captured within {:.1f} s replayed in {:.3f} s: {:.0f} telegrams/s".format(
+        len(frames), frames[-1][0] - frames[0][0], duration, len(frames) / duration))
+    values = hashlib.sha1(repr([(item.id(), item()) for item in items]).encode()).hexdigest()
+    print("{} item updates, checksum of the item values {}".format(CountingItem.updates, values))
+    if args.stats:
+        for key in ('flag', 'pa', 'ga'):
+            print("top {}: {}".format(key, ', '.join("{} {:.2f}/s".format(name, rates[0]) for name, rates in plugin.get_stats_top(key, 5))))
+
+
+if __name__ == '__main__':
+    main()
@@ -25,12 +25,18 @@ import datetime
 import lib.log
 import os
 import pickle
+import re
+import string
+import time
 
 from lib.shtime import Shtime
 from lib.model.smartplugin import SmartPlugin
 
 from .AutoBlindLoggerOLog import AbLogger
 
+# replacement for expressions which can not be evaluated
+EVAL_FAILED = "'--'"
+EVAL_FAILED_CODE = compile(EVAL_FAILED, '<olog_eval>', 'eval')
 
 
 class OperationLog(AbLogger, SmartPlugin):
@@ -40,7 +46,7 @@ class OperationLog(AbLogger, SmartPlugin):
     ALLOW_MULTIINSTANCE = False
 
     def __init__(self, smarthome, name, cache=True, logtofile=True, filepattern="{year:04}-{month:02}-{day:02}-{name}.log",
-                 mapping=['time', 'thread', 'level', 'message'], items=[], maxlen=50, logger=None):
+                 mapping=['time', 'thread', 'level', 'message'], items=[], maxlen=50, logger=None, cache_flush=1000):
         log_directory = "var/log/operationlog/"
         self._sh = smarthome
         self.shtime = Shtime.get_instance()
@@ -71,6 +77,13 @@ class OperationLog(AbLogger, SmartPlugin):
         self._items = items
         self._item_conf = {}
         self._logic_conf = {}
+        # entries not yet written to the journal of the cache
+        self._cache_pending = []
+        self._cache_lock = threading.Lock()
+        self._cache_event = threading.Event()
+        self._cache_flush = int(cache_flush) / 1000
+        self._cache_writer = None
+        self._journal_len = 0
         self.__date = None
         self.__fname = None
         info_txt_cache = ", caching active"
@@ -94,15 +107,23 @@ class OperationLog(AbLogger, SmartPlugin):
             self._cachefile = self._sh._cache_dir + self._path
             try:
                 self.__last_change, self._logcache = _cache_read(self._cachefile, self.shtime.tzinfo())
-                self.load(self._logcache)
                 self.logger.debug("OperationLog {}: read cache: {}".format(self.name, self._logcache))
             except Exception:
+                self._logcache = []
                 try:
                     _cache_write(self.logger, self._cachefile, self._log.export(int(self._maxlen)))
                     _cache_read(self._cachefile, self.shtime.tzinfo())
                     self.logger.info("OperationLog {}: generated cache file".format(self.name))
                 except Exception as e:
                     self.logger.warning("OperationLog {}: problem reading cache: {}".format(self._path, e))
+            try:
+                journal = _journal_read(self._cachefile + JOURNAL_SUFFIX)
+            except Exception as e:
+                self.logger.warning("OperationLog {}: problem reading cache journal: {}".format(self._path, e))
+                journal = []
+            self._journal_len = len(journal)
+            self._logcache = _cache_merge(self._logcache, journal, self._maxlen)
+            self.load(self._logcache)
 
     def update_logfilename(self):
         if self.__date == datetime.datetime.today() and self.__fname is not None:
@@ -117,25 +138,23 @@ class OperationLog(AbLogger, SmartPlugin):
         sh = self._sh
         for item_id in self._item_conf:
             if 'olog_eval' in self._item_conf[item_id]:
-                for (ind, eval_str) in enumerate(self._item_conf[item_id]['olog_eval']):
-                    try:
-                        eval(eval_str)
-                    except Exception as e:
-                        self.logger.warning('olog: could not evaluate {} for item: {}, {}'.format(eval_str, item_id, e))
-                        self._item_conf[item_id]['olog_eval'][ind] = "'--'"
+                self._check_eval(self._item_conf[item_id], 'item: {}'.format(item_id))
         for logic_name in self._logic_conf:
             if 'olog_eval' in self._logic_conf[logic_name]:
-                for (ind, eval_str) in enumerate(self._logic_conf[logic_name]['olog_eval']):
-                    try:
-                        eval(eval_str)
-                    except Exception as e:
-                        self.logger.warning('olog: could not evaluate {} for logic: {}, {}'.format(eval_str, logic_name, e))
-                        self._logic_conf[logic_name]['olog_eval'][ind] = "'--'"
+                self._check_eval(self._logic_conf[logic_name], 'logic: {}'.format(logic_name))
 
         self.alive = True
+        if self._cache is True:
+            self._cache_writer = threading.Thread(target=self._cache_write_loop, name='OperationLog {} cache'.format(self.name))
+            self._cache_writer.daemon = True
+            self._cache_writer.start()
 
     def stop(self):
         self.alive = False
+        if self._cache_writer is not None:
+            self._cache_event.set()
+            self._cache_writer.join(5)
+            self._cache_writer = None
 
     def parse_item(self, item):
         if 'olog' in item.conf and item.conf['olog'] == self.name:
@@ -176,6 +195,8 @@ class OperationLog(AbLogger, SmartPlugin):
                     self._item_conf[item.id()]['olog_rules'][key] = value
                 if len(self._item_conf[item.id()]['olog_rules']) != 0:
                     self.logger.info('Item: {}, olog rules: {}'.format(item.id(), self._item_conf[item.id()]['olog_rules']))
+            if 'olog_txt' in self._item_conf[item.id()]:
+                self._prepare_item(item, self._item_conf[item.id()])
             return self.update_item
         else:
             return None
@@ -192,6 +213,8 @@ class OperationLog(AbLogger, SmartPlugin):
                 olog_eval = []
             self._logic_conf[logic.name]['olog_txt'] = olog_txt
             self._logic_conf[logic.name]['olog_eval'] = olog_eval
+            self._logic_conf[logic.name]['olog_code'] = [self._compile(expr) for expr in olog_eval]
+            self._logic_conf[logic.name]['format'] = olog_txt.format
             return self.trigger_logic
 
     def parse_eval(self, info, olog_txt):
@@ -212,6 +235,51 @@ class OperationLog(AbLogger, SmartPlugin):
             pos = start
         return {'olog_txt' : olog_txt, 'olog_eval' : olog_eval}
 
+    def _compile(self, expr):
+        try:
+            return compile(expr, '<olog_eval>', 'eval')
+        except SyntaxError:
+            # reported by run()
+            return None
+
+    def _check_eval(self, conf, info):
+        """
+        Evaluates the expressions once and replaces the ones failing
+        """
+        sh = self._sh
+        for (ind, eval_str) in enumerate(conf['olog_eval']):
+            try:
+                code = conf['olog_code'][ind]
+                eval(eval_str if code is None else code, globals(), {'sh': sh, 'self': self})
+            except Exception as e:
+                self.logger.warning('olog: could not evaluate {} for {}, {}'.format(eval_str, info, e))
+                conf['olog_eval'][ind] = EVAL_FAILED
+                conf['olog_code'][ind] = EVAL_FAILED_CODE
+
+    def _prepare_item(self, item, conf):
+        """
+        Prepares the rules and the log text of an item for update_item: the
+        expressions are compiled, the limits converted to the item type and
+        the keys used by the log text determined
+        """
+        rules = conf['olog_rules']
+        conf['olog_code'] = [self._compile(expr) for expr in conf['olog_eval']]
+        for lim in ['lowlim', 'highlim']:
+            conf[lim + '_cmp'] = None
+            if rules[lim] is not None:
+                try:
+                    if item.type() == 'num':
+                        conf[lim + '_cmp'] = float(rules[lim])
+                    elif item.type() == 'str':
+                        conf[lim + '_cmp'] = str(rules[lim])
+                except ValueError as e:
+                    self.logger.warning('Item: {}, invalid olog rule {}: {}'.format(item.id(), lim, e))
+        keys = {re.split(r'[.\[]', field)[0] for text, field, spec, conversion in string.Formatter().parse(conf['olog_txt']) if field}
+        conf['keys_name'] = 'name' in keys
+        conf['keys_age'] = 'age' in keys
+        conf['keys_parent'] = 'pname' in keys or 'pid' in keys
+        conf['format'] = conf['olog_txt'].format
+
     def __call__(self, param1=None, param2=None):
         if isinstance(param1, list) and isinstance(param2, type(None)):
             self.log(param1)
@@ -241,44 +309,35 @@ class OperationLog(AbLogger, SmartPlugin):
         if caller != 'OperationLog':
             if item.conf['olog'] == self.name:
                 if len(self._items) == 0:
-                    if item.id() in self._item_conf and 'olog_txt' in self._item_conf[item.id()]:
-                        mvalue = item()
-                        if 'olog_rules' in self._item_conf[item.id()]:
-                            if 'lowlim' in self._item_conf[item.id()]['olog_rules']:
-                                if item.type() == 'num':
-                                    if self._item_conf[item.id()]['olog_rules']['lowlim'] is not None and item() < float(self._item_conf[item.id()]['olog_rules']['lowlim']):
-                                        return
-                                elif item.type() == 'str':
-                                    if self._item_conf[item.id()]['olog_rules']['lowlim'] is not None and item() < str(self._item_conf[item.id()]['olog_rules']['lowlim']):
-                                        return
-                            if 'highlim' in self._item_conf[item.id()]['olog_rules']:
-                                if item.type() == 'num':
-                                    if self._item_conf[item.id()]['olog_rules']['highlim'] is not None and item() >= float(self._item_conf[item.id()]['olog_rules']['highlim']):
-                                        return
-                                elif item.type() == 'str':
-                                    if self._item_conf[item.id()]['olog_rules']['highlim'] is not None and item() >= str(self._item_conf[item.id()]['olog_rules']['highlim']):
-                                        return
-                            try:
-                                mvalue = self._item_conf[item.id()]['olog_rules'][item()]
-                            except KeyError:
-                                mvalue = item()
-                                if self._item_conf[item.id()]['olog_rules']["*"] is None:
-                                    return
-                        sh = self._sh
-                        self._item_conf[item.id()]['olog_eval_res'] = []
-                        for expr in self._item_conf[item.id()]['olog_eval']:
-                            self._item_conf[item.id()]['olog_eval_res'].append(eval(expr))
-                        logtxt = self._item_conf[item.id()]['olog_txt'].format(*self._item_conf[item.id()]['olog_eval_res'],
-                                                                               **{'value': item(),
-                                                                                  'mvalue': mvalue,
-                                                                                  'name': str(item),
-                                                                                  'age': round(item.prev_age(), 2),
-                                                                                  'pname': str(item.return_parent()),
-                                                                                  'id': item.id(),
-                                                                                  'pid': item.return_parent().id(),
-                                                                                  'lowlim': self._item_conf[item.id()]['olog_rules']['lowlim'],
-                                                                                  'highlim': self._item_conf[item.id()]['olog_rules']['highlim']})
-                        logvalues = [logtxt]
+                    conf = self._item_conf.get(item.id())
+                    if conf is not None and 'olog_txt' in conf:
+                        value = item()
+                        if conf['lowlim_cmp'] is not None and value < conf['lowlim_cmp']:
+                            return
+                        if conf['highlim_cmp'] is not None and value >= conf['highlim_cmp']:
+                            return
+                        rules = conf['olog_rules']
+                        try:
+                            mvalue = rules[value]
+                        except KeyError:
+                            mvalue = value
+                            if rules["*"] is None:
+                                return
+                        if conf['olog_code']:
+                            local = {'self': self, 'sh': self._sh, 'item': item, 'caller': caller, 'source': source, 'dest': dest, 'mvalue': mvalue}
+                            eval_res = [eval(code, globals(), local) for code in conf['olog_code']]
+                        else:
+                            eval_res = []
+                        kwargs = {'value': value, 'mvalue': mvalue, 'id': item.id(), 'lowlim': rules['lowlim'], 'highlim': rules['highlim']}
+                        if conf['keys_name']:
+                            kwargs['name'] = str(item)
+                        if conf['keys_age']:
+                            kwargs['age'] = round(item.prev_age(), 2)
+                        if conf['keys_parent']:
+                            parent = item.return_parent()
+                            kwargs['pname'] = str(parent)
+                            kwargs['pid'] = parent.id()
+                        logvalues = [conf['format'](*eval_res, **kwargs)]
                     else:
                         logvalues = [item.id(), '=', item()]
                 else:
@@ -289,11 +348,13 @@ class OperationLog(AbLogger, SmartPlugin):
 
     def trigger_logic(self, logic, by=None, source=None, dest=None):
         if self.name == logic.conf['olog'] and logic.name in self._logic_conf:
-            sh = self._sh
-            olog_txt = self._logic_conf[logic.name]['olog_txt']
-            olog_eval = self._logic_conf[logic.name]['olog_eval']
-            eval_res = [eval(expr) for expr in olog_eval]
-            logvalues = [olog_txt.format(*eval_res, **{'plugin' : self, 'logic' : logic, 'by' : by, 'source' : source, 'dest' : dest})] 
+            conf = self._logic_conf[logic.name]
+            if conf['olog_code']:
+                local = {'self': self, 'sh': self._sh, 'logic': logic, 'by': by, 'source': source, 'dest': dest}
+                eval_res = [eval(code, globals(), local) for code in conf['olog_code']]
+            else:
+                eval_res = []
+            logvalues = [conf['format'](*eval_res, **{'plugin' : self, 'logic' : logic, 'by' : by, 'source' : source, 'dest' : dest})]
             self.log(logvalues, 'INFO' if 'olog_level' not in logic.conf else logic.conf['olog_level'])
 
     def log(self, logvalues, level='INFO'):
@@ -309,24 +370,63 @@ class OperationLog(AbLogger, SmartPlugin):
                 else:
                     values_txt = map(str, logvalues)
                     log.append(' '.join(values_txt))
-            self._log.add(log)
+            with self._cache_lock:
+                self._log.add(log)
+                if self._cache is True:
+                    self._cache_pending.append(dict(zip(self._log.mapping, log)))
+                    self._cache_event.set()
             if self._logtofile is True:
                 self.update_logfilename()
                 self.__myLogger.info('{}: {}', log[2], ''.join(log[3:]))
 
-            if self._cache is True:
-                try:
-                    _cache_write(self.logger, self._cachefile, self._log.export(int(self._maxlen)))
-                except Exception as e:
-                    self.logger.warning("OperationLog {}: could not update cache {}".format(self._path, e))
-
             if self._logger:
                 self._logger.log(logging.getLevelName(level), ' '.join(map(str, logvalues)))
 
+    def _cache_write_loop(self):
+        while self.alive:
+            self._cache_event.wait()
+            if not self.alive:
+                break
+            # coalesce the entries logged within the flush interval into one write
+            time.sleep(self._cache_flush)
+            self._cache_event.clear()
+            self._cache_update()
+        self._cache_update(compact=True)
+
+    def _cache_update(self, compact=False):
+        """
+        Appends the pending entries to the journal of the cache. If the journal
+        contains more entries than kept in memory, the cache file is written
+        with the current entries and the journal is truncated.
+        """
+        with self._cache_lock:
+            pending = self._cache_pending
+            self._cache_pending = []
+            if not pending and not compact:
+                return
+            if compact or self._journal_len + len(pending) >= self._maxlen:
+                # the exported entries contain the pending ones
+                snapshot = self._log.export(int(self._maxlen))
+            else:
+                snapshot = None
+        try:
+            if snapshot is None:
+                _journal_append(self._cachefile + JOURNAL_SUFFIX, pending)
+                self._journal_len += len(pending)
+            else:
+                _cache_write(self.logger, self._cachefile, snapshot, atomic=True)
+                _journal_append(self._cachefile + JOURNAL_SUFFIX, [], truncate=True)
+                self._journal_len = 0
+        except Exception as e:
+            self.logger.warning("OperationLog {}: could not update cache {}".format(self._path, e))
+
 
 #####################################################################
 # Cache Methods
 #####################################################################
+JOURNAL_SUFFIX = '.journal'
+
+
 def _cache_read(filename, tz):
     ts = os.path.getmtime(filename)
     dt = datetime.datetime.fromtimestamp(ts, tz)
@@ -336,9 +436,47 @@ def _cache_read(filename, tz):
     return (dt, value)
 
 
-def _cache_write(logger, filename, value):
+def _cache_write(logger, filename, value, atomic=False):
     try:
-        with open(filename, 'wb') as f:
+        with open(filename + '.tmp' if atomic else filename, 'wb') as f:
             pickle.dump(value, f)
+        if atomic:
+            os.replace(filename + '.tmp', filename)
     except IOError:
         logger.warning("Could not write to {}".format(filename))
+
+
+def _journal_read(filename):
+    """
+    Returns the entries of the journal, oldest first
+    """
+    entries = []
+    if not os.path.isfile(filename):
+        return entries
+    with open(filename, 'rb') as f:
+        while True:
+            try:
+                entries.extend(pickle.load(f))
+            except EOFError:
+                break
+            except Exception:
+                # incomplete last write
+                break
+    return entries
+
+
+def _journal_append(filename, entries, truncate=False):
+    with open(filename, 'wb' if truncate else 'ab') as f:
+        if entries:
+            pickle.dump(entries, f)
+
+
+def _cache_merge(snapshot, journal, maxlen):
+    """
+    Returns the entries of the cache file followed by the journal, newest first
+    (as exported by the log)
+    """
+    if snapshot and journal and 'time' in snapshot[0]:
+        # entries written to the cache file before the journal could be truncated
+        journal = [entry for entry in journal if entry.get('time') is None or entry['time'] > snapshot[0]['time']]
+    return (list(reversed(journal)) + list(snapshot))[:maxlen]
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+#########################################################################
+#  operationlogger
+#
+#  SmartHomeNG is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  SmartHomeNG is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with SmartHomeNG. If not, see <http://www.gnu.org/licenses/>.
+#########################################################################
+
+
+"""
+Measures the item updates per second update_item of the operationlog plugin
+handles (without writing the log entries), compared to the implementation
+evaluating the olog_eval expressions from source on every update.
+
+Run it from the base directory of SmartHomeNG:
+
+    python3 plugins/operationlog/tools/benchmark.py --updates 100000
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..'))
+
+from plugins.operationlog import OperationLog
+
+
+class Item():
+
+    def __init__(self, path, conf, parent=None):
+        self._path = path
+        self._value = 0.0
+        self._parent = parent
+        self.conf = conf
+
+    def __call__(self, value=None):
+        if value is None:
+            return self._value
+        self._value = value
+
+    def __str__(self):
+        return self._path.rpartition('.')[2]
+
+    def id(self):
+        return self._path
+
+    def type(self):
+        return 'num'
+
+    def prev_age(self):
+        return 12.3456
+
+    def prev_value(self):
+        return self._value - 1
+
+    def return_parent(self):
+        return self._parent
+
+
+class SmartHome():
+
+    def __init__(self, item):
+        self.bench = type('Items', (), {'item': item})
+
+
+def legacy_update_item(self, item, caller=None, source=None, dest=None):
+    # the former implementation of update_item (for logs without items)
+    if caller != 'OperationLog':
+        if item.conf['olog'] == self.name:
+            if item.id() in self._item_conf and 'olog_txt' in self._item_conf[item.id()]:
+                mvalue = item()
+                if 'olog_rules' in self._item_conf[item.id()]:
+                    if 'lowlim' in self._item_conf[item.id()]['olog_rules']:
+                        if item.type() == 'num':
+                            if self._item_conf[item.id()]['olog_rules']['lowlim'] is not None and item() < float(self._item_conf[item.id()]['olog_rules']['lowlim']):
+                                return
+                    if 'highlim' in self._item_conf[item.id()]['olog_rules']:
+                        if item.type() == 'num':
+                            if self._item_conf[item.id()]['olog_rules']['highlim'] is not None and item() >= float(self._item_conf[item.id()]['olog_rules']['highlim']):
+                                return
+                    try:
+                        mvalue = self._item_conf[item.id()]['olog_rules'][item()]
+                    except KeyError:
+                        mvalue = item()
+                        if self._item_conf[item.id()]['olog_rules']["*"] is None:
+                            return
+                sh = self._sh
+                self._item_conf[item.id()]['olog_eval_res'] = []
+                for expr in self._item_conf[item.id()]['olog_eval']:
+                    self._item_conf[item.id()]['olog_eval_res'].append(eval(expr))
+                logtxt = self._item_conf[item.id()]['olog_txt'].format(*self._item_conf[item.id()]['olog_eval_res'],
+                                                                       **{'value': item(),
+                                                                          'mvalue': mvalue,
+                                                                          'name': str(item),
+                                                                          'age': round(item.prev_age(), 2),
+                                                                          'pname': str(item.return_parent()),
+                                                                          'id': item.id(),
+                                                                          'pid': item.return_parent().id(),
+                                                                          'lowlim': self._item_conf[item.id()]['olog_rules']['lowlim'],
+                                                                          'highlim': self._item_conf[item.id()]['olog_rules']['highlim']})
+                logvalues = [logtxt]
+            else:
+                logvalues = [item.id(), '=', item()]
+            self.log(logvalues, 'INFO' if 'olog_level' not in item.conf else item.conf['olog_level'])
+
+
+def measure(name, update, item, updates):
+    start = time.perf_counter()
+    for n in range(updates):
+        item(float(n % 12))
+        update(item, 'Logic')
+    duration = time.perf_counter() - start
+    print("{:<8} {:>10.0f} updates/s".format(name + ':', updates / duration))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of update_item of the operationlog plugin")
+    parser.add_argument('--updates', type=int, default=100000, help="number of item updates")
+    parser.add_argument('--olog_txt', default="Item {name} has lowlim={lowlim} <= value={value} < highlim={highlim}, "
+                                              "the value {eval='increased' if sh.bench.item() > sh.bench.item.prev_value() else 'decreased'}",
+                        help="olog_txt of the item")
+    args = parser.parse_args()
+
+    parent = Item('bench', {})
+    item = Item('bench.item', {'olog': 'bench', 'olog_txt': args.olog_txt, 'olog_rules': ['lowlim:1', 'highlim:10', '*:value']}, parent)
+
+    # the plugin is set up without the log and cache files
+    plugin = OperationLog.__new__(OperationLog)
+    plugin.name = 'bench'
+    plugin.logger = logging.getLogger(__name__)
+    plugin._sh = SmartHome(item)
+    plugin._items = []
+    plugin._item_conf = {}
+    plugin._logic_conf = {}
+    plugin.log = lambda logvalues, level='INFO': None
+    plugin.parse_item(item)
+    plugin._check_eval(plugin._item_conf[item.id()], 'item: {}'.format(item.id()))
+
+    item(5.0)
+    messages = []
+    plugin.log = lambda logvalues, level='INFO': messages.extend(logvalues)
+    legacy_update_item(plugin, item, 'Logic')
+    plugin.update_item(item, 'Logic')
+    print("log text: {}".format(messages[-1]))
+    if messages[0] != messages[1]:
+        print("log texts differ: {}".format(messages[0]))
+    plugin.log = lambda logvalues, level='INFO': None
+
+    measure('legacy', lambda item, caller: legacy_update_item(plugin, item, caller), item, args.updates)
+    measure('compiled', plugin.update_item, item, args.updates)
+
+
+if __name__ == '__main__':
+    main()
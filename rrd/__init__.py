@@ -19,25 +19,106 @@
 #  along with SmartHomeNG.  If not, see <http://www.gnu.org/licenses/>.
 #########################################################################
 
+import concurrent.futures
 import datetime
 import functools
 import logging
 import os
+import socket
+import threading
+import time
 
 import rrdtool
 
+try:
+    import numpy
+    NUMPY_IMPORTED = True
+except ImportError:
+    NUMPY_IMPORTED = False
+
 logger = logging.getLogger('')
 
+# names of the data sources holding the real minimum and maximum of a step
+DS_MIN = '_min'
+DS_MAX = '_max'
+
+# units of time frames like 5d in seconds
+TIME_UNITS = {'s': 1, 'i': 60, 'min': 60, 'h': 3600, 'd': 86400, 'w': 604800, 'm': 2592000, 'mon': 2592000, 'y': 31536000}
+
+
+class Accumulator():
+    """
+    Aggregates the updates of an item between two update cycles
+    """
+    __slots__ = ('start', 'time', 'last', 'count', 'sum', 'min', 'max', 'area')
+
+    def __init__(self, value, now):
+        self.reset(value, now)
+
+    def reset(self, value, now):
+        self.start = now
+        self.time = now
+        self.last = value
+        self.count = 0
+        self.sum = 0.0
+        # the value held at the start of the step counts for the extremes
+        self.min = value
+        self.max = value
+        self.area = 0.0
+
+    def add(self, value, now):
+        self.area += self.last * (now - self.time)
+        self.time = now
+        self.last = value
+        self.count += 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def average(self, now):
+        """
+        Returns the time-weighted average since the start of the step
+        """
+        duration = now - self.start
+        if duration <= 0:
+            return self.last
+        return (self.area + self.last * (now - self.time)) / duration
+
+    def mean(self):
+        """
+        Returns the mean of the updates since the start of the step
+        """
+        if self.count == 0:
+            return self.last
+        return self.sum / self.count
+
 
 class RRD():
 
-    def __init__(self, smarthome, step=300, rrd_dir=None):
+    def __init__(self, smarthome, step=300, rrd_dir=None, rrdcached=None, threads=1, aggregate='twa'):
         self._sh = smarthome
-        if rrd_dir is None:
+        if not rrd_dir:
             rrd_dir = smarthome.base_dir + '/var/rrd/'
         self._rrd_dir = rrd_dir
         self._rrds = {}
         self.step = int(step)
+        self._rrdcached = rrdcached
+        self._rrdcached_sock = None
+        self._rrdcached_file = None
+        self._threads = max(int(threads), 1)
+        self._aggregate = aggregate
+        if self._aggregate not in ('twa', 'avg', 'last'):
+            logger.warning("RRDtool: unknown aggregate '{}', using 'twa'".format(aggregate))
+            self._aggregate = 'twa'
+        self._accumulators = {}
+        self._accumulators_lock = threading.Lock()
+        # time and value of the last update of every gauge rrd
+        self._last = {}
+        self._pool = None
+        self._stats_lock = threading.Lock()
+        self._stats = {'cycles': 0, 'updates': 0, 'failures': 0, 'batches': 0, 'fallbacks': 0, 'last_duration': None, 'max_duration': 0, 'last_cycle': None}
 
     def run(self):
         self.alive = True
@@ -46,27 +127,177 @@ class RRD():
             rrd = self._rrds[itempath]
             if not os.path.isfile(rrd['rrdb']):
                 self._create(rrd)
+            rrd['ds'] = self._ds_names(rrd)
+        if self._threads > 1:
+            self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=self._threads)
         offset = 100  # wait 100 seconds for 1-Wire to update values
         self._sh.scheduler.add('RRDtool', self._update_cycle, cycle=self.step, offset=offset, prio=5)
 
     def stop(self):
         self.alive = False
+        self._rrdcached_close()
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+    def stats(self):
+        """
+        Returns the counters of the update cycles (number of cycles, updates,
+        failures, rrdcached batches and fallbacks, duration of the last and
+        the longest cycle in seconds)
+        """
+        with self._stats_lock:
+            return dict(self._stats)
+
+    def update_item(self, item, caller=None, source=None, dest=None):
+        now = time.monotonic()
+        value = float(item())
+        with self._accumulators_lock:
+            accumulator = self._accumulators.get(item.id())
+            if accumulator is None:
+                self._accumulators[item.id()] = Accumulator(value, now)
+            else:
+                accumulator.add(value, now)
+
+    def _values(self, rrd, now):
+        """
+        Returns the values of the data sources of a rrd for the current step
+        and starts the next step
+        """
+        if rrd['type'] == 'COUNTER':
+            return [str(int(rrd['step'] * rrd['item']()))]
+        value = float(rrd['item']())
+        accumulator = self._accumulators.get(rrd['id'])
+        if self._aggregate == 'last':
+            # item updates are not tracked
+            values = [value, value, value]
+        elif accumulator is None:
+            self._accumulators[rrd['id']] = Accumulator(value, now)
+            values = [value, value, value]
+        else:
+            if self._aggregate == 'twa':
+                average = accumulator.average(now)
+            else:
+                average = accumulator.mean()
+            values = [average, accumulator.min, accumulator.max]
+            accumulator.reset(accumulator.last, now)
+        self._last[rrd['id']] = (time.time(), values[0])
+        # rrds created before the min/max data sources were introduced only contain the average
+        return [str(v) for v, ds in zip(values, (True, DS_MIN in rrd['ds'], DS_MAX in rrd['ds'])) if ds]
 
     def _update_cycle(self):
-        for itempath in self._rrds:
-            rrd = self._rrds[itempath]
-            if rrd['type'] == 'GAUGE':
-                value = 'N:' + str(float(rrd['item']()))
-            else:  # 'COUNTER'
-                value = 'N:' + str(int(rrd['step'] * rrd['item']()))
-            try:
-                rrdtool.update(
-                    rrd['rrdb'],
-                    value
-                )
-            except Exception as e:
-                logger.warning("RRD: error updating {}: {}".format(itempath, e))
-                continue
+        start = time.time()
+        now = time.monotonic()
+        updates = []
+        with self._accumulators_lock:
+            for itempath in self._rrds:
+                rrd = self._rrds[itempath]
+                updates.append((rrd, ':'.join(self._values(rrd, now))))
+        failures = None
+        if self._rrdcached:
+            # the daemon may receive the updates later, so the time of the cycle is sent
+            failures = self._update_rrdcached(updates, int(start))
+        if failures is None:
+            failures = self._update_files(updates)
+        duration = time.time() - start
+        with self._stats_lock:
+            self._stats['cycles'] += 1
+            self._stats['updates'] += len(updates) - failures
+            self._stats['failures'] += failures
+            self._stats['last_duration'] = duration
+            self._stats['max_duration'] = max(self._stats['max_duration'], duration)
+            self._stats['last_cycle'] = self._sh.now()
+        logger.debug("RRDtool: updated {} rrds in {:.3f}s ({} failures)".format(len(updates), duration, failures))
+
+    def _update_file(self, rrd, value):
+        try:
+            rrdtool.update(
+                rrd['rrdb'],
+                'N:' + value
+            )
+        except Exception as e:
+            logger.warning("RRD: error updating {}: {}".format(rrd['id'], e))
+            self._last.pop(rrd['id'], None)
+            return False
+        return True
+
+    def _update_files(self, updates):
+        """
+        Updates the rrd files directly, spread across the worker threads if
+        more than one thread is configured. Returns the number of failures.
+        """
+        if self._pool is None:
+            results = [self._update_file(rrd, value) for rrd, value in updates]
+        else:
+            results = list(self._pool.map(lambda update: self._update_file(*update), updates))
+        return results.count(False)
+
+    def _rrdcached_connect(self):
+        address = self._rrdcached
+        if address.startswith('unix:'):
+            address = address[5:]
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(10)
+        sock.connect(address)
+        return sock
+
+    def _rrdcached_close(self):
+        if self._rrdcached_file is not None:
+            self._rrdcached_file.close()
+            self._rrdcached_file = None
+        if self._rrdcached_sock is not None:
+            self._rrdcached_sock.close()
+            self._rrdcached_sock = None
+
+    def _rrdcached_status(self):
+        line = self._rrdcached_file.readline().decode()
+        if not line:
+            raise OSError("connection closed by rrdcached")
+        status, _, message = line.strip().partition(' ')
+        return int(status), message
+
+    def _update_rrdcached(self, updates, timestamp):
+        """
+        Sends all updates of a cycle with one BATCH command to rrdcached. Returns
+        the number of failed updates, or None if the daemon is not reachable and
+        the files have to be updated directly.
+        """
+        if not updates:
+            return 0
+        try:
+            if self._rrdcached_sock is None:
+                self._rrdcached_sock = self._rrdcached_connect()
+                self._rrdcached_file = self._rrdcached_sock.makefile('rb')
+            self._rrdcached_sock.sendall(b'BATCH\n')
+            status, message = self._rrdcached_status()
+            if status != 0:
+                raise OSError("BATCH refused: {}".format(message))
+            lines = ["UPDATE {} {}:{}\n".format(rrd['rrdb'], timestamp, value) for rrd, value in updates]
+            lines.append('.\n')
+            self._rrdcached_sock.sendall(''.join(lines).encode())
+            failures, message = self._rrdcached_status()
+            for i in range(failures):
+                number, message = self._rrdcached_status()
+                # the daemon reports the number of the failed command within the batch
+                if 0 < number <= len(updates):
+                    logger.warning("RRD: error updating {} via rrdcached: {}".format(updates[number - 1][0]['id'], message))
+                    self._last.pop(updates[number - 1][0]['id'], None)
+                else:
+                    logger.warning("RRD: error updating via rrdcached: {}".format(message))
+        except Exception as e:
+            logger.warning("RRDtool: rrdcached at {} not available, updating files directly: {}".format(self._rrdcached, e))
+            self._rrdcached_close()
+            with self._stats_lock:
+                self._stats['fallbacks'] += 1
+            return None
+        with self._stats_lock:
+            self._stats['batches'] += 1
+        return failures
+
+    def _daemon(self):
+        if self._rrdcached:
+            return ['--daemon', self._rrdcached]
+        return []
 
     def parse_item(self, item):
         if 'rrd' not in item.conf:
@@ -87,12 +318,14 @@ class RRD():
             rrd_step = int(item.conf['rrd_step'])
         item.series = functools.partial(self._series, item=item.id())
         item.db = functools.partial(self._single, item=item.id())
-        self._rrds[item.id()] = {'item': item, 'id': item.id(), 'rrdb': rrdb, 'max': rrd_max, 'min': rrd_min, 'step': rrd_step, 'type': rrd_type}
+        self._rrds[item.id()] = {'item': item, 'id': item.id(), 'rrdb': rrdb, 'max': rrd_max, 'min': rrd_min, 'step': rrd_step, 'type': rrd_type, 'ds': []}
 
         if item.conf['rrd'] == 'init':
             last = self._single('last', '5d', item=item.id())
             if last is not None:
                 item.set(last, 'RRDtool')
+        if rrd_type == 'GAUGE' and self._aggregate != 'last':
+            return self.update_item
 
     def parse_logic(self, logic):
         pass
@@ -119,17 +352,10 @@ class RRD():
         else:
             logger.warning("RRDtool: unsupported consolidation function {} for {}".format(func, item))
             return
-        if start.isdigit():
-            query.extend(['--start', "{}".format(start)])
-        else:
-            query.extend(['--start', "now-{}".format(start)])
-        if end != 'now':
-            if end.isdigit():
-                query.extend(['--end', "{}".format(end)])
-            else:
-                query.extend(['--end', "now-{}".format(end)])
+        query.extend(self._timeframe(start, end))
         if step is not None:
             query.extend(['--resolution', step])
+        query.extend(self._daemon())
         try:
             meta, name, data = rrdtool.fetch(*query)
         except Exception as e:
@@ -141,8 +367,9 @@ class RRD():
         istart, iend, istep = meta
         mstart = istart * 1000
         mstep = istep * 1000
-        tuples = [(mstart + i * mstep, v[0]) for i, v in enumerate(data)]
-        reply['series'] = sorted(tuples)
+        column = self._column(name, query[1])
+        # the rows are returned in ascending order
+        reply['series'] = [(mstart + i * mstep, v[column]) for i, v in enumerate(data)]
         reply['params'] = {'update': True, 'item': item, 'func': func, 'start': str(iend), 'end': str(iend + istep), 'step': str(istep), 'sid': sid}
         reply['update'] = self._sh.now() + datetime.timedelta(seconds=istep)
         return reply
@@ -153,56 +380,222 @@ class RRD():
         else:
             logger.warning("RRDtool: not enabled for {}".format(item))
             return
-        query = ["{}".format(rrd['rrdb'])]
-        if func == 'avg':
-            query.append('AVERAGE')
-        elif func == 'max':
-            if rrd['max']:
-                query.append('MAX')
-            else:
-                query.append('AVERAGE')
-        elif func == 'min':
-            if rrd['min']:
-                query.append('MIN')
-            else:
-                query.append('AVERAGE')
-        elif func == 'last':
-            query.append('AVERAGE')
-        else:
+        cf = self._single_cf(func, rrd)
+        if cf is None:
             logger.warning("RRDtool: unsupported consolidation function {} for {}".format(func, item))
             return
+        if func == 'last' and end == 'now':
+            last = self._last_value(rrd, start)
+            if last is not None:
+                return last
+        query = ["{}".format(rrd['rrdb']), cf]
+        query.extend(self._timeframe(start, end))
+        query.extend(self._daemon())
+        try:
+            meta, name, data = rrdtool.fetch(*query)
+        except Exception as e:
+            logger.warning("error reading {0} data: {1}".format(item, e))
+            return None
+        column = self._column(name, cf)
+        reduced = self._reduce(func, [[v[column]] for v in data])
+        if reduced:
+            return reduced[0]
+
+    def db_many(self, func, items, start='1d', end='now'):
+        """
+        Returns the value of the given function (avg, min, max, last) for
+        several items, read with one rrdtool xport call
+
+        :return: dict of item id and value (None if there is no value)
+        """
+        rrds, cfs, result = [], [], {}
+        for item in items:
+            rrd = self._rrds.get(item)
+            cf = None if rrd is None else self._single_cf(func, rrd)
+            if cf is None:
+                logger.warning("RRDtool: not enabled for {} or unsupported consolidation function {}".format(item, func))
+                continue
+            if func == 'last' and end == 'now':
+                last = self._last_value(rrd, start)
+                if last is not None:
+                    result[item] = last
+                    continue
+            rrds.append(rrd)
+            cfs.append(cf)
+        if rrds:
+            exported = self._xport(rrds, cfs, start, end)
+            if exported is not None:
+                meta, data = exported
+                reduced = self._reduce(func, data) or [None] * len(rrds)
+                result.update(zip([rrd['id'] for rrd in rrds], reduced))
+        return result
+
+    def series_many(self, func, items, start='1d', end='now', step=None):
+        """
+        Returns the series of the given function (avg, min, max) for several
+        items, read with one rrdtool xport call
+
+        :return: dict of item id and list of (timestamp in ms, value) tuples
+        """
+        cf = {'avg': 'AVERAGE', 'min': 'MIN', 'max': 'MAX'}.get(func)
+        rrds = []
+        for item in items:
+            rrd = self._rrds.get(item)
+            if rrd is None or cf is None or (func in ('min', 'max') and not rrd[func]):
+                logger.warning("RRDtool: not enabled for {} or unsupported consolidation function {}".format(item, func))
+                continue
+            rrds.append(rrd)
+        if not rrds:
+            return {}
+        exported = self._xport(rrds, [cf] * len(rrds), start, end, step)
+        if exported is None:
+            return {}
+        meta, data = exported
+        times = [(meta['start'] + i * meta['step']) * 1000 for i in range(len(data))]
+        return {rrd['id']: list(zip(times, [row[i] for row in data])) for i, rrd in enumerate(rrds)}
+
+    def _xport(self, rrds, cfs, start, end, step=None):
+        """
+        Reads the given rrds with one rrdtool xport call
+
+        :return: tuple of meta data (start, step) and rows with one column per rrd
+        """
+        query = self._timeframe(start, end)
+        if step is not None:
+            query.extend(['--step', str(step)])
+        query.extend(self._daemon())
+        for i, (rrd, cf) in enumerate(zip(rrds, cfs)):
+            ds = self._ds_name(rrd)
+            if cf == 'MIN' and DS_MIN in rrd['ds']:
+                ds = DS_MIN
+            elif cf == 'MAX' and DS_MAX in rrd['ds']:
+                ds = DS_MAX
+            query.append("DEF:v{}={}:{}:{}".format(i, rrd['rrdb'].replace(':', '\\:'), ds, cf))
+            query.append("XPORT:v{}:{}".format(i, rrd['id']))
+        try:
+            exported = rrdtool.xport(*query)
+        except Exception as e:
+            logger.warning("RRDtool: error exporting data of {} rrds: {}".format(len(rrds), e))
+            return None
+        return exported['meta'], exported['data']
+
+    def _reduce(self, func, data):
+        """
+        Returns the value of the given function for every column of the rows
+        (None values are ignored)
+        """
+        if not data:
+            return []
+        if NUMPY_IMPORTED:
+            values = numpy.array(data, dtype=float)
+            valid = ~numpy.isnan(values)
+            counts = valid.sum(axis=0)
+            if func == 'avg':
+                reduced = numpy.where(valid, values, 0).sum(axis=0) / numpy.maximum(counts, 1)
+            elif func == 'min':
+                reduced = numpy.where(valid, values, numpy.inf).min(axis=0)
+            elif func == 'max':
+                reduced = numpy.where(valid, values, -numpy.inf).max(axis=0)
+            else:  # 'last'
+                # index of the last valid row of every column
+                last = len(values) - 1 - numpy.argmax(valid[::-1], axis=0)
+                reduced = values[last, numpy.arange(values.shape[1])]
+            return [float(v) if n else None for v, n in zip(reduced, counts)]
+        result = []
+        for column in zip(*data):
+            values = [v for v in column if v is not None]
+            if not values:
+                result.append(None)
+            elif func == 'avg':
+                result.append(sum(values) / len(values))
+            elif func == 'min':
+                result.append(min(values))
+            elif func == 'max':
+                result.append(max(values))
+            else:  # 'last'
+                result.append(values[-1])
+        return result
+
+    def _single_cf(self, func, rrd):
+        if func == 'avg' or func == 'last':
+            return 'AVERAGE'
+        elif func == 'max':
+            return 'MAX' if rrd['max'] else 'AVERAGE'
+        elif func == 'min':
+            return 'MIN' if rrd['min'] else 'AVERAGE'
+        return None
+
+    def _timeframe(self, start, end):
         if start.isdigit():
-            query.extend(['--start', "{}".format(start)])
+            query = ['--start', "{}".format(start)]
         else:
-            query.extend(['--start', "now-{}".format(start)])
+            query = ['--start', "now-{}".format(start)]
         if end != 'now':
             if end.isdigit():
                 query.extend(['--end', "{}".format(end)])
             else:
                 query.extend(['--end', "now-{}".format(end)])
+        return query
+
+    def _seconds(self, frame):
+        """
+        Returns the duration of a time frame like 5d in seconds, None if it can
+        not be parsed
+        """
+        for unit in sorted(TIME_UNITS, key=len, reverse=True):
+            if frame.endswith(unit) and frame[:-len(unit)].isdigit():
+                return int(frame[:-len(unit)]) * TIME_UNITS[unit]
+        return None
+
+    def _last_value(self, rrd, start):
+        """
+        Returns the last value written to a gauge rrd, if it has been written
+        within the given time frame. The value is cached for every update and
+        read with rrdtool lastupdate once, so 'last' does not need a fetch.
+        """
+        if rrd['type'] != 'GAUGE':
+            return None
+        if rrd['id'] not in self._last:
+            self._lastupdate(rrd)
+        last = self._last.get(rrd['id'])
+        if last is None:
+            return None
+        if start.isdigit():
+            since = int(start)
+        else:
+            seconds = self._seconds(start)
+            if seconds is None:
+                return None
+            since = time.time() - seconds
+        if last[0] < since:
+            return None
+        return last[1]
+
+    def _lastupdate(self, rrd):
         try:
-            meta, name, data = rrdtool.fetch(*query)
+            info = rrdtool.lastupdate(rrd['rrdb'], *self._daemon())
+            value = info['ds'][self._ds_name(rrd)]
         except Exception as e:
-            logger.warning("error reading {0} data: {1}".format(item, e))
-            return None
-        values = [v[0] for v in data if v[0] is not None]
-        if func == 'avg':
-            if len(values) > 0:
-                return sum(values) / len(values)
-        elif func == 'min':
-            if len(values) > 0:
-                return min(values)
-        elif func == 'max':
-            if len(values) > 0:
-                return max(values)
-        elif func == 'last':
-            if len(values) > 0:
-                return values[-1]
+            logger.debug("RRDtool: no last update of {}: {}".format(rrd['rrdb'], e))
+            value = None
+        if value is None:
+            self._last[rrd['id']] = None
+        else:
+            self._last[rrd['id']] = (info['date'].timestamp(), float(value))
+
+    def _ds_name(self, rrd):
+        return rrd['id'].rpartition('.')[2][:19]
 
     def _create(self, rrd):
         args = [rrd['rrdb']]
-        item_id = rrd['id'].rpartition('.')[2][:19]
+        item_id = self._ds_name(rrd)
         args.append("DS:{}:{}:{}:U:U".format(item_id, rrd['type'], str(2 * rrd['step'])))
+        if rrd['type'] == 'GAUGE':
+            # the extremes of the updates within a step, consolidated by the MIN and MAX RRAs
+            if rrd['min']:
+                args.append("DS:{}:GAUGE:{}:U:U".format(DS_MIN, str(2 * rrd['step'])))
+            if rrd['max']:
+                args.append("DS:{}:GAUGE:{}:U:U".format(DS_MAX, str(2 * rrd['step'])))
         if rrd['min']:
             args.append('RRA:MIN:0.5:{}:1825'.format(int(86400 / rrd['step'])))  # 24h/5y
         if rrd['max']:
@@ -222,3 +615,22 @@ class RRD():
             logger.debug("Creating rrd ({0}) for {1}.".format(rrd['rrdb'], rrd['item']))
         except Exception as e:
             logger.warning("Error creating rrd ({0}) for {1}: {2}".format(rrd['rrdb'], rrd['item'], e))
+
+    def _ds_names(self, rrd):
+        try:
+            info = rrdtool.info(rrd['rrdb'])
+        except Exception as e:
+            logger.warning("RRDtool: error reading info of {}: {}".format(rrd['rrdb'], e))
+            return []
+        return [key[3:-6] for key in info if key.startswith('ds[') and key.endswith('].type')]
+
+    def _column(self, name, cf):
+        """
+        Returns the index of the data source holding the values for the given
+        consolidation function
+        """
+        if cf == 'MIN' and DS_MIN in name:
+            return name.index(DS_MIN)
+        if cf == 'MAX' and DS_MAX in name:
+            return name.index(DS_MAX)
+        return 0
@@ -22,6 +22,7 @@
 import logging
 import datetime
 import functools
+import queue
 import time
 import threading
 import sqlite3
@@ -38,31 +39,41 @@ class SQL(SmartPlugin):
     # SQL queries
     # time, item, avg, vmin, vmax, power
     _create_db = "CREATE TABLE IF NOT EXISTS history (time INTEGER, item TEXT, avg REAL, vmin REAL, vmax REAL, power REAL);"
-    _create_index = "CREATE INDEX IF NOT EXISTS idy ON history (item);"
-    _pack_query = """
-        SELECT
-        group_concat(rowid),
-        group_concat(time),
-        group_concat(avg),
-        group_concat(power),
-        item,
-        MIN(vmin),
-        MAX(vmax)
-        FROM history
-        WHERE (time < {})
-        GROUP by CAST((time / {}) AS INTEGER), item
-        ORDER BY time DESC;"""
-
-    def __init__(self, smarthome, cycle=300, path=None):
+    _create_index = "CREATE INDEX IF NOT EXISTS idt ON history (item, time);"
+    # packed time ranges: item, period days, packed up to time
+    _create_pack = "CREATE TABLE IF NOT EXISTS pack (item TEXT, period INTEGER, time INTEGER, PRIMARY KEY (item, period));"
+    # maximum number of rows packed within one transaction
+    _pack_chunk = 1000
+    # maximum number of read-only connections (used by series/single queries)
+    _readers_max = 4
+    # seconds between truncating checkpoints of the write ahead log
+    _checkpoint_interval = 3600
+    # number of failed dumps after which the pending rows are dropped
+    _dump_retries = 5
+
+    def __init__(self, smarthome, cycle=300, path=None, pack_rows=10000, synchronous='NORMAL', commit_window=0):
         self.logger = logging.getLogger(__name__)
         self._sh = smarthome
         self.connected = False
         self._dump_cycle = int(cycle)
+        self._pack_rows = int(pack_rows)
+        self._pack_marks = {}
+        self._synchronous = str(synchronous).upper()
+        self._commit_window = int(commit_window)
+        self._commit_last = time.time()
+        self._checkpoint_last = time.time()
+        self._pending = []
+        self._pending_failures = 0
+        self._dump_stats = {'rows': 0, 'duration': 0.0, 'pending': 0}
         self._buffer = {}
         self._buffer_lock = threading.Lock()
         self.logger.debug("SQLite {0}".format(sqlite3.sqlite_version))
         self._fdb_lock = threading.Lock()
         self._fdb_lock.acquire()
+        # idle read-only connections, at most _readers_max are opened
+        self._readers = queue.Queue()
+        self._readers_open = 0
+        self._readers_lock = threading.Lock()
         if path is None:
             self.path = smarthome.base_dir + '/var/db/smarthome.db'
         else:
@@ -94,10 +105,22 @@ class SQL(SmartPlugin):
         self._fdb.execute("DROP INDEX IF EXISTS idx;")
         self._fdb.execute(self._create_db)
         self._fdb.execute(self._create_index)
+        # replaced by the (item, time) index
+        self._fdb.execute("DROP INDEX IF EXISTS idy;")
+        self._fdb.execute(self._create_pack)
+        self._pack_marks = {(row[0], row[1]): row[2] for row in self._fdb.execute("SELECT item, period, time FROM pack;")}
         if version < self._version:
             self._fdb.execute("UPDATE common SET version=:version;", {'version': self._version})
             # self.query("alter table history add column power INTEGER;")
         self._fdb.commit()
+        # write ahead log: readers do not block the writer (and vice versa)
+        journal = self._fdb.execute("PRAGMA journal_mode=WAL;").fetchone()[0]
+        if journal.lower() != 'wal':
+            self.logger.warning("SQLite: could not enable WAL journal mode (using {}), queries may wait for writes".format(journal))
+        if self._synchronous in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+            self._fdb.execute("PRAGMA synchronous={};".format(self._synchronous))
+        else:
+            self.logger.warning("SQLite: ignoring unknown synchronous mode '{}'".format(synchronous))
         self._fdb_lock.release()
         minute = 60 * 1000
         hour = 60 * minute
@@ -107,9 +130,7 @@ class SQL(SmartPlugin):
         year = 365 * day
         self._frames = {'i': minute, 'h': hour, 'd': day, 'w': week, 'm': month, 'y': year}
         self._times = {'i': minute, 'h': hour, 'd': day, 'w': week, 'm': month, 'y': year}
-#        smarthome.scheduler.add('SQLite pack', self._pack, cron='2 3 * *', prio=5)
 #        smarthome.scheduler.add('SQLite dump', self._dump, cycle=self._dump_cycle, offset=20, prio=5)
-        self.scheduler_add('SQLite pack', self._pack, cron='2 3 * *', prio=5)
         self.scheduler_add('SQLite dump', self._dump, cycle=self._dump_cycle, offset=20, prio=5)
 
     def parse_item(self, item):
@@ -144,6 +165,12 @@ class SQL(SmartPlugin):
         finally:
             self.connected = False
             self._fdb_lock.release()
+        # connections checked out by running queries are closed when returned
+        while True:
+            try:
+                self._reader_close(self._readers.get_nowait())
+            except queue.Empty:
+                break
 
     def update_item(self, item, caller=None, source=None, dest=None):
         now = self._timestamp(self._sh.now())
@@ -167,11 +194,16 @@ class SQL(SmartPlugin):
             self._fdb_lock.release()
             
     def _dump(self):
-        if not self._fdb_lock.acquire(timeout=2):
-            return
-        items = list(self._buffer.keys())
-        self._fdb_lock.release()
-        for item in items:
+        """
+        Writes the aggregated values of all items within one transaction
+
+        When a commit window is configured, the rows are kept in memory and
+        written together once the window has elapsed (or the plugin stops).
+        Rows which could not be written are retried with the next dump, after
+        _dump_retries failed dumps in a row they are dropped.
+        """
+        start = time.time()
+        for item in list(self._buffer.keys()):
             self._buffer_lock.acquire()
             tuples = self._buffer[item]
             self._buffer[item] = []
@@ -179,19 +211,41 @@ class SQL(SmartPlugin):
             self.update_item(item)
             _now = self._timestamp(self._sh.now())
             try:
-                _insert = self.__dump(item.id(), tuples, _now)
+                row = self.__dump(item.id(), tuples, _now)
             except:
                 continue
-            if not self._fdb_lock.acquire(timeout=10):
-                continue
+            with self._buffer_lock:
+                self._pending.append(row)
+        self._dump_stats['pending'] = len(self._pending)
+        if self.alive and start - self._commit_last < self._commit_window:
+            return
+        if self._pending and self._fdb_lock.acquire(timeout=10):
+            # rows appended meanwhile (e.g. by a concurrent dump) are written by the next dump
+            with self._buffer_lock:
+                rows, self._pending = self._pending, []
             try:
                 # time, item, avg, vmin, vmax, power
-                self._fdb.execute("INSERT INTO history VALUES (?,?,?,?,?,?);", _insert)
+                self._fdb.executemany("INSERT INTO history VALUES (?,?,?,?,?,?);", rows)
                 self._fdb.commit()
+                self._pending_failures = 0
+                self._commit_last = start
+                self._dump_stats = {'rows': len(rows), 'duration': time.time() - start, 'pending': len(self._pending)}
+                self.logger.debug("SQLite: dumped {} rows in {:.3f}s".format(len(rows), self._dump_stats['duration']))
             except Exception as e:
-                self.logger.warning("SQLite: problem updating {}: {}".format(item.id(), e))
+                self._fdb.rollback()
+                self._pending_failures += 1
+                if self._pending_failures < self._dump_retries:
+                    self.logger.warning("SQLite: problem dumping {} rows: {}".format(len(rows), e))
+                    with self._buffer_lock:
+                        self._pending = rows + self._pending
+                else:
+                    self.logger.error("SQLite: problem dumping {} rows, dropping them after {} failed dumps: {}".format(len(rows), self._pending_failures, e))
+                    self._pending_failures = 0
             finally:
                 self._fdb_lock.release()
+        if self._pack_rows > 0 and self.alive:
+            self._pack(self._pack_rows)
+            self._checkpoint()
 
     def __dump(self, item, tuples, end):
         vsum = 0.0
@@ -232,77 +286,164 @@ class SQL(SmartPlugin):
             self.logger.warning("DB select: unkown time frame '{0}'".format(frame))
         return ts
 
-    def _fetchone(self, *query):
-        if not self._fdb_lock.acquire(timeout=2):
-            return
-        if not self.connected:
-            self._fdb_lock.release()
-            return
+    def _reader_get(self):
+        """
+        Checks out an idle read-only connection
+
+        Readers use their own connections, so queries never wait for the dump
+        or pack holding the writer connection (in WAL journal mode). A new
+        connection is opened if none is idle, until _readers_max connections
+        are open, then the query waits for a connection to be returned.
+        """
         try:
-            reply = self._fdb.execute(*query).fetchone()
-        except Exception as e:
-            self.logger.warning("SQLite: Problem with '{0}': {1}".format(query, e))
-            reply = None
-        finally:
-            self._fdb_lock.release()
-        return reply
+            return self._readers.get_nowait()
+        except queue.Empty:
+            pass
+        with self._readers_lock:
+            opened = self._readers_open < self._readers_max
+            if opened:
+                self._readers_open += 1
+        if not opened:
+            return self._readers.get(timeout=10)
+        try:
+            return sqlite3.connect('file:{}?mode=ro'.format(self.path), uri=True, timeout=10,
+                                   check_same_thread=False)
+        except Exception:
+            with self._readers_lock:
+                self._readers_open -= 1
+            raise
+
+    def _reader_put(self, reader):
+        if self.connected:
+            self._readers.put(reader)
+        else:
+            self._reader_close(reader)
+
+    def _reader_close(self, reader):
+        with self._readers_lock:
+            self._readers_open -= 1
+        try:
+            reader.close()
+        except Exception:
+            pass
+
+    def _fetchone(self, *query):
+        return self._read(lambda cursor: cursor.fetchone(), query)
 
     def _fetchall(self, *query):
-        if not self._fdb_lock.acquire(timeout=2):
-            return
+        return self._read(lambda cursor: cursor.fetchall(), query)
+
+    def _read(self, fetch, query):
         if not self.connected:
-            self._fdb_lock.release()
             return
+        reader = None
         try:
-            reply = self._fdb.execute(*query).fetchall()
+            reader = self._reader_get()
+            reply = fetch(reader.execute(*query))
         except Exception as e:
             self.logger.warning("SQLite: Problem with '{0}': {1}".format(query, e))
             reply = None
         finally:
-            self._fdb_lock.release()
+            if reader is not None:
+                self._reader_put(reader)
         return reply
 
-    def _pack(self):
-        insert = []
-        delete = []
-        if not self._fdb_lock.acquire(timeout=2):
+    def _pack(self, budget=None):
+        """
+        Packs the history of the items incrementally
+
+        For every period the rows older than the period are aggregated to one
+        row per granularity. The time up to which an item is packed for a
+        period is stored in the pack table, so only rows logged since the last
+        run are read. Every chunk of rows is packed within its own transaction.
+
+        :param budget: maximum number of rows to read (None: pack everything)
+        """
+        done = 0
+        now = self._timestamp(self._sh.now())
+        for item in [item.id() for item in list(self._buffer)]:
+            for period, granularity in self.periods:
+                cutoff = int(now - period * 24 * 3600 * 1000)
+                granularity = int(granularity * 3600 * 1000)
+                cutoff -= cutoff % granularity
+                while self.connected and self._pack_marks.get((item, period), 0) < cutoff:
+                    if budget is not None and done >= budget:
+                        return
+                    if not self._fdb_lock.acquire(timeout=10):
+                        return
+                    try:
+                        done += self._pack_chunk_rows(item, period, granularity, cutoff)
+                        self._fdb.commit()
+                    except Exception as e:
+                        self.logger.exception("problem packing sqlite database: {} item: {} period: {}".format(e, item, period))
+                        self._fdb.rollback()
+                        self._pack_marks = {(row[0], row[1]): row[2] for row in self._fdb.execute("SELECT item, period, time FROM pack;")}
+                        return
+                    finally:
+                        self._fdb_lock.release()
+
+    def _checkpoint(self):
+        """
+        Writes the write ahead log back into the database and truncates it
+
+        Packing deletes and inserts rows continuously, so without a truncating
+        checkpoint the WAL file keeps the size of the largest pack run.
+        """
+        if time.time() - self._checkpoint_last < self._checkpoint_interval:
+            return
+        if not self._fdb_lock.acquire(timeout=10):
             return
         try:
-            self.logger.debug("SQLite: pack database")
-            for entry in self.periods:
-                now = self._timestamp(self._sh.now())
-                prev = {}
-                period, granularity = entry
-                period = int(now - period * 24 * 3600 * 1000)
-                granularity = int(granularity * 3600 * 1000)
-                for row in self._fdb.execute(self._pack_query.format(period, granularity)):
-                    gid, gtime, gavg, gpower, item, vmin, vmax = row
-                    gtime = gtime.split(',')
-                    if len(gtime) == 1:  # ignore
-                        prev[item] = gtime[0]
-                        continue
-                    if item not in prev:
-                        upper = now
-                    else:
-                        upper = prev[item]
-                    # pack !!!
-                    delete = gid
-                    gavg = gavg.split(',')
-                    gpower = gpower.split(',')
-                    _time, _avg, _power = self.__pack(gtime, gavg, gpower, upper)
-                    insert = (_time, item, _avg, vmin, vmax, _power)
-                    self._fdb.execute("INSERT INTO history VALUES (?,?,?,?,?,?);", insert)
-                    self._fdb.execute("DELETE FROM history WHERE rowid in ({0});".format(delete))
-                    self._fdb.commit()
-                    prev[item] = gtime[0]
-            self._fdb.execute("VACUUM;")
-            self._fdb.execute("PRAGMA shrink_memory;")
+            busy, pages, done = self._fdb.execute("PRAGMA wal_checkpoint(TRUNCATE);").fetchone()
+            self._checkpoint_last = time.time()
+            if busy:
+                self.logger.debug("SQLite: WAL checkpoint incomplete ({} of {} pages), queries running".format(done, pages))
         except Exception as e:
-            self.logger.exception("problem packing sqlite database: {} period: {} type: {}".format(e, period, type(period)))
-            self._fdb.rollback()
+            self.logger.warning("SQLite: problem checkpointing the WAL: {}".format(e))
         finally:
             self._fdb_lock.release()
 
+    def _pack_chunk_rows(self, item, period, granularity, cutoff):
+        """
+        Packs the next chunk of rows of an item for the given period
+
+        :return: number of rows read
+        """
+        start = self._pack_marks.get((item, period), 0)
+        rows = self._fdb.execute("SELECT rowid, time, avg, power, vmin, vmax FROM history WHERE item = ? AND time >= ? AND time < ? ORDER BY time ASC LIMIT ?;",
+                                 (item, start, cutoff, self._pack_chunk)).fetchall()
+        end = cutoff
+        if len(rows) == self._pack_chunk:
+            # do not split a group of rows between chunks
+            end = rows[-1][1] - rows[-1][1] % granularity
+            if end <= rows[0][1]:
+                end = rows[0][1] - rows[0][1] % granularity + granularity
+                rows = self._fdb.execute("SELECT rowid, time, avg, power, vmin, vmax FROM history WHERE item = ? AND time >= ? AND time < ? ORDER BY time ASC;",
+                                         (item, start, end)).fetchall()
+            else:
+                rows = [row for row in rows if row[1] < end]
+        if rows:
+            upper = self._fdb.execute("SELECT time FROM history WHERE item = ? AND time >= ? ORDER BY time ASC LIMIT 1;", (item, end)).fetchone()
+            upper = self._timestamp(self._sh.now()) if upper is None else upper[0]
+            groups = []
+            for row in rows:
+                if groups and groups[-1][0][1] // granularity == row[1] // granularity:
+                    groups[-1].append(row)
+                else:
+                    groups.append([row])
+            for i, group in enumerate(groups):
+                if len(group) == 1:
+                    continue
+                gend = groups[i + 1][0][1] if i + 1 < len(groups) else upper
+                _time, _avg, _power = self.__pack([row[1] for row in group], [row[2] for row in group], [row[3] for row in group], gend)
+                # time, item, avg, vmin, vmax, power
+                self._fdb.execute("INSERT INTO history VALUES (?,?,?,?,?,?);",
+                                  (_time, item, _avg, min(row[4] for row in group), max(row[5] for row in group), _power))
+                self._fdb.executemany("DELETE FROM history WHERE rowid = ?;", [(row[0],) for row in group])
+        self._fdb.execute("INSERT OR REPLACE INTO pack VALUES (?,?,?);", (item, period, end))
+        self._pack_marks[(item, period)] = end
+        return max(len(rows), 1)
+
     def __pack(self, gtime, gavg, gpower, end):
         asum = 0.0
         psum = 0.0